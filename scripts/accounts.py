@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module lets a workshop use more than one AWS account.
+#
+# Each account is a named profile in the AWS credentials file (the one named
+# by AWS_SHARED_CREDENTIALS_FILE).  The `default` profile is the one that
+# `finish_install` has always set up; `finish_install` can now add others.
+#
+# A "location" says where instances live: A region, optionally prefixed by a
+# profile name and a colon (like `second:us-west-2`).  A plain region means
+# the default profile.  Locations are used wherever our scripts use regions as
+# keys (for clients, and for grouping instances), so the default account's
+# regions look just like they always have.
+
+# First, import modules from the standard library
+from os import environ
+import os
+import threading
+
+# Then, import our own stuff
+import configstore
+import startup
+
+
+# The profile that plain regions use.
+DEFAULT_PROFILE = 'default'
+
+# What goes between a profile and a region, in a location.
+LOCATION_SEPARATOR = ':'
+
+# The profile names in the credentials file, once we have read them.
+_profiles = None
+_profiles_lock = threading.Lock()
+
+
+# Make a location from a profile and a region.
+def location(profile, region):
+    if profile is None or profile == DEFAULT_PROFILE:
+        return region
+    return '%s%s%s' % (profile, LOCATION_SEPARATOR, region)
+
+
+# Split a location into a tuple of (profile, region).
+def split_location(location):
+    if LOCATION_SEPARATOR in location:
+        profile, region = location.split(LOCATION_SEPARATOR, 1)
+        return (profile, region)
+    return (DEFAULT_PROFILE, location)
+
+
+# Get the location of an instance record (see the `inventory` module).
+def instance_location(instance):
+    return location(instance.get('Account'), instance['Region'])
+
+
+# Get the names of the profiles in the credentials file.
+# The file is only read once.
+# Returns a sorted list of profile names.
+def profiles():
+    global _profiles
+    with _profiles_lock:
+        if _profiles is None:
+            path = environ.get('AWS_SHARED_CREDENTIALS_FILE')
+            if path is None or not os.path.isfile(path):
+                _profiles = list()
+            else:
+                credentials, snapshot = configstore.read_config(path)
+                _profiles = sorted(credentials.sections())
+        return list(_profiles)
+
+
+# Get the session for a profile.
+def session(profile):
+    if profile == DEFAULT_PROFILE:
+        profile = None
+    return startup.get_session(profile)
+
+
+# Get a (shared) client for a location.
+def client(location, service='ec2'):
+    profile, region = split_location(location)
+    if profile == DEFAULT_PROFILE:
+        profile = None
+    return startup.client(service, region_name=region, profile=profile)
+
+
+# Start making clients for some locations, in the background.
+def preload_clients(locations, service='ec2'):
+    def preload():
+        try:
+            for location in locations:
+                client(location, service)
+        except Exception:
+            # Whoever uses the client will hit (and report) the problem.
+            pass
+    threading.Thread(target=preload, daemon=True).start()
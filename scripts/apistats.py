@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module measures our AWS API calls, so we can tell how much of a script's
+# time is spent waiting on AWS, and how much is spent in our own loops.
+#
+# It hooks into botocore's event system on each session (see `startup`):
+# `before-call` notes when a call starts, `needs-retry` sees each attempt (and
+# whether AWS throttled it), and `after-call` (or `after-call-error`) notes
+# when the call is done.  The time of a call includes any retries, and the
+# waits between them.
+#
+# For each operation, in each region, we count the calls, errors, retries, and
+# throttles, and keep a histogram of how long the calls took.  `report` prints
+# a summary, and `dump` writes everything out as JSON.
+
+# First, import modules from the standard library
+import json
+import os
+import sys
+import threading
+import time
+
+
+# The histogram's buckets: Each is the longest call (in milliseconds) that it
+# counts.  The last bucket counts everything longer.
+buckets = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# These errors mean AWS throttled us.
+throttle_errors = (
+    'EC2ThrottledException',
+    'PriorRequestNotComplete',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+)
+
+# Where we keep the numbers in each call's botocore context.
+CONTEXT_KEY = 'workshop_apistats'
+
+# When we started, for reporting.
+start_time = time.perf_counter()
+
+# Our numbers, keyed by (operation, region).  Updates happen one at a time.
+_stats = dict()
+_stats_lock = threading.Lock()
+
+
+# Work out which region a call is going to, from its botocore context.
+def _context_region(context, request_signer=None):
+    region = context.get('client_region')
+    if region is None and request_signer is not None:
+        region = getattr(request_signer, 'region_name', None)
+    return region or '(none)'
+
+
+# Our `before-call` handler: Start timing the call.
+def _before_call(model, context, request_signer=None, **kwargs):
+    context[CONTEXT_KEY] = {
+        'operation': '%s.%s' % (model.service_model.service_name, model.name),
+        'region': _context_region(context, request_signer),
+        'start': time.perf_counter(),
+        'attempts': 1,
+        'throttles': 0,
+    }
+
+
+# Our `needs-retry` handler: Count the attempts, and the throttles.
+# We only watch; returning None leaves the decision to botocore.
+def _needs_retry(attempts=1, response=None, request_dict=None, **kwargs):
+    if request_dict is None or CONTEXT_KEY not in request_dict.get('context', dict()):
+        return None
+    call = request_dict['context'][CONTEXT_KEY]
+    call['attempts'] = max(call['attempts'], attempts)
+    if response is not None:
+        error_code = response[1].get('Error', dict()).get('Code')
+        if error_code in throttle_errors:
+            call['throttles'] = call['throttles'] + 1
+    return None
+
+
+# Record a finished call.
+def _finish(context, error):
+    call = context.get(CONTEXT_KEY)
+    if call is None:
+        return
+    milliseconds = (time.perf_counter() - call['start']) * 1000
+    bucket = len(buckets)
+    for i, limit in enumerate(buckets):
+        if milliseconds <= limit:
+            bucket = i
+            break
+    with _stats_lock:
+        key = (call['operation'], call['region'])
+        if key not in _stats:
+            _stats[key] = {
+                'calls': 0,
+                'errors': 0,
+                'retries': 0,
+                'throttles': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'histogram': list(0 for i in range(0, len(buckets) + 1)),
+            }
+        entry = _stats[key]
+        entry['calls'] = entry['calls'] + 1
+        if error:
+            entry['errors'] = entry['errors'] + 1
+        entry['retries'] = entry['retries'] + call['attempts'] - 1
+        entry['throttles'] = entry['throttles'] + call['throttles']
+        entry['total_ms'] = entry['total_ms'] + milliseconds
+        entry['max_ms'] = max(entry['max_ms'], milliseconds)
+        entry['histogram'][bucket] = entry['histogram'][bucket] + 1
+
+
+# Our `after-call` handler.  A call that AWS refused (say, with an HTTP 400)
+# still ends up here, before botocore raises its error.
+def _after_call(context, http_response=None, **kwargs):
+    _finish(context, http_response is None or http_response.status_code >= 300)
+
+
+# Our `after-call-error` handler, for calls that never got a response.
+def _after_call_error(context, **kwargs):
+    _finish(context, True)
+
+
+# Hook into a session's events.  This must happen before the session makes any
+# clients, because clients copy the session's handlers when they are made.
+def install(session):
+    session.events.register('before-call', _before_call)
+    session.events.register('needs-retry', _needs_retry)
+    session.events.register('after-call', _after_call)
+    session.events.register('after-call-error', _after_call_error)
+
+
+# Estimate a percentile (`fraction` is between 0 and 1) from a histogram.
+# Returns the bucket's limit, or None if the call was longer than every limit.
+def histogram_percentile(histogram, fraction):
+    total = sum(histogram)
+    if total == 0:
+        return 0
+    needed = fraction * total
+    running = 0
+    for i, count in enumerate(histogram):
+        running = running + count
+        if running >= needed:
+            return buckets[i] if i < len(buckets) else None
+    return None
+
+
+# Get a copy of our numbers.
+# Returns a list of dicts, one per operation and region, slowest (in total)
+# first.
+def snapshot():
+    with _stats_lock:
+        entries = list(
+            dict(entry, operation=operation, region=region, histogram=list(entry['histogram']))
+            for (operation, region), entry in _stats.items()
+        )
+    return sorted(entries, key=lambda entry: entry['total_ms'], reverse=True)
+
+
+# Write our numbers out as JSON, to a path (or to an open file).
+def dump(path_or_file):
+    data = {
+        'run_ms': round((time.perf_counter() - start_time) * 1000, 1),
+        'buckets_ms': list(buckets),
+        'operations': snapshot(),
+    }
+    if hasattr(path_or_file, 'write'):
+        json.dump(data, path_or_file, indent=2)
+        return
+    temp_path = '%s.tmp' % (path_or_file,)
+    with open(temp_path, 'w') as dump_fh:
+        json.dump(data, dump_fh, indent=2)
+    os.replace(temp_path, path_or_file)
+
+
+# Print a summary of our numbers (to standard error).
+def report(out=None):
+    if out is None:
+        out = sys.__stderr__
+    entries = snapshot()
+    print('', file=out)
+    print('AWS API calls (times in milliseconds)', file=out)
+    if len(entries) == 0:
+        print('  (none)', file=out)
+        return
+    print('  %-36s %-16s %6s %6s %7s %9s %8s %7s %7s %8s' % (
+        'Operation', 'Region', 'Calls', 'Errors', 'Retries', 'Throttles',
+        'Mean', 'p50', 'p90', 'Max',
+    ), file=out)
+
+    def show_limit(limit):
+        return ('>%d' % (buckets[-1],)) if limit is None else ('<=%d' % (limit,))
+
+    total_ms = 0.0
+    for entry in entries:
+        total_ms = total_ms + entry['total_ms']
+        print('  %-36s %-16s %6d %6d %7d %9d %8.1f %7s %7s %8.1f' % (
+            entry['operation'],
+            entry['region'],
+            entry['calls'],
+            entry['errors'],
+            entry['retries'],
+            entry['throttles'],
+            entry['total_ms'] / entry['calls'],
+            show_limit(histogram_percentile(entry['histogram'], 0.5)),
+            show_limit(histogram_percentile(entry['histogram'], 0.9)),
+            entry['max_ms'],
+        ), file=out)
+    print('  Time in AWS calls: %.1f (added up across threads)' % (total_ms,), file=out)
+    print('  Total run time: %.1f' % (
+        (time.perf_counter() - start_time) * 1000,
+    ), file=out)
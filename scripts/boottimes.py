@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module remembers how long each workshop's instances took to be ready:
+# the time (in seconds) from asking EC2 for an instance, to the instance
+# passing its status checks.  `create_instances` and `schedule_instances`
+# record every launch, and `schedule_instances` uses the history to work out
+# when to start launching.
+#
+# Only the most recent `max_samples` times are kept for each workshop.  Until a
+# workshop has `min_samples` times, the times of every workshop are used; and
+# until there are that many, we guess `default_ready_time`.
+#
+# The history is kept (and locked) by the `jsoncache` module.
+
+# First, import modules from the standard library
+import math
+
+# Then, import our own stuff
+import jsoncache
+
+
+history_path = jsoncache.path('boot_times.json')
+
+# How many times are kept for each workshop.
+max_samples = 200
+
+# How many times we need, before we trust them.
+min_samples = 5
+
+# Our guess (in seconds), when we don't have enough history.
+default_ready_time = 8 * 60
+
+
+# Check that the history (as read from disk) looks right.
+def is_valid(history):
+    return isinstance(history, dict)
+
+
+# Read the history.  A missing or broken history is the same as an empty one.
+# Returns a dict mapping workshop names to lists of times.
+def load():
+    return jsoncache.read(history_path, is_valid) or dict()
+
+
+# Add some times (in seconds) to a workshop's history.
+def record(workshop, times):
+    times = list(round(ready_time, 1) for ready_time in times)
+    if len(times) == 0:
+        return
+    with jsoncache.update(history_path, dict, is_valid) as history:
+        samples = history.get(workshop, list()) + times
+        history[workshop] = samples[-max_samples:]
+
+
+# Get a percentile of some times (using the nearest-rank method).
+# `fraction` is between 0 and 1; for example, 0.9 is the 90th percentile.
+# Returns None if there are no times.
+def percentile(times, fraction):
+    if len(times) == 0:
+        return None
+    times = sorted(times)
+    rank = max(1, int(math.ceil(fraction * len(times))))
+    return times[min(rank, len(times)) - 1]
+
+
+# Predict how long a workshop's instances will take to be ready.
+# Returns a tuple of the prediction (in seconds), and how many times it is
+# based on (zero if it is our guess).
+def predict(workshop, fraction):
+    history = load()
+    samples = history.get(workshop, list())
+    if len(samples) < min_samples:
+        samples = list(
+            ready_time
+            for workshop_samples in history.values()
+            for ready_time in workshop_samples
+        )
+    if len(samples) < min_samples:
+        return (default_ready_time, 0)
+    return (percentile(samples, fraction), len(samples))
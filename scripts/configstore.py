@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module reads and writes our config files without holding locks for
+# longer than it takes to read or write them.
+#
+# Readers take a snapshot: The file's text and version, read under a brief
+# shared lock.  The lock is released right away, so a long-running launch
+# never blocks `finish_install`.  Writers write a new copy of the file, and
+# rename it into place (so nobody ever sees a half-written file), and then
+# bump the version.  A reader can check its snapshot against the current
+# version, to see if the file changed since it was read.  A writer can pass
+# the snapshot it started from, so it doesn't overwrite someone else's change.
+#
+# Each config file has a lock file next to it (`<file>.lock`), which holds the
+# file's version number.  The config file itself can't be locked, because
+# renaming a new copy into place would leave the lock on the old copy.
+
+# First, import modules from the standard library
+import configparser
+import contextlib
+import fcntl
+import io
+import os
+
+
+# A write found that the file changed since the writer's snapshot was taken.
+class StaleConfigError(Exception):
+    pass
+
+
+# Where a config file's lock (and version number) lives.
+def lock_path(path):
+    return '%s.lock' % (path,)
+
+
+# Hold a lock on a config file, for a `with` block.  The lock file is yielded,
+# so the version can be read (or written).
+# The lock is only ever held briefly, so we wait for it.
+@contextlib.contextmanager
+def locked(path, operation):
+    with open(lock_path(path), 'a+t', encoding='utf-8') as lock_fh:
+        fcntl.flock(lock_fh.fileno(), operation)
+        try:
+            yield lock_fh
+        finally:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+
+
+# Read the version from a (locked) lock file.  A new lock file is version 0.
+def read_version(lock_fh):
+    lock_fh.seek(0, 0)
+    version = lock_fh.read().strip()
+    if version.isdigit():
+        return int(version)
+    return 0
+
+
+# Describe the file on disk, so hand edits (which don't bump the version) can
+# be noticed too.  Returns None if the file doesn't exist.
+def file_signature(path):
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (path_stat.st_ino, path_stat.st_size, path_stat.st_mtime_ns)
+
+
+# Take a snapshot of a config file.  A missing file reads as empty.
+# Returns a dict with the file's path, version, signature, and text.
+def read(path):
+    with locked(path, fcntl.LOCK_SH) as lock_fh:
+        try:
+            with open(path, 'r', encoding='utf-8') as config_fh:
+                text = config_fh.read()
+        except FileNotFoundError:
+            text = ''
+        return {
+            'path': path,
+            'version': read_version(lock_fh),
+            'signature': file_signature(path),
+            'text': text,
+        }
+
+
+# Take a snapshot of a config file, and parse it.
+# Returns a tuple of the ConfigParser and the snapshot.
+def read_config(path):
+    snapshot = read(path)
+    config = configparser.ConfigParser()
+    config.read_string(snapshot['text'], source=path)
+    return (config, snapshot)
+
+
+# Check if a config file has changed since a snapshot was taken.
+def changed(snapshot):
+    with locked(snapshot['path'], fcntl.LOCK_SH) as lock_fh:
+        return (
+            read_version(lock_fh) != snapshot['version'] or
+            file_signature(snapshot['path']) != snapshot['signature']
+        )
+
+
+# Replace a config file's contents.
+# If a snapshot is given, and the file has changed since it was taken, nothing
+# is written, and StaleConfigError is raised.
+# Returns a snapshot of what was written.
+def write(path, text, snapshot=None):
+    with locked(path, fcntl.LOCK_EX) as lock_fh:
+        version = read_version(lock_fh)
+        if snapshot is not None and (
+            version != snapshot['version'] or
+            file_signature(path) != snapshot['signature']
+        ):
+            raise StaleConfigError(
+                'The file at %s was changed by someone else' % (path,)
+            )
+
+        # Write the new copy next to the old one (so the rename stays in one
+        # filesystem), with the same permissions.  Credentials live in one of
+        # these files, so a new file is only readable by us.
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o600
+        temp_path = '%s.%d' % (path, os.getpid())
+        temp_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with open(temp_fd, 'w', encoding='utf-8') as temp_fh:
+            temp_fh.write(text)
+            temp_fh.flush()
+            os.fsync(temp_fh.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+
+        # Bump the version.
+        version = version + 1
+        lock_fh.seek(0, 0)
+        lock_fh.truncate(0)
+        lock_fh.write('%d\n' % (version,))
+        lock_fh.flush()
+
+        return {
+            'path': path,
+            'version': version,
+            'signature': file_signature(path),
+            'text': text,
+        }
+
+
+# Write out a ConfigParser.  See `write` for details.
+def write_config(path, config, snapshot=None):
+    config_text = io.StringIO()
+    config.write(config_text)
+    return write(path, config_text.getvalue(), snapshot)
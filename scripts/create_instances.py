@@ -11,21 +11,27 @@
 # See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
 
 # First, import modules from the standard library
-import configparser
-import fcntl
-import os
-from os import environ
-import random
+import datetime
 import signal
 import sys
 from sys import exit
 import time
 
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
 # Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
 try:
-    import boto3
+    startup.require('boto3', 'dateutil')
     from progress.bar import Bar
-    from progress.spinner import Spinner
+    import accounts
+    import boottimes
+    import configstore
+    import launch
+    import quota
+    import validation
+    import workshops
 except ModuleNotFoundError as e:
     print('Failed to import module %s' % (e.name,))
     print('Run `finish_install`')
@@ -33,177 +39,65 @@ except ModuleNotFoundError as e:
 
 print('Welcome to Instance Launcher!')
 
+# Start talking to AWS in the background, while we read the config and the
+# user reads the menu.
+startup.start_session()
+
 # Worker timeout is in seconds
 worker_timeout = 600
 
-# Look for and lock our config files
-spinner = Spinner('Checking Configuration ')
-handles = dict()
-for var in (
-    'AWS_CONFIG_FILE',
-    'AWS_SHARED_CREDENTIALS_FILE',
-    'CREATE_INSTANCES_CONFIG',
-):
-    spinner.next()
-    if var not in environ:
-        print('Environment variable %s is missing.  Re-run `finish_install`.' % (
-            var,
-        ))
-        exit()
-    if not os.path.isfile(environ[var]):
-        print('The %s file appears to be missing.  Re-run `finish_install`.' % (
-            var,
-        ))
-        exit()
-    try:
-        handles[var] = open(environ[var], 'r')
-        fcntl.flock(handles[var].fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
-    except Exception as e:
-        print('There was a problem opening and locking the file at %s: %s' % (
-            environ[var],
-            e,
-        ))
-        print('There may be a permission problem.')
-        print('Or, someone else may be running `finish_install`.')
-        exit()
-        
-# Try loading our config
-spinner.next()
-config = configparser.ConfigParser()
-try:
-    config.read(environ['CREATE_INSTANCES_CONFIG'])
-    spinner.next()
-except Exception as e:
-    print('ERROR')
-    print('The instance configuration file could not be read.')
-    print('Here is the error: ', e)
-    print('Re-run `finish_install`')
-    exit()
-print(' Complete')
-
-# Check for connectivity and permissions
-spinner = Spinner('Talking to AWS ')
-
-# Our EC2 client uses the default region for this check.
-try:
-    ec2_client = boto3.client('ec2')
-    ec2_client.describe_instances(MaxResults=5)
-    spinner.next()
-except Exception as e:
-    print('ERROR!')
-    print('We were unable to get a list of running EC2 instances.')
-    print('The exact error we got:', e)
-    print('Re-run `finish_install`')
-    exit()
-print(' Complete')
-
-# Prepare to build an indexed list of configs
-config_names_as_list = list()
-config_names_as_list.append('(Quit)')
-spinner = Spinner('Checking %s workshop(s) ' % (
-    len(config.sections()),
-))
+# Load our config files
+with startup.phase('Reading configuration'):
+    config, config_snapshot = workshops.load_config()
 
 # Build our list of usable workshops
-for workshop in config.sections():
-    # Make sure the required keys are in each workshop.
-    for var in (
-        'template',
-        'region',
-        'instructions',
-        'maximum',
-    ):
-        # Skip if we're missing a var
-        if var not in config[workshop]:
-            print(' WARNING')
-            print('Workshop "%s" missing config item \'%s\'.' % (
-                workshop,
-                var
-            ))
-            print('Skipping this entry for now.  Re-run `finish_install` to fix.')
-            next
-
-        # For maximum, do number tests
-        if var == 'maximum':
-            try:
-                config[workshop].getint('maximum')
-            except ValueError:
-                config[workshop]['maximum'] = -1
-            if config[workshop].getint('maximum') <= 0:
-                print(' WARNING')
-                print('Workworkshop "%s" has invalid item \'maximum\'.' % (
-                    workshop,
-                ))
-                print('Skipping this entry for now.  Re-run `finish_install` to fix.')
-                next
-
-    # Done checking over individual vars.
-
-    # Change ec2_client to this workshop's region
-    ec2_client = boto3.client('ec2',
-        region_name=config[workshop]['region'],
+with startup.phase('Checking workshops'):
+    usable_workshops = workshops.check_workshops(config)
+
+# We now have a list of workshops.
+# Which workshop does the user wish to access?
+with startup.phase('Waiting for a choice'):
+    chosen_config = workshops.choose_workshop(
+        usable_workshops,
+        'The following workshops are available to launch:',
     )
 
-    # Make sure we can access the launch template
-    try:
-        ec2_client.describe_launch_templates(LaunchTemplateIds=[config[workshop]['template']])
-    except Exception as e:
-        print(' WARNING')
-        print('Unable to pull up the launch template for workworkshop "%s"' % (
-            workshop,
-        ))
-        print('Skipping this entry for now.  Re-run `finish_install` to fix.')
-        next
-
-    # Done checking this workshop!
-    config_names_as_list.append(workshop)
-    spinner.next()
-
-# Done checking configuration
-print(' Complete')
-
-# We now have a list of instance types to launch, and a working Boto3 client.
-# What does the user wish to launch?
-
-print('')
-print('The following workshops are available to launch:')
-for i in range(0, len(config_names_as_list)):
-    print('%3d: %s' % (i, config_names_as_list[i]))
-choice_index = -1
-while choice_index == -1:
-    try:
-        choice_index = input('Please choose a number from 0 to %d: ' % (len(config_names_as_list)-1,))
-    except (EOFError, KeyboardInterrupt):
-        choice_index = 0
-    try:
-        choice_index = int(choice_index)
-    # Make sure we have an integer in the range [0, len(config_names_as_list))
-    except ValueError:
-        print('Please enter a valid base 10 integer')
-        choice_index = -1
-        continue
-    if choice_index < 0:
-        print('Please enter a non-negative integer')
-        choice_index = -1
-    if choice_index >= len(config_names_as_list):
-        print('Please enter an integer less than %d' % (len(config_names_as_list),))
-        choice_index = -1
-
 # Report the selection, or exit
-if choice_index == 0:
+if chosen_config is None:
     print('Goodbye')
     exit()
-chosen_config = config_names_as_list[choice_index]
-print('')
-print("Selected template:  %s\nAWS Region:         %s\nAWS Template ID:    %s\nUsage Instructions: %s" %
-      (chosen_config, config[chosen_config]['region'], config[chosen_config]['template'], config[chosen_config]['instructions'])
-)
-del choice_index
-del config_names_as_list
 
-# Do our final ec2_client re-creation
-ec2_client = boto3.client('ec2',
-    region_name = config[chosen_config]['region'],
+# A workshop may be split into shards, each a region/template pair with a
+# weight (see `workshops.workshop_shards`).  Most workshops have just one.
+shards = workshops.workshop_shards(config, chosen_config)
+shard_regions = sorted(set(region for region, template, weight in shards))
+
+# Now that we know the workshop, check connectivity and its launch template(s).
+# We also make sure we're allowed to launch (and tag) instances in each region.
+with startup.phase('Talking to AWS'):
+    workshops.check_connectivity(workshops.launch_checks(shards))
+    if len(workshops.check_templates(config, [chosen_config])) == 0:
+        print('Goodbye')
+        exit()
+
+print('')
+if len(shards) == 1:
+    print("Selected template:  %s\nAWS Region:         %s\nAWS Template ID:    %s\nUsage Instructions: %s" %
+          (chosen_config, shards[0][0], shards[0][1], config[chosen_config]['instructions'])
+    )
+else:
+    print("Selected template:  %s\nUsage Instructions: %s" %
+          (chosen_config, config[chosen_config]['instructions'])
+    )
+    print('AWS Regions:')
+    for region, template, weight in shards:
+        print('  %-16s %-22s (weight %d)' % (region, template, weight))
+del usable_workshops
+
+# Do our final ec2_client re-creation, one per region (and account)
+ec2_clients = dict(
+    (region, accounts.client(region))
+    for region in shard_regions
 )
 
 # How many instances should be launched?
@@ -234,10 +128,84 @@ while instance_count == -1:
 if instance_count == 0:
     print('Goodbye')
     exit()
+
+# The config isn't locked while we wait for the user, so make sure the
+# workshop wasn't changed (by `finish_install`, say) in the meantime.
+if configstore.changed(config_snapshot):
+    new_config, config_snapshot = configstore.read_config(config_snapshot['path'])
+    if (
+        (chosen_config not in new_config) or
+        (dict(new_config[chosen_config]) != dict(config[chosen_config]))
+    ):
+        print('The configuration for `%s` changed while you were choosing.' % (chosen_config,))
+        print('Please run `create_instances` again.')
+        exit()
+    del new_config
+
+# Split the count across the shards.
+shard_counts = launch.split_count(instance_count, list(shard[2] for shard in shards))
+
+# Before anything is launched, make sure the instances fit within the vCPU (or
+# instance) limits of each region (see the `quota` module).  Shards that are
+# near their limits are capped, and the rest goes to shards with room.
+with startup.phase('Checking limits'):
+    print('Checking instance limits… ', end='')
+    sys.stdout.flush()
+    limits, limit_errors = quota.shard_limits(shards)
+    planned_counts = quota.fit_counts(shards, shard_counts, limits)
+    if len(limit_errors) > 0:
+        print('WARNING')
+        for region, e in sorted(limit_errors.items()):
+            print('Unable to check the limits in %s: %s' % (region, e))
+        print('We will try to launch there anyway.')
+    else:
+        print('Complete')
+if sum(planned_counts) == 0:
+    print('None of the instances fit within your current limits.')
+    print('Terminate some instances, or ask AWS to raise your limits.')
+    print('Goodbye')
+    exit()
+elif sum(planned_counts) < instance_count:
+    print('Only %d of the %d instances fit within your current limits.' % (
+        sum(planned_counts),
+        instance_count,
+    ))
+    response = None
+    while response not in ('y', 'n'):
+        try:
+            response = input('Launch %d instances instead (y/n)? ' % (sum(planned_counts),))
+        except (EOFError, KeyboardInterrupt):
+            response = 'n'
+    if response == 'n':
+        print('Goodbye')
+        exit()
+    instance_count = sum(planned_counts)
+elif planned_counts != shard_counts:
+    print('Some regions are near their limits, so the split has been adjusted.')
+shard_counts = planned_counts
+del limits
+del limit_errors
+del planned_counts
+
+launch_plan = list(
+    (region, template, count)
+    for (region, template, weight), count in zip(shards, shard_counts)
+)
+if len(shards) > 1:
+    print('')
+    print('The instances will be split like this:')
+    for region, template, count in launch_plan:
+        print('  %-16s %-22s %d' % (region, template, count))
+    print('')
+
 print('Requesting %d instances of `%s`… ' % (instance_count, chosen_config), end='')
 
-instance_template = config[chosen_config]['template']
 instance_instructions = config[chosen_config]['instructions']
+validation_key = validation.entry_key(
+    config,
+    chosen_config,
+    validation.credential_identity(),
+)
 del config
 
 # Block the user from unintentionally doing Control-C after this point.
@@ -253,47 +221,40 @@ def control_c(signal, frame):
         exit()
 signal.signal(signal.SIGINT, control_c)
 
-# Let's launch our instances.  This will be done synchronously, as a single call.
-try:
-    # Flush stdout, and then do the call
-    sys.stdout.flush()
-    launched_instances = ec2_client.run_instances(
-        LaunchTemplate={
-            'LaunchTemplateId': instance_template,
-        },
-        MinCount=instance_count,
-        MaxCount=instance_count,
-        TagSpecifications=({
-            'ResourceType': 'instance',
-            'Tags': [
-               {
-                    'Key': 'LaunchDate',
-                    'Value': 'x',
-                },
-                {
-                    'Key': 'LaunchDateTime',
-                    'Value': 'x',
-                },
-            ],
-        },),
-    )
-except Exception as e:
-    print('ERROR')
-    print('Something went wrong in the call to run the instances')
-    print('Here are the details: ', e)
-    exit()
+# Let's launch our instances.  Each shard is launched with a single call, and
+# the shards are launched at the same time.
+# The launch time tags (in UTC) survive stops and starts, unlike EC2's own
+# launch time, so the reaper uses them to work out an instance's age.
+launch_datetime = datetime.datetime.now(datetime.timezone.utc)
+launch_starttime = time.monotonic()
 
-# Do some manipulation: We want a dict of instance IDs to dicts
-launched_instances = launched_instances['Instances']
-launched_instances = dict(
-    (instance['InstanceId'], instance) for instance in launched_instances
+# Flush stdout, and then do the calls
+sys.stdout.flush()
+launched_instances, instance_regions, launch_errors = launch.launch_shards(
+    ec2_clients,
+    launch_plan,
+    launch.launch_tags(launch_datetime),
 )
+if len(launch_errors) > 0:
+    if len(launched_instances) == 0:
+        print('ERROR')
+    else:
+        print('WARNING')
+    print('Something went wrong in the call to run the instances')
+    for (region, template), e in sorted(launch_errors.items()):
+        print('Here are the details (%s, %s): ' % (region, template), e)
+    # The workshop may have been skipped over by the validation cache, so make
+    # sure it is fully checked next time.
+    validation.forget(validation_key)
+    if len(launched_instances) == 0:
+        exit()
 
 # Make sure the count of instances matches what we requested
 if len(launched_instances) == instance_count:
     print('Done')
 else:
-    print('WARNING')
+    if len(launch_errors) == 0:
+        print('WARNING')
     print('Out of the %d instances requested, only %d were launched.' % (instance_count, len(launched_instances)))
     print('Since some instances were launched, we will continue.')
 
@@ -301,9 +262,13 @@ else:
 print('')
 print('The following instances were launched:')
 for instance_id in launched_instances:
-    print(instance_id)
+    if len(shard_regions) == 1:
+        print(instance_id)
+    else:
+        print('%s (%s)' % (instance_id, instance_regions[instance_id]))
 
 # Wait for all of the instances to transition to `running` state.
+# Each region is checked in its own thread (see the `launch` module).
 
 progress_bar = Bar(
     'Waiting for instances to "power on"…',
@@ -313,41 +278,13 @@ print('')
 progress_bar.start()
 sys.stdout.flush()
 
-# Build the list of instances not yet checked
-instances_to_check = list(launched_instances.keys())
-
-# We just kicked off the launch, so wait three seconds before checking.
-time.sleep(3)
-
-# We'll be governed by worker_timeout for giving up on updates.
-wait_starttime = time.monotonic()
-
-# Loop through calling out to AWS
-while (
-    (len(instances_to_check) > 0) and
-    (time.monotonic() - wait_starttime <= worker_timeout)
-):
-    paginator_client = ec2_client.get_paginator('describe_instances')
-    page_iterator = paginator_client.paginate(InstanceIds=instances_to_check)
-    for page in page_iterator:
-        for reservation in page['Reservations']:
-            for instance in reservation['Instances']:
-                # Here we have a dict of information about the instance.
-                # Update the launched_instances dict
-                launched_instances[instance['InstanceId']] = instance
-
-                # Is the instance state no longer 'pending'?
-                # If so, remove it from the pending list, and update the status bar
-                if instance['State']['Code'] != 0:
-                    instances_to_check.remove(instance['InstanceId'])
-                    progress_bar.next()
-            # Done with the instance
-        # Done with a reservation
-    # Done with a page
-
-    # If we have any items left to check, wait zero to 15 seconds before trying again
-    if len(instances_to_check) > 0:
-        time.sleep(random.randrange(0, 1500, 1) / 100)
+instances_to_check = launch.wait_for_running(
+    ec2_clients,
+    launched_instances,
+    instance_regions,
+    timeout=worker_timeout,
+    on_done=lambda instance_id: progress_bar.next(),
+)
 
 # We have either run out of time, or have checked everything
 progress_bar.finish()
@@ -361,9 +298,6 @@ if len(instances_to_check) > 0:
 
 # Our instances are now powered on!
 # (If any are in a non-pending non-running state, we'll catch that later.)
-del wait_starttime
-del paginator_client
-del page_iterator
 del instances_to_check
 
 # Do we have any instances left?  If not, then exit
@@ -383,55 +317,27 @@ print('(This next step will take several minutes.)')
 progress_bar.start()
 sys.stdout.flush()
 
-# Build the list of instances not yet checked
-instances_to_check = list(launched_instances.keys())
-failed_instances = list()
-
-# We'll be governed by worker_timeout for giving up on updates.
-wait_starttime = time.monotonic()
-
-# Loop through calling out to AWS
-while (
-    (len(instances_to_check) > 0) and
-    (time.monotonic() - wait_starttime <= worker_timeout)
-):
-    paginator_client = ec2_client.get_paginator('describe_instance_status')
-    page_iterator = paginator_client.paginate(
-        InstanceIds=instances_to_check,
-        IncludeAllInstances=True,
-    )
-    for page in page_iterator:
-        for instance in page['InstanceStatuses']:
-            # Is the instance state no longer running?
-            # Is the instance impaired or railed?
-            # Then we're done with it for now.
-            if (
-                (instance['InstanceState']['Name'] != 'running') or
-                (instance['InstanceStatus']['Status'] == 'impaired') or
-                (instance['SystemStatus']['Status'] == 'failed')
-            ):
-                failed_instances.append(instance['InstanceId'])
-                instances_to_check.remove(instance['InstanceId'])
-                progress_bar.next()
-
-            # If the instance and system status are good, then awesome!
-            if (
-                (instance['InstanceStatus']['Status'] == 'ok') and
-                (instance['SystemStatus']['Status'] == 'ok')
-            ):
-                instances_to_check.remove(instance['InstanceId'])
-                progress_bar.next()
-
-            # For all other statuses, we'll need to check again.
-        # Done with the instance
-    # Done with a page
-
-    # If we have any items left to check, wait zero to 5 seconds before trying again
-    if len(instances_to_check) > 0:
-        time.sleep(random.randrange(0, 500, 1) / 100)
+# Note when each instance is done, so we can remember how long the workshop's
+# instances take to be ready (see the `boottimes` module).
+ready_times = dict()
+def instance_done(instance_id):
+    ready_times[instance_id] = time.monotonic() - launch_starttime
+    progress_bar.next()
+
+failed_instances, instances_to_check = launch.wait_for_status(
+    ec2_clients,
+    list(launched_instances.keys()),
+    instance_regions,
+    timeout=worker_timeout,
+    on_done=instance_done,
+)
 
 # We have either run out of time, or have checked everything
 progress_bar.finish()
+boottimes.record(chosen_config, list(
+    ready_times[instance_id] for instance_id in launched_instances
+    if instance_id in ready_times and instance_id not in failed_instances
+))
 
 # Did any instances either fail to go OK in time, or go bad?
 for bad_instance in instances_to_check:
@@ -446,9 +352,6 @@ if (len(instances_to_check) + len(failed_instances)) > 0:
     print('Please also remember to clean up failed instances.')
 
 # Our instances are now running!
-del wait_starttime
-del paginator_client
-del page_iterator
 del failed_instances
 del instances_to_check
 
@@ -462,13 +365,20 @@ else:
 
 # Instances are now ready to use!
 
-# Print the IP addresses of the instances
+# Print the IP addresses of the instances.  If the workshop is split across
+# regions, say which region each instance is in.
 print('')
 print('Here are the IP addresses of the running instances:')
-for instance_id in launched_instances:
-    public_ip = launched_instances[instance_id]['PublicIpAddress']
+for instance_id in sorted(
+    launched_instances.keys(),
+    key=lambda instance_id: instance_regions[instance_id],
+):
+    public_ip = launched_instances[instance_id].get('PublicIpAddress')
     if public_ip is not None:
-        print(public_ip)
+        if len(shard_regions) == 1:
+            print(public_ip)
+        else:
+            print('%-15s %s' % (public_ip, instance_regions[instance_id]))
 
 # Print the instructions, and we're done!
 print('')
@@ -0,0 +1,464 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This script builds everything a workshop needs: A VPC, a public subnet (in
+# one availability zone), an internet gateway, a route table, a
+# security group, and a launch template.  The steps form a dependency graph
+# (see the `provision` module), so steps that don't depend on each other run
+# at the same time.  Everything is tagged with the workshop's name, so running
+# this again picks up where a failed run left off.  At the end, the workshop
+# (and its launch template) is added to the workshop config.
+
+# First, import modules from the standard library
+import argparse
+import ipaddress
+from os import environ
+import sys
+from sys import exit
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    import configstore
+    import provision
+    import regions
+    import validation
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Create (or finish creating) the AWS resources for a workshop.',
+)
+parser.add_argument('workshop',
+    help='The name of the workshop.',
+)
+parser.add_argument('--region',
+    default=None,
+    help='The region for the workshop.  Default: Your default region.',
+)
+parser.add_argument('--ami',
+    default=None,
+    help='The AMI to launch.  Required unless the launch template already exists.',
+)
+parser.add_argument('--instance-type',
+    default='t3.micro',
+    help='The instance type to launch.  Default: t3.micro',
+)
+parser.add_argument('--key-name',
+    default=None,
+    help='The EC2 key pair to put on each instance.  Default: None',
+)
+parser.add_argument('--cidr',
+    default='10.0.0.0/16',
+    help='The VPC\'s address block.  Default: 10.0.0.0/16',
+)
+parser.add_argument('--zone',
+    default=None,
+    help='The availability zone for the subnet.  Default: The region\'s first zone',
+)
+parser.add_argument('--port',
+    type=int,
+    action='append',
+    help='A TCP port to open to the world.  May be given more than once.  Default: 22',
+)
+parser.add_argument('--maximum',
+    type=int,
+    default=25,
+    help='The most instances `create_instances` may launch at once.  Default: 25',
+)
+parser.add_argument('--instructions',
+    default='Connect to your instance using SSH.',
+    help='Usage instructions, shown by `create_instances`.',
+)
+args = parser.parse_args()
+if args.port is None:
+    args.port = [22]
+
+print('Welcome to Workshop Creator')
+
+# Start talking to AWS in the background.
+startup.start_session()
+
+# Work out (and check) the region.
+if args.region is None:
+    args.region = startup.get_session().region_name
+if args.region is None or not regions.is_valid_region(args.region):
+    print('"%s" is not an AWS region we know about.' % (args.region,))
+    exit(1)
+if 'CREATE_INSTANCES_CONFIG' not in environ:
+    print('Environment variable CREATE_INSTANCES_CONFIG is missing.  Re-run `finish_install`.')
+    exit(1)
+
+# Check connectivity (and our permissions in the workshop's region).
+workshops.check_connectivity({args.region: ()})
+ec2_client = startup.client('ec2', region_name=args.region)
+
+# Pick our availability zone, and take the subnet from the VPC's block.
+# The launch template puts every instance in this one subnet, so there is no
+# point making subnets in other zones.
+try:
+    zones = sorted(
+        zone['ZoneName'] for zone in ec2_client.describe_availability_zones(
+            Filters=[{'Name': 'state', 'Values': ['available']}],
+        )['AvailabilityZones']
+        if zone.get('ZoneType', 'availability-zone') == 'availability-zone'
+    )
+    subnet_block = next(
+        ipaddress.ip_network(args.cidr).subnets(new_prefix=24),
+        None,
+    )
+except Exception as e:
+    print('We were unable to work out the availability zone and subnet.')
+    print('The exact error we got:', e)
+    exit(1)
+if args.zone is not None:
+    if args.zone not in zones:
+        print('The availability zone %s is not available in %s.' % (
+            args.zone,
+            args.region,
+        ))
+        exit(1)
+    subnet_zone = args.zone
+elif len(zones) > 0:
+    subnet_zone = zones[0]
+else:
+    print('There are no availability zones to make a subnet in.')
+    exit(1)
+if subnet_block is None:
+    print('The VPC\'s address block is too small to make a subnet.')
+    exit(1)
+del zones
+
+
+# Define a subroutine to find a tagged resource.
+# `describe` is a describe_* call, and `key` is the key of the list it returns.
+# Returns the first matching resource, or None.
+def find_tagged(describe, key, resource, extra_filters=()):
+    found = describe(
+        Filters=provision.resource_filters(args.workshop, resource) + list(extra_filters),
+    )[key]
+    if len(found) == 0:
+        return None
+    return found[0]
+
+
+# Each of these subroutines is a node in our graph.  Each takes the results
+# so far, and returns the ID of what it found (or made).
+
+def make_vpc(results):
+    vpc = find_tagged(ec2_client.describe_vpcs, 'Vpcs', 'vpc')
+    if vpc is not None:
+        vpc_id = vpc['VpcId']
+        print('Found VPC %s' % (vpc_id,))
+    else:
+        vpc_id = ec2_client.create_vpc(
+            CidrBlock=args.cidr,
+            TagSpecifications=provision.tag_specifications('vpc', args.workshop, 'vpc'),
+        )['Vpc']['VpcId']
+        print('Created VPC %s' % (vpc_id,))
+        ec2_client.get_waiter('vpc_available').wait(VpcIds=[vpc_id])
+    # Instances get public DNS names (this is safe to repeat).
+    ec2_client.modify_vpc_attribute(
+        VpcId=vpc_id,
+        EnableDnsHostnames={'Value': True},
+    )
+    return vpc_id
+
+
+def make_internet_gateway(results):
+    gateway = find_tagged(
+        ec2_client.describe_internet_gateways,
+        'InternetGateways',
+        'internet-gateway',
+    )
+    if gateway is not None:
+        print('Found internet gateway %s' % (gateway['InternetGatewayId'],))
+        return gateway['InternetGatewayId']
+    gateway_id = ec2_client.create_internet_gateway(
+        TagSpecifications=provision.tag_specifications(
+            'internet-gateway',
+            args.workshop,
+            'internet-gateway',
+        ),
+    )['InternetGateway']['InternetGatewayId']
+    print('Created internet gateway %s' % (gateway_id,))
+    return gateway_id
+
+
+def attach_internet_gateway(results):
+    gateway = ec2_client.describe_internet_gateways(
+        InternetGatewayIds=[results['internet-gateway']],
+    )['InternetGateways'][0]
+    if any(
+        attachment['VpcId'] == results['vpc']
+        for attachment in gateway.get('Attachments', ())
+    ):
+        return results['internet-gateway']
+    ec2_client.attach_internet_gateway(
+        InternetGatewayId=results['internet-gateway'],
+        VpcId=results['vpc'],
+    )
+    print('Attached internet gateway %s to VPC %s' % (
+        results['internet-gateway'],
+        results['vpc'],
+    ))
+    return results['internet-gateway']
+
+
+def make_subnet_function(zone, block):
+    resource = 'subnet-%s' % (zone,)
+    def make_subnet(results):
+        subnet = find_tagged(
+            ec2_client.describe_subnets,
+            'Subnets',
+            resource,
+            [{'Name': 'vpc-id', 'Values': [results['vpc']]}],
+        )
+        if subnet is not None:
+            subnet_id = subnet['SubnetId']
+            print('Found subnet %s in %s' % (subnet_id, zone))
+        else:
+            subnet_id = ec2_client.create_subnet(
+                VpcId=results['vpc'],
+                CidrBlock=str(block),
+                AvailabilityZone=zone,
+                TagSpecifications=provision.tag_specifications('subnet', args.workshop, resource),
+            )['Subnet']['SubnetId']
+            print('Created subnet %s in %s' % (subnet_id, zone))
+        ec2_client.modify_subnet_attribute(
+            SubnetId=subnet_id,
+            MapPublicIpOnLaunch={'Value': True},
+        )
+        return subnet_id
+    return make_subnet
+
+
+def make_route_table(results):
+    route_table = find_tagged(
+        ec2_client.describe_route_tables,
+        'RouteTables',
+        'route-table',
+        [{'Name': 'vpc-id', 'Values': [results['vpc']]}],
+    )
+    if route_table is not None:
+        print('Found route table %s' % (route_table['RouteTableId'],))
+        return route_table['RouteTableId']
+    route_table_id = ec2_client.create_route_table(
+        VpcId=results['vpc'],
+        TagSpecifications=provision.tag_specifications(
+            'route-table',
+            args.workshop,
+            'route-table',
+        ),
+    )['RouteTable']['RouteTableId']
+    print('Created route table %s' % (route_table_id,))
+    return route_table_id
+
+
+def make_default_route(results):
+    route_table = ec2_client.describe_route_tables(
+        RouteTableIds=[results['route-table']],
+    )['RouteTables'][0]
+    if any(
+        route.get('DestinationCidrBlock') == '0.0.0.0/0'
+        for route in route_table.get('Routes', ())
+    ):
+        return results['route-table']
+    ec2_client.create_route(
+        RouteTableId=results['route-table'],
+        DestinationCidrBlock='0.0.0.0/0',
+        GatewayId=results['internet-gateway'],
+    )
+    print('Added a default route to %s' % (results['route-table'],))
+    return results['route-table']
+
+
+def associate_route_table_function(zone):
+    subnet_node = 'subnet-%s' % (zone,)
+    def associate_route_table(results):
+        route_table = ec2_client.describe_route_tables(
+            RouteTableIds=[results['route-table']],
+        )['RouteTables'][0]
+        for association in route_table.get('Associations', ()):
+            if association.get('SubnetId') == results[subnet_node]:
+                return association['RouteTableAssociationId']
+        association_id = ec2_client.associate_route_table(
+            RouteTableId=results['route-table'],
+            SubnetId=results[subnet_node],
+        )['AssociationId']
+        print('Associated subnet %s with route table %s' % (
+            results[subnet_node],
+            results['route-table'],
+        ))
+        return association_id
+    return associate_route_table
+
+
+def make_security_group(results):
+    group = find_tagged(
+        ec2_client.describe_security_groups,
+        'SecurityGroups',
+        'security-group',
+        [{'Name': 'vpc-id', 'Values': [results['vpc']]}],
+    )
+    if group is not None:
+        print('Found security group %s' % (group['GroupId'],))
+        return group['GroupId']
+    group_id = ec2_client.create_security_group(
+        GroupName=provision.launch_template_name(args.workshop),
+        Description='Workshop %s' % (args.workshop,),
+        VpcId=results['vpc'],
+        TagSpecifications=provision.tag_specifications(
+            'security-group',
+            args.workshop,
+            'security-group',
+        ),
+    )['GroupId']
+    print('Created security group %s' % (group_id,))
+    return group_id
+
+
+def open_ports(results):
+    for port in args.port:
+        try:
+            ec2_client.authorize_security_group_ingress(
+                GroupId=results['security-group'],
+                IpPermissions=[{
+                    'IpProtocol': 'tcp',
+                    'FromPort': port,
+                    'ToPort': port,
+                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                }],
+            )
+            print('Opened port %d in %s' % (port, results['security-group']))
+        except Exception as e:
+            if not provision.is_error(e, 'InvalidPermission.Duplicate'):
+                raise
+    return results['security-group']
+
+
+def make_launch_template(results):
+    template = find_tagged(
+        ec2_client.describe_launch_templates,
+        'LaunchTemplates',
+        'launch-template',
+    )
+    if template is not None:
+        print('Found launch template %s' % (template['LaunchTemplateId'],))
+        return template['LaunchTemplateId']
+    if args.ami is None:
+        raise ValueError('The launch template needs an AMI; use --ami')
+
+    template_data = {
+        'ImageId': args.ami,
+        'InstanceType': args.instance_type,
+        'NetworkInterfaces': [{
+            'DeviceIndex': 0,
+            'SubnetId': results['subnet-%s' % (subnet_zone,)],
+            'Groups': [results['security-group']],
+            'AssociatePublicIpAddress': True,
+            'DeleteOnTermination': True,
+        }],
+        # The instance scripts find a workshop's instances by this tag.
+        'TagSpecifications': [{
+            'ResourceType': 'instance',
+            'Tags': [{'Key': provision.WORKSHOP_TAG, 'Value': args.workshop}],
+        }],
+    }
+    if args.key_name is not None:
+        template_data['KeyName'] = args.key_name
+    template_id = ec2_client.create_launch_template(
+        LaunchTemplateName=provision.launch_template_name(args.workshop),
+        LaunchTemplateData=template_data,
+        TagSpecifications=provision.tag_specifications(
+            'launch-template',
+            args.workshop,
+            'launch-template',
+        ),
+    )['LaunchTemplate']['LaunchTemplateId']
+    print('Created launch template %s' % (template_id,))
+    return template_id
+
+
+# Build our graph.  Each entry is (dependencies, function).
+# The launch template waits for the routes and ports, so that a workshop is
+# only written to the config once its network works.
+graph = {
+    'vpc': ((), make_vpc),
+    'internet-gateway': ((), make_internet_gateway),
+    'gateway-attachment': (('vpc', 'internet-gateway'), attach_internet_gateway),
+    'route-table': (('vpc',), make_route_table),
+    'default-route': (('route-table', 'gateway-attachment'), make_default_route),
+    'security-group': (('vpc',), make_security_group),
+    'open-ports': (('security-group',), open_ports),
+}
+graph['subnet-%s' % (subnet_zone,)] = (
+    ('vpc',),
+    make_subnet_function(subnet_zone, subnet_block),
+)
+graph['route-%s' % (subnet_zone,)] = (
+    ('route-table', 'subnet-%s' % (subnet_zone,)),
+    associate_route_table_function(subnet_zone),
+)
+graph['launch-template'] = (
+    ('default-route', 'open-ports', 'route-%s' % (subnet_zone,)),
+    make_launch_template,
+)
+
+# Run it!
+print('Building workshop %s in %s…' % (args.workshop, args.region))
+sys.stdout.flush()
+results, failures = provision.run_graph(graph)
+
+if len(failures) > 0:
+    print('')
+    print('Some steps did not finish:')
+    for name in sorted(failures.keys()):
+        print('  %s: %s' % (name, failures[name]))
+    print('Fix the problem, and run `create_workshop` again to pick up where we left off.')
+    exit(1)
+
+# Add (or update) the workshop in the config.  If someone else changes the
+# config at the same time, re-read it and try again.
+print('Updating the workshop configuration…')
+while True:
+    config, config_snapshot = configstore.read_config(environ['CREATE_INSTANCES_CONFIG'])
+    if args.workshop not in config:
+        config[args.workshop] = dict()
+    config[args.workshop]['region'] = args.region
+    config[args.workshop]['template'] = results['launch-template']
+    if 'instructions' not in config[args.workshop]:
+        config[args.workshop]['instructions'] = args.instructions
+    if 'maximum' not in config[args.workshop]:
+        config[args.workshop]['maximum'] = str(args.maximum)
+    try:
+        configstore.write_config(environ['CREATE_INSTANCES_CONFIG'], config, config_snapshot)
+        break
+    except configstore.StaleConfigError:
+        continue
+
+# We just made (or found) the launch template, so there's no need to check it
+# again right away.
+validation.record(config, [args.workshop], validation.credential_identity())
+
+print('')
+print('Workshop %s is ready!' % (args.workshop,))
+print('Launch template: %s' % (results['launch-template'],))
+print('You can now run `create_instances`')
@@ -11,23 +11,29 @@
 # See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
 
 # First, import modules from the standard library
-import configparser
 import datetime
-import dateutil.tz
-import fcntl
-import ipaddress
-import os
-from os import environ
+import shutil
 import sys
 from sys import exit
 import time
 
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
 # Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
 try:
-    import boto3
+    startup.require('boto3', 'dateutil')
     from progress.bar import Bar
-    from progress.spinner import Spinner
-    from termcolor import colored
+    from progress.counter import Counter
+    import accounts
+    import configstore
+    import workshops
+    termcolor = startup.lazy_import('termcolor')
+    import filters
+    import inventory
+    import terminate
+    import watch
 except ModuleNotFoundError as e:
     print('Failed to import module %s' % (e.name,))
     print('Run `finish_install`')
@@ -35,176 +41,98 @@ except ModuleNotFoundError as e:
 
 print('Welcome to Instance L̶a̶u̶n̶c̶h̶e̶r̶ Destroyer')
 
+# Start talking to AWS in the background, while we read the config and the
+# user reads the menu.
+startup.start_session()
+
 # Worker timeout is in seconds
 worker_timeout = 600
 
-# Look for and lock our config files
-spinner = Spinner('Checking Configuration ')
-handles = dict()
-for var in (
-    'AWS_CONFIG_FILE',
-    'AWS_SHARED_CREDENTIALS_FILE',
-    'CREATE_INSTANCES_CONFIG',
-):
-    spinner.next()
-    if var not in environ:
-        print('Environment variable %s is missing.  Re-run `finish_install`.' % (
-            var,
-        ))
-        exit()
-    if not os.path.isfile(environ[var]):
-        print('The %s file appears to be missing.  Re-run `finish_install`.' % (
-            var,
-        ))
-        exit()
-    try:
-        handles[var] = open(environ[var], 'r')
-        fcntl.flock(handles[var].fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
-    except Exception as e:
-        print('There was a problem opening and locking the file at %s: %s' % (
-            environ[var],
-            e,
-        ))
-        print('There may be a permission problem.')
-        print('Or, someone else may be running `finish_install`.')
-        exit()
+# Load our config files
+with startup.phase('Reading configuration'):
+    config, config_snapshot = workshops.load_config()
 
-# Try loading our config
-spinner.next()
-config = configparser.ConfigParser()
-try:
-    config.read(environ['CREATE_INSTANCES_CONFIG'])
-    spinner.next()
-except Exception as e:
-    print('ERROR')
-    print('The instance configuration file could not be read.')
-    print('Here is the error: ', e)
-    print('Re-run `finish_install`')
-    exit()
-print(' Complete')
+# Build our list of usable workshops
+with startup.phase('Checking workshops'):
+    usable_workshops = workshops.check_workshops(config)
 
-# Check for connectivity and permissions
-spinner = Spinner('Talking to AWS ')
+# EC2 clients, by region.  Clients are created as regions are needed, and kept
+# for the rest of the session, so switching workshops doesn't mean starting over.
+ec2_clients = dict()
 
-# Our EC2 client uses the default region for this check.
-try:
-    ec2_client = boto3.client('ec2')
-    ec2_client.describe_instances(MaxResults=5)
-    spinner.next()
-except Exception as e:
-    print('ERROR!')
-    print('We were unable to get a list of running EC2 instances.')
-    print('The exact error we got:', e)
-    print('Re-run `finish_install`')
-    exit()
-print(' Complete')
+# The workshops whose launch templates have been checked.  Templates are
+# checked when a workshop is first chosen, not before the menu is shown.
+checked_workshops = set()
 
-# Prepare to build an indexed list of configs
-config_names_as_list = list()
-config_names_as_list.append('(Quit)')
-spinner = Spinner('Checking %s workshop(s) ' % (
-    len(config.sections()),
-))
 
-# Build our list of usable workshops
-for workshop in config.sections():
-    # Make sure the required keys are in each workshop.
-    for var in (
-        'template',
-        'region',
-        'instructions',
-        'maximum',
-    ):
-        # Skip if we're missing a var
-        if var not in config[workshop]:
-            print(' WARNING')
-            print('Workshop "%s" missing config item \'%s\'.' % (
-                workshop,
-                var
-            ))
-            print('Skipping this entry for now.  Re-run `finish_install` to fix.')
-            next
+# Define a subroutine that asks which workshop(s) the user wants to access.
+# Returns a tuple of the choice (a workshop name, or ALL_WORKSHOPS) and a dict
+# mapping each region to a list of the chosen workshops in it, or None if the
+# user chose to quit.
+def choose_workshops():
+    while True:
+        # We now have a list of workshops.
+        # Which workshop does the user wish to access?
+        with startup.phase('Waiting for a choice'):
+            choice = workshops.choose_workshop(
+                usable_workshops,
+                'The following workshops are available:',
+                allow_all=True,
+            )
 
-        # For maximum, do number tests
-        if var == 'maximum':
-            try:
-                config[workshop].getint('maximum')
-            except ValueError:
-                config[workshop]['maximum'] = -1
-            if config[workshop].getint('maximum') <= 0:
-                print(' WARNING')
-                print('Workworkshop "%s" has invalid item \'maximum\'.' % (
-                    workshop,
-                ))
-                print('Skipping this entry for now.  Re-run `finish_install` to fix.')
-                next
+        # Report the selection, or exit
+        if choice is None:
+            return None
+        print('')
+        print('Selected workshop %s' % (choice))
 
-    # Done checking over individual vars.
+        if choice == workshops.ALL_WORKSHOPS:
+            chosen_workshops = list(usable_workshops)
+        else:
+            chosen_workshops = [choice]
+
+        # Check connectivity, and our permissions in each chosen region
+        # (regions checked before are not checked again).  Then, check any
+        # launch templates we haven't checked yet.  Workshops that fail are
+        # dropped from the menu.
+        with startup.phase('Talking to AWS'):
+            ec2_client = workshops.check_connectivity(dict(
+                (region, ())
+                for region in workshops.workshops_by_region(config, chosen_workshops)
+            ))
+            ec2_clients[ec2_client.meta.region_name] = ec2_client
+            unchecked_workshops = list(
+                workshop for workshop in chosen_workshops
+                if workshop not in checked_workshops
+            )
+            if len(unchecked_workshops) > 0:
+                checked_workshops.update(
+                    workshops.check_templates(config, unchecked_workshops)
+                )
+        for workshop in unchecked_workshops:
+            if workshop not in checked_workshops:
+                usable_workshops.remove(workshop)
+        chosen_workshops = list(
+            workshop for workshop in chosen_workshops
+            if workshop in checked_workshops
+        )
+        if len(chosen_workshops) > 0:
+            break
 
-    # Change ec2_client to this workshop's region
-    ec2_client = boto3.client('ec2',
-        region_name=config[workshop]['region'],
-    )
+    # Group the chosen workshop(s) by region, and make sure we have clients.
+    # (A workshop with shards in several regions is in each of them.)
+    workshops_by_region = workshops.workshops_by_region(config, chosen_workshops)
+    for region in workshops_by_region:
+        if region not in ec2_clients:
+            ec2_clients[region] = accounts.client(region)
+    return (choice, workshops_by_region)
 
-    # Make sure we can access the launch template
-    try:
-        ec2_client.describe_launch_templates(LaunchTemplateIds=[config[workshop]['template']])
-    except Exception as e:
-        print(' WARNING')
-        print('Unable to pull up the launch template for workworkshop "%s"' % (
-            workshop,
-        ))
-        print('Skipping this entry for now.  Re-run `finish_install` to fix.')
-        next
-
-    # We have a good workshop!
-    config_names_as_list.append(workshop)
-    spinner.next()
-
-# Done checking configuration
-print(' Complete')
-
-# We now have a list of workshops, and a working Boto3 client.
-# Which workshop does the user wish to access?
-
-print('')
-print('The following workshops are available:')
-for i in range(0, len(config_names_as_list)):
-    print('%3d: %s' % (i, config_names_as_list[i]))
-choice_index = -1
-while choice_index == -1:
-    try:
-        choice_index = input('Please choose a number from 0 to %d: ' % (len(config_names_as_list)-1,))
-    except (EOFError, KeyboardInterrupt):
-        choice_index = 0
-    try:
-        choice_index = int(choice_index)
-    # Make sure we have an integer in the range [0, len(config_names_as_list))
-    except ValueError:
-        print('Please enter a valid base 10 integer')
-        choice_index = -1
-        continue
-    if choice_index < 0:
-        print('Please enter a non-negative integer')
-        choice_index = -1
-    if choice_index >= len(config_names_as_list):
-        print('Please enter an integer less than %d' % (len(config_names_as_list),))
-        choice_index = -1
-
-# Report the selection, or exit
-if choice_index == 0:
+
+chosen = choose_workshops()
+if chosen is None:
     print('Goodbye')
     exit()
-chosen_config = config_names_as_list[choice_index]
-print('')
-print('Selected workshop %s' % (chosen_config))
-del choice_index
-del config_names_as_list
-
-# Do our final ec2_client re-creation
-ec2_client = boto3.client('ec2',
-    region_name = config[chosen_config]['region'],
-)
+chosen_config, workshops_by_region = chosen
 
 # Before we get instance info, we need to set up the place to store the info.
 
@@ -215,10 +143,29 @@ instances_by_state = list()
 instances_by_creation = list()
 instances_by_id = list()
 instances_by_ip = list()
+instances_by_workshop = list()
 
 # Our default display is the "by-id" list.
 display_list = instances_by_id
 
+# Formatting a row is the slowest part of drawing the table, so each row's
+# text is cached by instance ID.  The cache is emptied whenever the instance
+# info is reloaded, so each row is formatted once per load, not once per draw.
+row_cache = dict()
+
+# The list is shown one page at a time.  Row numbers are global (they do not
+# restart on each page), so ranges like `1-500` work no matter the page.
+# A page size of zero means "fit the page to the terminal".
+page_size_setting = 0
+current_page = 1
+
+# The list can be narrowed with a filter expression (see the `filters` module),
+# which is evaluated locally, without asking EC2 again.  The filter's indexes
+# are built the first time a filter is used after each load.
+filter_text = None
+filter_terms = None
+filter_index = dict()
+
 
 # Define a subroutine that fetches our instances
 def load_instances(
@@ -227,84 +174,78 @@ def load_instances(
     instances_by_id_list,
     instances_by_creation_list,
     instances_by_ip_list,
+    instances_by_workshop_list,
     instance_filter,
 ):
     # First, clear everything
     instances_dict.clear()
+    row_cache.clear()
+    filter_index.clear()
     instances_by_state_list.clear()
     instances_by_id_list.clear()
     instances_by_creation_list.clear()
     instances_by_ip_list.clear()
+    instances_by_workshop_list.clear()
 
     # Make a dict of instance states, to help in building the list later
     instances_by_state_dict = dict()
 
-    # Let's grab a list of instances.
-    print('Loading instance information…')
-    instance_iterator = ec2_client.get_paginator('describe_instances').paginate(Filters=[
-        {
-            'Name': 'tag:Workshop',
-            'Values': (chosen_config,),
-        },
-        {
-            'Name': 'instance-state-name',
-            'Values': instance_filter,
-        },
-    ])
-
-    # Go through each page of results
-    for page in instance_iterator:
-        for reservation in page['Reservations']:
-            for instance in reservation['Instances']:
-                # First, add the instance to the main list
-                instance_id = instance['InstanceId']
-                instances_dict[instance_id] = instance
-
-                # Next, add to the appropriate by-status entry
-                instance_state = instance['State']['Name']
-                if instance_state not in instances_by_state_dict:
-                    instances_by_state_dict[instance_state] = list()
-                instances_by_state_dict[instance_state].append(instance_id)
-
-                # Store the ipaddress object in the instance
-                instance_ip = None
-                if 'PublicIpAddress' in instance:
-                    instance_ip = ipaddress.IPv4Address(instance['PublicIpAddress'])
-                instance['PublicIpAddress'] = instance_ip
-
-                # Convert the time to the local time zone
-                instance['LaunchTime'] = instance['LaunchTime'].astimezone(
-                    dateutil.tz.gettz()
-                )
-                instance_creation = instance['LaunchTime']
-
-                # Next, add to the by-creation, by_id, and by_ip lists
-                instances_by_creation_list.append((
-                    instance_creation,
-                    instance_id
-                ))
-                instances_by_id_list.append((
-                    instance_id,
-                    instance_id,
-                ))
-                instances_by_ip_list.append((
-                    0 if instance_ip is None else int(instance_ip),
-                    instance_id
-                ))
-    # We have finished processing our `describe_instances` call!
+    # Let's grab a stream of instances.
+    # Records arrive one page at a time, already normalized (the public IP is
+    # an ipaddress object, and the launch time is in the local time zone).
+    # When we have several regions, they are all queried at the same time.
+    counter = Counter('Loading instance information… ')
+    for instance in inventory.iter_regions_instances(
+        ec2_clients,
+        workshops_by_region,
+        states=instance_filter,
+    ):
+        counter.next()
+
+        # First, add the instance to the main list
+        instance_id = instance['InstanceId']
+        instances_dict[instance_id] = instance
+
+        # Next, add to the appropriate by-status entry
+        instance_state = instance['State']
+        if instance_state not in instances_by_state_dict:
+            instances_by_state_dict[instance_state] = list()
+        instances_by_state_dict[instance_state].append(instance_id)
+
+        # Next, add to the by-creation, by_id, and by_ip lists
+        instance_ip = instance['PublicIpAddress']
+        instances_by_creation_list.append((
+            instance['LaunchTime'],
+            instance_id
+        ))
+        instances_by_id_list.append((
+            instance_id,
+            instance_id,
+        ))
+        instances_by_ip_list.append((
+            0 if instance_ip is None else int(instance_ip),
+            instance_id
+        ))
+        instances_by_workshop_list.append((
+            (instance['Workshop'] or '', accounts.instance_location(instance), instance_id),
+            instance_id
+        ))
+    counter.finish()
+    # We have finished processing our `describe_instances` stream!
 
     # Now, sort our lists
     for l in (
         instances_by_creation_list,
         instances_by_id_list,
         instances_by_ip_list,
+        instances_by_workshop_list,
     ):
         l.sort(
             key=lambda val: val[0]
         )
 
     # Merge the state dict entries into the state list, in our specific order.
-    for state in ('pending', 'running', 'stopping', 'stopped', 'shutting-down', 'terminated'):
+    for state in inventory.INSTANCE_STATES:
         if state in instances_by_state_dict:
             instances_by_state_list.extend(
                 (state, instance_id) for instance_id in instances_by_state_dict[state]
@@ -313,14 +254,65 @@ def load_instances(
 # Done with the instance-population sub! 
 
 
+# Define a subroutine that works out how many rows fit on a page
+def get_page_size():
+    if page_size_setting > 0:
+        return page_size_setting
+
+    # Leave room for the header, footer, status lines, and prompt.
+    return max(5, shutil.get_terminal_size().lines - 10)
+
+
+# Define a subroutine that returns the number of pages in a list
+def get_page_count(display_list):
+    page_size = get_page_size()
+    return max(1, (len(display_list) + page_size - 1) // page_size)
+
+
+# Define a subroutine that says if we are showing more than one workshop
+def showing_workshops():
+    return chosen_config == workshops.ALL_WORKSHOPS
+
+
+# Define a subroutine that formats (and caches) the body of a row
+def format_row(instance_id):
+    if instance_id not in row_cache:
+        instance = instances[instance_id]
+        row_cache[instance_id] = ' %19s | %15s | %17s | %13s |' % (
+            instance_id,
+            instance['PublicIpAddress'],
+            instance['LaunchTime'].strftime('%a, %b %d %H:%M'),
+            instance['State']
+        )
+        if showing_workshops():
+            row_cache[instance_id] += ' %-24s |' % ((
+                '%s (%s)' % (instance['Workshop'], accounts.instance_location(instance))
+            )[:24],)
+    return row_cache[instance_id]
+    #nnn| i-01137d37bc2f6c2ea | 123.456.789.012 | Mon, Jan 11 XX:XX | shutting-down |
+
+
 # Define a subroutine that prints our instance list
+# Only rows `first_row` through `last_row` (inclusive, 1-indexed) are printed.
 def print_list(
     display_list,
     instances_by_id_list,
     instances_by_creation_list,
     instances_by_ip_list,
     instances_by_state_list,
+    instances_by_workshop_list=None,
+    first_row=1,
+    last_row=None,
+    sort_list=None,
 ):
+    if last_row is None or last_row > len(display_list):
+        last_row = len(display_list)
+
+    # `sort_list` is the sorted list that `display_list` was filtered from.
+    # It tells us which column to highlight.
+    if sort_list is None:
+        sort_list = display_list
+
     # Output some stats
     print('')
 #    print('%3d instances found!\n    %3d running\n    %3d stopped (or shutting down)\n    %3d terminated (or terminating)' % (
@@ -333,36 +325,102 @@ def print_list(
     # First, the header
     print('================================================================================')
 
+    # Row numbers are global, so the number column grows with the list.
+    number_width = max(3, len(str(len(display_list))))
+
     # How we list a column depends on if we're sorting by it
     header_id = '     Instance ID     '
     header_ip = '    Public IP    '
     header_creation = '      Created      '
     header_state = '     State     '
-    print('   |%s|%s|%s|%s|' % (
-        colored(header_id, attrs=['bold']) if display_list is instances_by_id_list else header_id,
-        colored(header_ip, attrs=['bold']) if display_list is instances_by_ip_list else header_ip,
-        colored(header_creation, attrs=['bold']) if display_list is instances_by_creation_list else header_creation,
-        colored(header_state, attrs=['bold']) if display_list is instances_by_state_list else header_state,
+    header_workshop = '    Workshop (Region)     '
+    print('%s|%s|%s|%s|%s|%s' % (
+        ' ' * number_width,
+        termcolor.colored(header_id, attrs=['bold']) if sort_list is instances_by_id_list else header_id,
+        termcolor.colored(header_ip, attrs=['bold']) if sort_list is instances_by_ip_list else header_ip,
+        termcolor.colored(header_creation, attrs=['bold']) if sort_list is instances_by_creation_list else header_creation,
+        termcolor.colored(header_state, attrs=['bold']) if sort_list is instances_by_state_list else header_state,
+        '' if not showing_workshops() else '%s|' % (
+            termcolor.colored(header_workshop, attrs=['bold']) if sort_list is instances_by_workshop_list else header_workshop,
+        ),
     ))
 
     # Next, print the instances using whichever sorting method was selected
-    for i in range(1, len(display_list)+1):
+    for i in range(first_row, last_row+1):
         # Each list contains tuples; the second item in the tuple is the instance ID.
         instance_id = display_list[i-1][1]
-        instance = instances[instance_id]
-        print('%3d| %19s | %15s | %17s | %13s |' % (
-            i,
-            instance_id,
-            instance['PublicIpAddress'],
-            instance['LaunchTime'].strftime('%a, %b %d %H:%M'),
-            instance['State']['Name']
-        ))
-    #nnn: i-01137d37bc2f6c2ea | 123.456.789.012 | Mon, Jan 11 XX:XX | shutting-down |
+        print('%*d|%s' % (number_width, i, format_row(instance_id)))
 
     # Finally, print the footer
     print('================================================================================')
 
 
+# Define a subroutine that prints one page of our instance list
+def print_page(
+    display_list,
+    page,
+    instances_by_id_list,
+    instances_by_creation_list,
+    instances_by_ip_list,
+    instances_by_state_list,
+    instances_by_workshop_list,
+    sort_list=None,
+):
+    page_size = get_page_size()
+    first_row = (page - 1) * page_size + 1
+    print_list(
+        display_list,
+        instances_by_id_list=instances_by_id_list,
+        instances_by_creation_list=instances_by_creation_list,
+        instances_by_ip_list=instances_by_ip_list,
+        instances_by_state_list=instances_by_state_list,
+        instances_by_workshop_list=instances_by_workshop_list,
+        first_row=first_row,
+        last_row=first_row + page_size - 1,
+        sort_list=sort_list,
+    )
+    print('Page %d of %d (rows %d-%d of %d)' % (
+        page,
+        get_page_count(display_list),
+        min(first_row, len(display_list)),
+        min(first_row + page_size - 1, len(display_list)),
+        len(display_list),
+    ))
+
+
+# Define a subroutine that prints our menu
+def print_menu():
+    print('To destroy instances, enter a range of row numbers (use hyphens and commas)')
+    print('Or enter one of the following commands:')
+    print('  q  to quit')
+    print('  r  to reload the list and reset the sort/filter')
+    print('  ?  to show this menu again')
+    print('  w  to watch the instances live (auto-refreshing)')
+    print('  cw to change workshops (without reloading everything)')
+    print('  To move between pages:')
+    print('     n  to show the next page')
+    print('     p  .......... previous page')
+    print('     jN to jump to page N')
+    print('     lN to show N lines per page (l0 fits the page to your terminal)')
+    print('  To only show certain instances:')
+    print('     fr to only show running instances')
+    print('     fs ............ stopped instances')
+    print('     ft ............ terminated instances')
+    print('     f EXPRESSION to only show instances matching EXPRESSION, made of')
+    print('        terms joined with "and" (any term may start with "not"):')
+    print('          state running,stopped   older-than 3h   newer-than 30m')
+    print('          ip 10.0.0.0/8   ip none   tag KEY=VALUE   tag KEY')
+    print('          id i-0abc   workshop NAME   region NAME   account PROFILE')
+    print('     fc to clear the filter')
+    print('     ta to destroy all instances matching the filter')
+    print('  To sort the results:')
+    print('     si to sort by instance ID')
+    print('     sp .......... public IP')
+    print('     sc .......... creation date')
+    print('     ss .......... status')
+    print('     sw .......... workshop and region')
+
+
 # Define a subroutine to work our what the user wants to do
 def get_selection():
     # Get a selection from the user
@@ -373,9 +431,30 @@ def get_selection():
             response = 'q'
 
         # Immediately return on the clear responses
-        if response in ('q', 'r', 'fr', 'fs', 'ft', 'si', 'sp', 'sc', 'ss'):
+        if response in (
+            'q', 'r', '?', 'n', 'p', 'w',
+            'fr', 'fs', 'ft', 'fc', 'ta',
+            'cw',
+            'si', 'sp', 'sc', 'ss', 'sw',
+        ):
             return response
 
+        # Filter expressions come back as a ('f', terms, text) tuple
+        if response[:2] == 'f ':
+            try:
+                return ('f', filters.parse(response[2:]), response[2:].strip())
+            except ValueError as e:
+                print('Could not use that filter: %s' % (e,))
+                continue
+
+        # Page jumps and page sizes come back as a (command, number) tuple
+        if response[:1] in ('j', 'l') and len(response) > 1:
+            try:
+                return (response[:1], int(response[1:].strip()))
+            except ValueError:
+                print('Could not parse "%s"' % (response,))
+                continue
+
         # At this point, we have a range to parse out
         # (Using a set does de-duplication for us automatically!)
         response_list = set()
@@ -432,11 +511,21 @@ def destroy_instances(instance_list):
     # Print the warning, and give the user a change to abort.
     print('')
     print(
-        colored('WARNING!!!', attrs=['bold']),
+        termcolor.colored('WARNING!!!', attrs=['bold']),
         '  You have decided to destroy the following instances:',
         sep=''
     )
-    print_list(instance_list, list(), list(), list(), list())
+    # Show (at most) one page of the instances, so a big selection doesn't
+    # scroll the prompt away.
+    print_list(
+        instance_list, list(), list(), list(), list(),
+        last_row=get_page_size(),
+    )
+    if len(instance_list) > get_page_size():
+        print('…and %d more instance(s), for a total of %d.' % (
+            len(instance_list) - get_page_size(),
+            len(instance_list),
+        ))
     response = None
     while response is None:
         try:
@@ -456,27 +545,136 @@ def destroy_instances(instance_list):
     if len(instance_list) <= 0:
         print('No instances were actually specified!  Nothing to kill.')
     else:
-        print('Requesting instance termination… ', end='')
+        # The list we got is a list of tuples of (sort key, instance ID).
+        # We need to extract the instance ID.
+        instance_ids = list(x[1] for x in instance_list)
+
+        # Send the termination requests, in chunks.
+        progress_bar = Bar(
+            'Requesting instance termination…',
+            max=len(instance_ids),
+        )
+        progress_bar.start()
         sys.stdout.flush()
-        ec2_client.terminate_instances(InstanceIds=list(
-            # The list we got is a list of tuples of (sort key, instance ID).
-            # We need to extract the instance ID.
-            x[1] for x in instance_list
-        ))
-        print('Complete')
+        states, failures = terminate.terminate_instances_by_region(
+            ec2_clients,
+            group_by_region(instance_ids),
+            on_chunk_done=progress_bar.next,
+        )
+        progress_bar.finish()
+
+        # Report anything that could not be terminated
+        for instance_id in sorted(failures.keys()):
+            print('WARNING: Instance %s could not be terminated: %s' % (
+                instance_id,
+                failures[instance_id],
+            ))
+        if len(states) == 0:
+            print('No instances were terminated.')
+            return
+
+        # Follow the instances until they are actually terminated.
+        progress_bar = Bar(
+            'Waiting for instances to terminate…',
+            max=len(states),
+        )
+        print('(Press <Control-C> to stop waiting; termination will continue.)')
+        progress_bar.start()
+        sys.stdout.flush()
+        wait_error = None
+        try:
+            remaining = terminate.wait_for_termination_by_region(
+                ec2_clients,
+                group_by_region(states.keys()),
+                timeout=worker_timeout,
+                on_terminated=lambda instance_id: progress_bar.next(),
+            )
+        except KeyboardInterrupt:
+            remaining = None
+        except Exception as e:
+            # The terminations were already requested, so a problem here only
+            # means we can't follow them.
+            wait_error = e
+            remaining = None
+        progress_bar.finish()
+
+        # Report what didn't finish
+        if wait_error is not None:
+            print('WARNING: We were unable to check on the terminations.')
+            print('The exact error we got:', wait_error)
+        if remaining is None:
+            print('Stopped waiting.  Use `r` to check on your instances.')
+        elif len(remaining) > 0:
+            for instance_id in sorted(remaining.keys()):
+                print('WARNING: Instance %s has not terminated yet (last state: %s)' % (
+                    instance_id,
+                    remaining[instance_id],
+                ))
+        else:
+            print('All %d instance(s) terminated.' % (len(states),))
     
 # Done with the instance-destroying code!
 
 
+# Define a subroutine that groups instance IDs by the region (and account)
+# they live in.  Each region's instances have to go to that region's client.
+# `records` is the dict to look the instances up in (default: `instances`).
+def group_by_region(instance_ids, records=None):
+    if records is None:
+        records = instances
+    instance_ids_by_region = dict()
+    for instance_id in instance_ids:
+        region = accounts.instance_location(records[instance_id])
+        if region not in instance_ids_by_region:
+            instance_ids_by_region[region] = list()
+        instance_ids_by_region[region].append(instance_id)
+    return instance_ids_by_region
+
+
+# Define a subroutine that actually terminates a list of instance IDs.
+# (This is used by the watch view, which does its own confirmation.  The view
+# passes its own records, since instances may have appeared while it was open.)
+# Returns a dict of instance IDs (which could not be terminated) to errors.
+def terminate_instance_ids(instance_ids, records):
+    states, failures = terminate.terminate_instances_by_region(
+        ec2_clients,
+        group_by_region(instance_ids, records),
+    )
+    return failures
+
+
+# Define a subroutine that applies the current filter to a sorted list
+def apply_filter(sort_list):
+    if filter_terms is None:
+        return sort_list
+
+    # Build the indexes (once per load), and evaluate the filter against them.
+    if len(filter_index) == 0:
+        filter_index.update(filters.build_index(instances))
+    matches = filters.evaluate(filter_terms, filter_index)
+    return list(x for x in sort_list if x[1] in matches)
+
+
+# Define a subroutine that fetches instances in some states, for the watch view
+def fetch_instances(states):
+    return inventory.iter_regions_instances(
+        ec2_clients,
+        workshops_by_region,
+        states=states,
+    )
+
+
 # Now we have our "event loop"!
 
-# First, make a note of what we're filtering on.
+# First, make a note of what we're asking EC2 for.
+# (Narrowing the list down is done locally, with `filter_terms`.)
 instance_filter = (
     'pending', 'running',
     'shutting-down', 'terminated',
     'stopping', 'stopped',
 )
 
+show_menu = True
 while True:
 
     # If our instance dict is empty, reload it
@@ -487,34 +685,44 @@ while True:
             instances_by_id_list=instances_by_id,
             instances_by_creation_list=instances_by_creation,
             instances_by_ip_list=instances_by_ip,
+            instances_by_workshop_list=instances_by_workshop,
             instance_filter=instance_filter,
         )
 
-    # Print the list, and our options
-    print_list(
-        display_list,
+    # Apply our filter (if any) to the sorted list.
+    shown_list = apply_filter(display_list)
+
+    # Keep our page number in range, since the list may have shrunk.
+    current_page = max(1, min(current_page, get_page_count(shown_list)))
+
+    # Print the current page, and our options
+    print_page(
+        shown_list,
+        current_page,
         instances_by_id_list=instances_by_id,
         instances_by_creation_list=instances_by_creation,
         instances_by_ip_list=instances_by_ip,
-        instances_by_state_list=instances_by_state
+        instances_by_state_list=instances_by_state,
+        instances_by_workshop_list=instances_by_workshop,
+        sort_list=display_list,
     )
+    if filter_text is not None:
+        print('Filter: %s (%d of %d instances shown)' % (
+            filter_text,
+            len(shown_list),
+            len(display_list),
+        ))
     print('                                                Current Time: %s' % (
-        datetime.datetime.now(tz=dateutil.tz.gettz()).strftime('%a, %b %d %H:%M')
+        datetime.datetime.now(tz=inventory.local_tz()).strftime('%a, %b %d %H:%M')
     ))
     print('(Terminated instances will clean up themselves after a few minutes...)')
-    print('To destroy instances, enter a range of row numbers (use hyphens and commas)')
-    print('Or enter one of the following commands:')
-    print('  q  to quit')
-    print('  r  to reload the list and reset the sort/filter')
-    print('  To only show certain instances:')
-    print('     fr to only show running instances')
-    print('     fs ............ stopped instances')
-    print('     ft ............ terminated instances')
-    print('  To sort the results:')
-    print('     si to sort by instance ID')
-    print('     sp .......... public IP')
-    print('     sc .......... creation date')
-    print('     ss .......... status')
+
+    # The full menu is long, so only print it the first time (or on request).
+    if show_menu:
+        print_menu()
+        show_menu = False
+    else:
+        print('Enter row numbers to destroy, n/p/jN to change pages, or ? for help.')
 
     # Find out what the user wants to do
     response = get_selection()
@@ -525,43 +733,102 @@ while True:
         # Translate the set into a list of instances
         destruction_list = list()
         for i in response:
-            if i > 0 and i <= len(display_list):
+            if i > 0 and i <= len(shown_list):
                 # NOTE: The lists we display are 1-indexed, but Python lists are 0-indexed.
-                destruction_list.append(display_list[i-1])
+                destruction_list.append(shown_list[i-1])
         # Call the destruction code
         destroy_instances(destruction_list)
         # Clear our instance info, to trigger a reload
         instances.clear()
     elif response == 'q':
         break
+    elif response == '?':
+        show_menu = True
+    elif response == 'w':
+        # The watch view takes over the terminal until the user quits it.
+        watch.watch_instances(
+            chosen_config,
+            instances,
+            fetch_instances,
+            terminate_instance_ids,
+        )
+        # Things have probably changed, so reload
+        instances.clear()
+    elif response == 'cw':
+        # Pick new workshop(s).  The config was already checked, so this is
+        # quick, unless the config has changed since we read it.
+        if configstore.changed(config_snapshot):
+            print('The configuration has changed; reloading it.')
+            config, config_snapshot = workshops.load_config()
+            usable_workshops = workshops.check_workshops(config)
+            checked_workshops.clear()
+        chosen = choose_workshops()
+        if chosen is None:
+            break
+        chosen_config, workshops_by_region = chosen
+        instances.clear()
+        display_list = instances_by_id
+        filter_text = None
+        filter_terms = None
+        current_page = 1
     elif response == 'r':
         # Wipe our instance dict, for it to reload on the next loop
         instances.clear()
         # Reset the list of instances to display
-        instance_filter = (
-            'pending', 'running',
-            'shutting-down', 'terminated',
-            'stopping', 'stopped',
-        )
-        # Reset the sort
+        filter_text = None
+        filter_terms = None
+        # Reset the sort, and go back to the first page
         display_list = instances_by_id
+        current_page = 1
 
-    # The filter options clear the instance dict and set a new filter.
-    elif response == 'fr':
-        instances.clear()
-        instance_filter = (
-            'pending', 'running',
-        )
-    elif response == 'fs':
-        instances.clear()
-        instance_filter = (
-            'stopping', 'stopped',
-        )
-    elif response == 'ft':
-        instances.clear()
-        instance_filter = (
-            'shutting-down', 'terminated',
-        )
+    # The page options move around the list, without reloading anything.
+    elif response == 'n':
+        current_page = min(current_page + 1, get_page_count(shown_list))
+    elif response == 'p':
+        current_page = max(current_page - 1, 1)
+    elif type(response) is tuple and response[0] == 'j':
+        if response[1] < 1 or response[1] > get_page_count(shown_list):
+            print('Please enter a page number from 1 to %d' % (
+                get_page_count(shown_list),
+            ))
+        else:
+            current_page = response[1]
+    elif type(response) is tuple and response[0] == 'l':
+        if response[1] < 0:
+            print('Please enter a non-negative number of lines')
+        else:
+            # Keep the first row of the current page in view.
+            first_row = (current_page - 1) * get_page_size() + 1
+            page_size_setting = response[1]
+            current_page = (first_row - 1) // get_page_size() + 1
+
+    # The filter options set a new filter.  Filters are evaluated locally, so
+    # nothing needs to be reloaded.  (fr/fs/ft are shortcuts.)
+    elif response in ('fr', 'fs', 'ft') or (
+        type(response) is tuple and response[0] == 'f'
+    ):
+        if response == 'fr':
+            filter_text = 'state pending,running'
+        elif response == 'fs':
+            filter_text = 'state stopping,stopped'
+        elif response == 'ft':
+            filter_text = 'state shutting-down,terminated'
+        else:
+            filter_text = response[2]
+        filter_terms = filters.parse(filter_text)
+        current_page = 1
+    elif response == 'fc':
+        filter_text = None
+        filter_terms = None
+        current_page = 1
+
+    # Destroy everything matching the filter (after confirmation, of course).
+    elif response == 'ta':
+        if filter_terms is None:
+            print('Set a filter first (or give a range of row numbers).')
+        else:
+            destroy_instances(shown_list)
+            instances.clear()
 
 
     # The sort options simply involve changing our display list
@@ -573,6 +840,8 @@ while True:
         display_list = instances_by_creation
     elif response == 'ss':
         display_list = instances_by_state
+    elif response == 'sw':
+        display_list = instances_by_workshop
 
     # We validated input in `get_selection()`, so we should never reach here
     else:
@@ -0,0 +1,331 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This script removes everything a workshop has in AWS: Its instances, Elastic
+# IPs, launch template, security groups, subnets, route tables, internet
+# gateway, and VPC.
+# Resources are found by their `Workshop` tag (see the `provision` module), so
+# this also cleans up after a half-finished `create_workshop`.
+#
+# The deletions form a dependency graph, which is the reverse of the one
+# `create_workshop` uses: For example, the VPC goes last, and the subnets go
+# once the instances are gone.  Deletions that don't depend on each other run
+# at the same time.  EC2 often needs a little time to notice that something
+# is gone, so a deletion that is refused because of a dependency is retried.
+
+# First, import modules from the standard library
+import argparse
+from os import environ
+import sys
+from sys import exit
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    import configstore
+    import inventory
+    import provision
+    import regions
+    import terminate
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# These errors mean the resource is already gone, which is what we want.
+gone_errors = (
+    'Gateway.NotAttached',
+    'InvalidAllocationID.NotFound',
+    'InvalidAssociationID.NotFound',
+    'InvalidGroup.NotFound',
+    'InvalidInternetGatewayID.NotFound',
+    'InvalidLaunchTemplateId.NotFound',
+    'InvalidRouteTableID.NotFound',
+    'InvalidSubnetID.NotFound',
+    'InvalidVpcID.NotFound',
+)
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Delete a workshop\'s instances, and all of its AWS resources.',
+)
+parser.add_argument('workshop',
+    help='The name of the workshop.',
+)
+parser.add_argument('--region',
+    default=None,
+    help='The workshop\'s region.  Default: The region in the workshop config.',
+)
+parser.add_argument('--yes',
+    action='store_true',
+    help='Do not ask for confirmation.',
+)
+parser.add_argument('--keep-config',
+    action='store_true',
+    help='Leave the workshop in the workshop config.',
+)
+args = parser.parse_args()
+
+print('Welcome to Workshop Destroyer')
+
+# Start talking to AWS in the background.
+startup.start_session()
+
+# Work out (and check) the region.
+if 'CREATE_INSTANCES_CONFIG' not in environ:
+    print('Environment variable CREATE_INSTANCES_CONFIG is missing.  Re-run `finish_install`.')
+    exit(1)
+config, config_snapshot = configstore.read_config(environ['CREATE_INSTANCES_CONFIG'])
+if args.region is None:
+    if args.workshop in config and 'region' in config[args.workshop]:
+        args.region = config[args.workshop]['region']
+    else:
+        print('The workshop "%s" is not configured (or has no region).' % (args.workshop,))
+        print('Use --region to say where it is.')
+        exit(1)
+if not regions.is_valid_region(args.region):
+    print('"%s" is not an AWS region we know about.' % (args.region,))
+    exit(1)
+del config
+
+# Check connectivity (and our permissions in the workshop's region).
+workshops.check_connectivity({args.region: ()})
+ec2_client = startup.client('ec2', region_name=args.region)
+
+
+# Find everything that belongs to the workshop.  The lookups don't depend on
+# each other, so they also run as a graph.
+def find_instances(results):
+    return list(inventory.iter_instance_ids(
+        ec2_client,
+        inventory.workshop_filters(args.workshop, inventory.LIVE_STATES),
+    ))
+
+def find_resources(describe, key):
+    def find(results):
+        return describe(Filters=provision.resource_filters(args.workshop))[key]
+    return find
+
+print('Looking for the resources of workshop %s in %s… ' % (args.workshop, args.region), end='')
+sys.stdout.flush()
+found, failures = provision.run_graph({
+    'instances': ((), find_instances),
+    'addresses': ((), find_resources(ec2_client.describe_addresses, 'Addresses')),
+    'launch-templates': ((), find_resources(ec2_client.describe_launch_templates, 'LaunchTemplates')),
+    'security-groups': ((), find_resources(ec2_client.describe_security_groups, 'SecurityGroups')),
+    'subnets': ((), find_resources(ec2_client.describe_subnets, 'Subnets')),
+    'route-tables': ((), find_resources(ec2_client.describe_route_tables, 'RouteTables')),
+    'internet-gateways': ((), find_resources(ec2_client.describe_internet_gateways, 'InternetGateways')),
+    'vpcs': ((), find_resources(ec2_client.describe_vpcs, 'Vpcs')),
+})
+if len(failures) > 0:
+    print('ERROR')
+    for name in sorted(failures.keys()):
+        print('  Looking for %s: %s' % (name, failures[name]))
+    exit(1)
+print('Complete')
+
+
+# Define a subroutine that deletes something, treating "already gone" as
+# success, and retrying while something still depends on it.
+def delete(description, function, **kwargs):
+    def delete_node(results):
+        try:
+            provision.retry_dependency(function, **kwargs)
+            print('Deleted %s' % (description,))
+        except Exception as e:
+            if not provision.is_error(e, *gone_errors):
+                raise
+        return True
+    return delete_node
+
+
+# Define a subroutine that terminates the instances, and waits for them to be
+# gone.  Until then, their network interfaces hold on to everything else.
+def terminate_instances(results):
+    instance_ids = found['instances']
+    if len(instance_ids) == 0:
+        return True
+    states, failures = terminate.terminate_instances(ec2_client, instance_ids)
+    if len(failures) > 0:
+        raise RuntimeError('%d instance(s) could not be terminated, including %s: %s' % (
+            len(failures),
+            sorted(failures.keys())[0],
+            failures[sorted(failures.keys())[0]],
+        ))
+    remaining = terminate.wait_for_termination(ec2_client, instance_ids)
+    if len(remaining) > 0:
+        raise RuntimeError('%d instance(s) did not finish terminating in time' % (
+            len(remaining),
+        ))
+    print('Terminated %d instance(s)' % (len(instance_ids),))
+    return True
+
+
+# Build the teardown graph.  Each entry is (dependencies, function).
+graph = {
+    'instances': ((), terminate_instances),
+}
+vpc_dependencies = list()
+
+# The launch templates don't block anything.
+for template in found['launch-templates']:
+    graph['launch-template %s' % (template['LaunchTemplateId'],)] = ((), delete(
+        'launch template %s' % (template['LaunchTemplateId'],),
+        ec2_client.delete_launch_template,
+        LaunchTemplateId=template['LaunchTemplateId'],
+    ))
+
+# Security groups and subnets can go once the instances are gone.
+for group in found['security-groups']:
+    node = 'security-group %s' % (group['GroupId'],)
+    graph[node] = (('instances',), delete(
+        'security group %s' % (group['GroupId'],),
+        ec2_client.delete_security_group,
+        GroupId=group['GroupId'],
+    ))
+    vpc_dependencies.append(node)
+for subnet in found['subnets']:
+    node = 'subnet %s' % (subnet['SubnetId'],)
+    graph[node] = (('instances',), delete(
+        'subnet %s' % (subnet['SubnetId'],),
+        ec2_client.delete_subnet,
+        SubnetId=subnet['SubnetId'],
+    ))
+    vpc_dependencies.append(node)
+
+# Route tables can go once they are disassociated from their subnets.
+# (The main route table goes with the VPC.)
+for route_table in found['route-tables']:
+    association_nodes = list()
+    main = False
+    for association in route_table.get('Associations', ()):
+        if association.get('Main', False):
+            main = True
+            continue
+        node = 'association %s' % (association['RouteTableAssociationId'],)
+        graph[node] = ((), delete(
+            'route table association %s' % (association['RouteTableAssociationId'],),
+            ec2_client.disassociate_route_table,
+            AssociationId=association['RouteTableAssociationId'],
+        ))
+        association_nodes.append(node)
+    if main:
+        continue
+    node = 'route-table %s' % (route_table['RouteTableId'],)
+    graph[node] = (tuple(association_nodes), delete(
+        'route table %s' % (route_table['RouteTableId'],),
+        ec2_client.delete_route_table,
+        RouteTableId=route_table['RouteTableId'],
+    ))
+    vpc_dependencies.append(node)
+
+# Elastic IPs (from `suspend_workshop --keep-ips`) are let go once their
+# instances are gone.
+address_nodes = ['instances']
+for address in found['addresses']:
+    node = 'address %s' % (address['AllocationId'],)
+    graph[node] = (('instances',), delete(
+        'Elastic IP %s' % (address['PublicIp'],),
+        ec2_client.release_address,
+        AllocationId=address['AllocationId'],
+    ))
+    address_nodes.append(node)
+
+# Internet gateways are detached once the instances (and their public IPs)
+# are gone, and then deleted.
+for gateway in found['internet-gateways']:
+    detach_nodes = list()
+    for attachment in gateway.get('Attachments', ()):
+        node = 'detach %s %s' % (gateway['InternetGatewayId'], attachment['VpcId'])
+        graph[node] = (tuple(address_nodes), delete(
+            'internet gateway attachment %s' % (gateway['InternetGatewayId'],),
+            ec2_client.detach_internet_gateway,
+            InternetGatewayId=gateway['InternetGatewayId'],
+            VpcId=attachment['VpcId'],
+        ))
+        detach_nodes.append(node)
+        vpc_dependencies.append(node)
+    graph['internet-gateway %s' % (gateway['InternetGatewayId'],)] = (tuple(detach_nodes), delete(
+        'internet gateway %s' % (gateway['InternetGatewayId'],),
+        ec2_client.delete_internet_gateway,
+        InternetGatewayId=gateway['InternetGatewayId'],
+    ))
+
+# The VPCs go last.
+for vpc in found['vpcs']:
+    graph['vpc %s' % (vpc['VpcId'],)] = (tuple(vpc_dependencies), delete(
+        'VPC %s' % (vpc['VpcId'],),
+        ec2_client.delete_vpc,
+        VpcId=vpc['VpcId'],
+    ))
+
+# Say what we found, and confirm.
+print('')
+print('This will delete:')
+print('  %d instance(s)' % (len(found['instances']),))
+for key, description in (
+    ('addresses', 'Elastic IP(s)'),
+    ('launch-templates', 'launch template(s)'),
+    ('security-groups', 'security group(s)'),
+    ('subnets', 'subnet(s)'),
+    ('route-tables', 'route table(s)'),
+    ('internet-gateways', 'internet gateway(s)'),
+    ('vpcs', 'VPC(s)'),
+):
+    print('  %d %s' % (len(found[key]), description))
+if not args.yes:
+    response = ''
+    while response not in ('y', 'n'):
+        try:
+            response = input('Are you sure (y/n)? ')
+        except (EOFError, KeyboardInterrupt):
+            response = 'n'
+    if response == 'n':
+        print('Goodbye')
+        exit()
+
+# Tear it all down!
+print('Tearing down workshop %s…' % (args.workshop,))
+sys.stdout.flush()
+results, failures = provision.run_graph(graph)
+
+if len(failures) > 0:
+    print('')
+    print('Some resources could not be deleted:')
+    for name in sorted(failures.keys()):
+        print('  %s: %s' % (name, failures[name]))
+    print('Fix the problem, and run `destroy_workshop` again to finish up.')
+    exit(1)
+
+# Remove the workshop from the config.  If someone else changes the config at
+# the same time, re-read it and try again.
+if not args.keep_config:
+    while True:
+        config, config_snapshot = configstore.read_config(environ['CREATE_INSTANCES_CONFIG'])
+        if args.workshop not in config:
+            break
+        del config[args.workshop]
+        try:
+            configstore.write_config(environ['CREATE_INSTANCES_CONFIG'], config, config_snapshot)
+            print('Removed workshop %s from the workshop configuration' % (args.workshop,))
+            break
+        except configstore.StaleConfigError:
+            continue
+
+print('')
+print('Workshop %s is gone.' % (args.workshop,))
@@ -0,0 +1,198 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# First, import modules from the standard library
+import argparse
+import csv
+import json
+import sys
+from sys import exit
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    import accounts
+    import inventory
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# These are the columns we export, in order.
+columns = (
+    'Workshop',
+    'Account',
+    'Region',
+    'InstanceId',
+    'State',
+    'PublicIpAddress',
+    'LaunchTime',
+    'LaunchDateTime',
+    'InstanceType',
+    'AvailabilityZone',
+)
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Export the instances of one workshop (or all of them) as CSV or JSON Lines.',
+)
+parser.add_argument('workshop',
+    nargs='?',
+    help='The workshop to export.  If not given, you will be asked.',
+)
+parser.add_argument('--all',
+    action='store_true',
+    help='Export every configured workshop.',
+)
+parser.add_argument('--format',
+    choices=('csv', 'jsonl'),
+    default='csv',
+    help='The output format.  Default: csv',
+)
+parser.add_argument('--output', '-o',
+    default=None,
+    help='Write to this file, instead of standard output.',
+)
+parser.add_argument('--state',
+    action='append',
+    choices=inventory.INSTANCE_STATES,
+    help='Only export instances in this state.  May be given more than once.',
+)
+args = parser.parse_args()
+
+# Start talking to AWS in the background.
+startup.start_session()
+
+# Everything except the export itself goes to standard error, so the export
+# can be piped or redirected cleanly.
+sys.stdout = sys.stderr
+
+# Load our config files
+with startup.phase('Reading configuration'):
+    config, config_snapshot = workshops.load_config()
+
+# Exports only need to know each workshop's region.
+region_workshops = list(
+    workshop for workshop in config.sections()
+    if 'region' in config[workshop]
+)
+
+# Work out which workshop(s) to export.
+if args.all:
+    chosen_workshops = region_workshops
+elif args.workshop is not None:
+    if args.workshop not in region_workshops:
+        print('The workshop "%s" is not configured (or has no region).' % (
+            args.workshop,
+        ))
+        print('Re-run `finish_install` to fix.')
+        exit(1)
+    chosen_workshops = [args.workshop]
+else:
+    choice = workshops.choose_workshop(
+        region_workshops,
+        'The following workshops can be exported:',
+        allow_all=True,
+    )
+    if choice is None:
+        print('Goodbye')
+        exit()
+    elif choice == workshops.ALL_WORKSHOPS:
+        chosen_workshops = region_workshops
+    else:
+        chosen_workshops = [choice]
+del region_workshops
+
+# Now that we know what to export, check connectivity (and that we can list
+# instances in each region).
+with startup.phase('Talking to AWS'):
+    workshops.check_connectivity(dict(
+        (region, ())
+        for region in workshops.workshops_by_region(config, chosen_workshops)
+    ), read_only=True)
+
+# Group the workshops by region (a workshop with shards in several regions is
+# in each of them), and make clients for each region.
+workshops_by_region = workshops.workshops_by_region(config, chosen_workshops)
+ec2_clients = dict()
+for region in workshops_by_region:
+    if region not in ec2_clients:
+        ec2_clients[region] = accounts.client(region)
+
+
+# Define a subroutine that turns an instance record into a flat dict of strings
+def export_row(instance):
+    return {
+        'Workshop': instance['Workshop'],
+        'Account': instance['Account'],
+        'Region': instance['Region'],
+        'InstanceId': instance['InstanceId'],
+        'State': instance['State'],
+        'PublicIpAddress': (
+            '' if instance['PublicIpAddress'] is None
+            else str(instance['PublicIpAddress'])
+        ),
+        'LaunchTime': instance['LaunchTime'].isoformat(),
+        'LaunchDateTime': inventory.launched_at(instance).isoformat(),
+        'InstanceType': instance['InstanceType'],
+        'AvailabilityZone': instance['AvailabilityZone'],
+    }
+
+
+# Open our output.  (Remember that sys.stdout now points to standard error.)
+if args.output is None:
+    output_fh = sys.__stdout__
+else:
+    try:
+        output_fh = open(args.output, 'w', newline='', encoding='utf-8')
+    except Exception as e:
+        print('Unable to open %s for writing: %s' % (args.output, e))
+        exit(1)
+
+# Stream the instances straight to the output, as each page arrives.  Nothing
+# is sorted or collected, so memory use stays the same no matter how many
+# instances there are.
+if args.format == 'csv':
+    writer = csv.DictWriter(output_fh, fieldnames=columns)
+    writer.writeheader()
+    write_row = writer.writerow
+else:
+    def write_row(row):
+        output_fh.write(json.dumps(row))
+        output_fh.write('\n')
+
+count = 0
+try:
+    for instance in inventory.iter_regions_instances(
+        ec2_clients,
+        workshops_by_region,
+        states=args.state,
+    ):
+        write_row(export_row(instance))
+        count = count + 1
+except Exception as e:
+    print('ERROR')
+    print('Something went wrong while getting the list of instances.')
+    print('The exact error we got:', e)
+    exit(1)
+finally:
+    output_fh.flush()
+    if args.output is not None:
+        output_fh.close()
+
+print('Exported %d instance(s) from %d workshop(s).' % (count, len(chosen_workshops)))
+exit()
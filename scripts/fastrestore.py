@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module turns EBS Fast Snapshot Restore (FSR) on and off for a workshop.
+#
+# A new instance's EBS volumes are made from the AMI's snapshots, and their
+# blocks are fetched from S3 the first time each one is read.  That makes the
+# first few minutes of every instance slow.  With FSR enabled for a snapshot
+# in an Availability Zone, volumes made there are fully fast right away.
+#
+# To find what to enable, we follow the workshop's launch template to its AMI,
+# and the AMI to its snapshots; and we follow the template's subnets (or
+# placement) to the Availability Zones it launches into.  If the template
+# doesn't pin a zone, we use every zone in the region.
+#
+# FSR is billed for every hour it is enabled, for each snapshot in each zone,
+# so it should be turned off after class.
+
+# First, import modules from the standard library
+import random
+import time
+
+# Then, import our own stuff
+import templates
+
+
+# How long (in seconds) to wait for FSR to finish enabling, by default.
+# Enabling takes about an hour for each TiB of snapshot.
+default_timeout = 2 * 60 * 60
+
+# The FSR states which mean "on, or on its way".
+on_states = ('enabling', 'optimizing', 'enabled')
+
+# For this long (in seconds) after a request, a snapshot/zone pair that EC2
+# doesn't list yet is assumed to be on its way.
+settle_time = 60
+
+
+# Find the AMI and EBS snapshots behind a launch template.
+# Returns a tuple of the AMI ID and a sorted list of snapshot IDs.
+def template_snapshots(ec2_client, data):
+    if 'ImageId' not in data:
+        raise ValueError('The launch template does not name an AMI')
+    images = ec2_client.describe_images(ImageIds=[data['ImageId']])['Images']
+    if len(images) == 0:
+        raise ValueError('The AMI %s was not found' % (data['ImageId'],))
+    snapshot_ids = set()
+    for mapping in images[0].get('BlockDeviceMappings', ()):
+        if 'SnapshotId' in mapping.get('Ebs', dict()):
+            snapshot_ids.add(mapping['Ebs']['SnapshotId'])
+    return (data['ImageId'], sorted(snapshot_ids))
+
+
+# Find the Availability Zones a launch template launches into.
+# Returns a sorted list of zone names.
+def template_zones(ec2_client, data):
+    zones = set()
+    placement_zone = data.get('Placement', dict()).get('AvailabilityZone')
+    if placement_zone is not None:
+        zones.add(placement_zone)
+
+    subnet_ids = list(
+        interface['SubnetId']
+        for interface in data.get('NetworkInterfaces', ())
+        if 'SubnetId' in interface
+    )
+    if len(subnet_ids) > 0:
+        for subnet in ec2_client.describe_subnets(SubnetIds=subnet_ids)['Subnets']:
+            zones.add(subnet['AvailabilityZone'])
+
+    # If the template doesn't say, the instances could go anywhere.
+    if len(zones) == 0:
+        response = ec2_client.describe_availability_zones(
+            Filters=[{
+                'Name': 'state',
+                'Values': ['available'],
+            }],
+        )
+        zones.update(
+            zone['ZoneName'] for zone in response['AvailabilityZones']
+            if zone.get('ZoneType', 'availability-zone') == 'availability-zone'
+        )
+    return sorted(zones)
+
+
+# Work out everything FSR needs for one launch template.
+# Returns a dict with the template's AMI (`image`), snapshots (`snapshots`),
+# and zones (`zones`).
+def resolve(ec2_client, template):
+    data = templates.template_data(ec2_client, template)
+    image_id, snapshot_ids = template_snapshots(ec2_client, data)
+    return {
+        'image': image_id,
+        'snapshots': snapshot_ids,
+        'zones': template_zones(ec2_client, data),
+    }
+
+
+# Turn FSR on (or off) for some snapshots, in some zones.
+# Returns a dict mapping (snapshot ID, zone) tuples, for the ones that EC2
+# refused, to the reasons why.
+def set_fast_restore(ec2_client, snapshot_ids, zones, enable=True):
+    if len(snapshot_ids) == 0 or len(zones) == 0:
+        return dict()
+    if enable:
+        call = ec2_client.enable_fast_snapshot_restores
+    else:
+        call = ec2_client.disable_fast_snapshot_restores
+    response = call(
+        AvailabilityZones=list(zones),
+        SourceSnapshotIds=list(snapshot_ids),
+    )
+
+    refused = dict()
+    for item in response.get('Unsuccessful', ()):
+        for error in item.get('FastSnapshotRestoreStateErrors', ()):
+            refused[(item['SnapshotId'], error['AvailabilityZone'])] = (
+                error['Error'].get('Message', error['Error'].get('Code'))
+            )
+    return refused
+
+
+# Get the FSR state of some snapshots, in some zones.
+# Returns a dict mapping (snapshot ID, zone) tuples to states.  Pairs with FSR
+# off are missing (EC2 forgets them once they are disabled).
+def fast_restore_states(ec2_client, snapshot_ids, zones):
+    states = dict()
+    page_iterator = ec2_client.get_paginator('describe_fast_snapshot_restores').paginate(
+        Filters=[
+            {'Name': 'snapshot-id', 'Values': list(snapshot_ids)},
+            {'Name': 'availability-zone', 'Values': list(zones)},
+        ],
+    )
+    for snapshot_id, zone, state in page_iterator.search(
+        'FastSnapshotRestores[].[SnapshotId, AvailabilityZone, State]'
+    ):
+        states[(snapshot_id, zone)] = state
+    return states
+
+
+# Wait for FSR to be enabled for some snapshots, in some zones.
+# `on_enabled` (if provided) is called with each (snapshot ID, zone) tuple, as
+# it becomes enabled.  Pairs that go off (instead of on) stop being watched.
+# Returns a dict mapping the (snapshot ID, zone) tuples that didn't finish
+# (because they timed out, or went off) to their last known state.
+def wait_for_fast_restore(ec2_client, snapshot_ids, zones, timeout=default_timeout, on_enabled=None):
+    remaining = dict(
+        ((snapshot_id, zone), None)
+        for snapshot_id in snapshot_ids
+        for zone in zones
+    )
+    failed = dict()
+    wait_starttime = time.monotonic()
+
+    while (
+        (len(remaining) > 0) and
+        (time.monotonic() - wait_starttime <= timeout)
+    ):
+        states = fast_restore_states(ec2_client, snapshot_ids, zones)
+        settling = (time.monotonic() - wait_starttime <= settle_time)
+        for pair in list(remaining.keys()):
+            state = states.get(pair)
+            if state is None and settling:
+                continue
+            if state is None:
+                state = 'disabled'
+            remaining[pair] = state
+            if state == 'enabled':
+                del remaining[pair]
+                if on_enabled is not None:
+                    on_enabled(pair)
+            elif state not in on_states:
+                del remaining[pair]
+                failed[pair] = state
+
+        # If we have any items left to check, wait 15 to 30 seconds before
+        # trying again.  (This is a slow process.)
+        if len(remaining) > 0:
+            time.sleep(random.randrange(1500, 3000, 1) / 100)
+
+    remaining.update(failed)
+    return remaining
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module evaluates filter expressions against instance records (from the
+# `inventory` module), without going back to EC2.
+#
+# An expression is one or more terms, joined with `and`.  Any term may start
+# with `not`.  These are the terms:
+#
+#   state STATE[,STATE...]   Instances in any of the listed states
+#   older-than AGE           Instances launched more than AGE ago
+#   newer-than AGE           Instances launched less than AGE ago
+#   ip CIDR                  Instances whose public IP is in CIDR
+#   ip none                  Instances with no public IP
+#   tag KEY=VALUE            Instances with tag KEY set to VALUE
+#   tag KEY                  Instances with tag KEY set (to anything)
+#   id PREFIX                Instances whose ID starts with PREFIX
+#   workshop NAME            Instances in workshop NAME
+#   region NAME              Instances in region NAME
+#   account PROFILE          Instances in the account of credential PROFILE
+#
+# AGE is a number followed by s, m, h, or d (for example, `3h` or `90m`).
+#
+# For example: `state running and older-than 3h and not ip 10.0.0.0/8`
+#
+# Each field gets an index (a dict of sets, or a sorted list), so evaluating a
+# term costs a lookup or a binary search, not a walk through every instance.
+
+# First, import modules from the standard library
+import bisect
+import datetime
+import ipaddress
+
+
+# How many seconds are in each AGE unit.
+age_units = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+}
+
+
+# Build the indexes for a dict of instance records (keyed by instance ID).
+# The index should be rebuilt whenever the records are reloaded.
+def build_index(instances):
+    index = {
+        'all': set(instances.keys()),
+        'state': dict(),
+        'workshop': dict(),
+        'region': dict(),
+        'account': dict(),
+        'tag': dict(),
+        'tag_key': dict(),
+        'no_ip': set(),
+    }
+    launch_list = list()
+    ip_list = list()
+
+    for instance_id, instance in instances.items():
+        for field, value in (
+            ('state', instance['State']),
+            ('workshop', instance.get('Workshop')),
+            ('region', instance.get('Region')),
+            ('account', instance.get('Account')),
+        ):
+            index[field].setdefault(value, set()).add(instance_id)
+        for key, value in instance.get('Tags', dict()).items():
+            index['tag'].setdefault((key, value), set()).add(instance_id)
+            index['tag_key'].setdefault(key, set()).add(instance_id)
+        launch_list.append((instance['LaunchTime'].timestamp(), instance_id))
+        if instance['PublicIpAddress'] is None:
+            index['no_ip'].add(instance_id)
+        else:
+            ip_list.append((int(instance['PublicIpAddress']), instance_id))
+
+    # The sorted indexes are kept as two parallel lists: one of keys (for
+    # bisect to search), and one of instance IDs.
+    launch_list.sort()
+    ip_list.sort()
+    index['launch_keys'] = list(x[0] for x in launch_list)
+    index['launch_ids'] = list(x[1] for x in launch_list)
+    index['ip_keys'] = list(x[0] for x in ip_list)
+    index['ip_ids'] = list(x[1] for x in ip_list)
+    index['ids'] = sorted(instances.keys())
+
+    return index
+
+
+# Turn an AGE (like `3h`) into a number of seconds.
+def parse_age(age):
+    if len(age) < 2 or age[-1] not in age_units:
+        raise ValueError('"%s" is not an age (try something like 3h or 90m)' % (age,))
+    try:
+        count = float(age[:-1])
+    except ValueError:
+        raise ValueError('"%s" is not an age (try something like 3h or 90m)' % (age,))
+    return count * age_units[age[-1]]
+
+
+# Parse an expression into a list of (negate, field, value) terms.
+# Raises ValueError (with a readable message) if the expression is bad.
+def parse(expression):
+    terms = list()
+    words = expression.split()
+    if len(words) == 0:
+        raise ValueError('The filter is empty')
+
+    # Split the words into groups, on `and`.
+    groups = [[]]
+    for word in words:
+        if word.lower() == 'and':
+            groups.append([])
+        else:
+            groups[-1].append(word)
+
+    for group in groups:
+        negate = False
+        if len(group) > 0 and group[0].lower() == 'not':
+            negate = True
+            group = group[1:]
+        if len(group) != 2:
+            raise ValueError('Could not parse "%s"' % (' '.join(group),))
+        field = group[0].lower()
+        value = group[1]
+
+        # Check (and pre-parse) the value, so evaluation never fails.
+        if field == 'state':
+            value = tuple(state.lower() for state in value.split(',') if state != '')
+        elif field in ('older-than', 'newer-than'):
+            value = parse_age(value)
+        elif field == 'ip':
+            if value.lower() == 'none':
+                value = None
+            else:
+                try:
+                    value = ipaddress.ip_network(value, strict=False)
+                except ValueError:
+                    raise ValueError('"%s" is not an IP address or CIDR block' % (value,))
+                # Instances' public IPs are always IPv4, and the index keys
+                # them as IPv4 numbers.
+                if value.version != 4:
+                    raise ValueError('"%s" is not an IPv4 address or CIDR block' % (value,))
+        elif field == 'tag':
+            if '=' in value:
+                value = tuple(value.split('=', 1))
+            else:
+                value = (value, None)
+        elif field in ('id', 'workshop', 'region', 'account'):
+            pass
+        else:
+            raise ValueError('"%s" is not something we can filter on' % (field,))
+        terms.append((negate, field, value))
+
+    return terms
+
+
+# Find the instance IDs matching one (non-negated) term.
+def match_term(index, field, value, now):
+    if field == 'state':
+        matches = set()
+        for state in value:
+            matches.update(index['state'].get(state, ()))
+        return matches
+    elif field in ('workshop', 'region', 'account'):
+        return set(index[field].get(value, ()))
+    elif field == 'tag':
+        if value[1] is None:
+            return set(index['tag_key'].get(value[0], ()))
+        return set(index['tag'].get(value, ()))
+    elif field in ('older-than', 'newer-than'):
+        cutoff = now.timestamp() - value
+        position = bisect.bisect_right(index['launch_keys'], cutoff)
+        if field == 'older-than':
+            return set(index['launch_ids'][:position])
+        return set(index['launch_ids'][position:])
+    elif field == 'ip':
+        if value is None:
+            return set(index['no_ip'])
+        low = bisect.bisect_left(index['ip_keys'], int(value.network_address))
+        high = bisect.bisect_right(index['ip_keys'], int(value.broadcast_address))
+        return set(index['ip_ids'][low:high])
+    elif field == 'id':
+        matches = set()
+        position = bisect.bisect_left(index['ids'], value)
+        while position < len(index['ids']) and index['ids'][position].startswith(value):
+            matches.add(index['ids'][position])
+            position = position + 1
+        return matches
+
+
+# Evaluate parsed terms against an index.  Returns a set of instance IDs.
+def evaluate(terms, index, now=None):
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    matches = set(index['all'])
+    for negate, field, value in terms:
+        term_matches = match_term(index, field, value, now)
+        if negate:
+            matches.difference_update(term_matches)
+        else:
+            matches.intersection_update(term_matches)
+    return matches
@@ -11,24 +11,37 @@
 # See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
 
 # Import standard library stuff
-import configparser
-import fcntl
+import concurrent.futures
 import getpass
-import json
-import pkg_resources
 from os import environ
 import sys
 from sys import exit
 
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
 # Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
 try:
-    import boto3
+    startup.require('boto3')
+    import accounts
+    import configstore
     from progress.spinner import Spinner
+    import preflight
+    import regions
+    import templates
+    import validation
+    import workshops
 except ModuleNotFoundError as e:
     print('Failed to import module %s' % (e.name,))
     print('Run `finish_install`')
     exit()
 
+# Import boto3 in the background, while the user answers our questions.
+# No clients are made ahead of time, because we may be about to change the
+# config and credentials that they would use.
+startup.start_session(preload=())
+
 # Let's start by making sure our environment variables are actually defined.
 spinner = Spinner('Checking Environment ')
 
@@ -49,6 +62,47 @@ for var in (
 print(' Complete')
 
 # Now we can start checking out the contents of each config file.
+# Config files are read as snapshots, and written by replacing them (see the
+# `configstore` module), so we never lock out the other scripts, and they
+# never lock us out.
+
+# Make a small subroutine to read a snapshot of a config file.
+# If the file doesn't exist, it reads as empty.
+def read_config_file(var):
+    try:
+        return configstore.read_config(environ[var])
+    except Exception as e:
+        print(
+            'We were unable to read the file at path %s.' % environ[var],
+            'Please check permissions and try again.',
+            'Details: %s' % e,
+            sep="\n"
+        )
+        exit()
+# Done defining read_config_file
+
+# Make a small subroutine to write out a config file.
+# If someone else changed the file since we read it, we stop.
+def write_config_file(var, config, snapshot):
+    try:
+        return configstore.write_config(environ[var], config, snapshot)
+    except configstore.StaleConfigError:
+        print(
+            'The file at path %s was changed while we were working.' % environ[var],
+            'Your changes to it were not saved.',
+            'Please run `finish_install` again.',
+            sep="\n"
+        )
+        exit()
+    except Exception as e:
+        print(
+            'We were unable to write the file at path %s.' % environ[var],
+            'Please check permissions and try again.',
+            'Details: %s' % e,
+            sep="\n"
+        )
+        exit()
+# Done defining write_config_file
 
 # Start with the general config file.
 
@@ -58,35 +112,7 @@ aws_partition = None
 aws_region = None
 
 # Load the config.  If the file doesn't exist, this will fail silently.
-aws_config = configparser.ConfigParser()
-try:
-    aws_config_fh = open(environ['AWS_CONFIG_FILE'],
-        mode='a+t',
-        encoding='utf-8',
-    )
-except Exception as e:
-    print(
-        'We were unable to open (or create) the file at path %s.' % environ['AWS_CONFIG_FILE'],
-        'Please check permissions and try again.',
-        'Details: %s' % e,
-        sep="\n"
-    )
-    exit()
-try:
-    fcntl.lockf(aws_config_fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-except OSError:
-    print(
-        'We were unable to get an exclusive lock on %s.' % environ['AWS_CONFIG_FILE'],
-        'Another script may be using this file.',
-        'Please try again later!',
-        sep="\n"
-    )
-    exit()
-aws_config_fh.seek(0, 0)
-aws_config.read_file(
-    f=aws_config_fh,
-    source=environ['AWS_CONFIG_FILE']
-)
+aws_config, aws_config_snapshot = read_config_file('AWS_CONFIG_FILE')
 if 'default' not in aws_config:
     aws_config['default'] = {}
 
@@ -97,18 +123,8 @@ if 'region' in aws_config['default']:
     aws_region = aws_config['default']['region']
 
 # Unfortunately, boto3 doesn't give us human-readable descriptions via API.
-# But, the descriptions are in a JSON file that we can parse!
-# See https://github.com/boto/boto3/issues/1411
-endpoints_list_file = pkg_resources.resource_filename(
-    'botocore',
-    'data/endpoints.json',
-)
-with open(endpoints_list_file, 'r') as endpoints_list_fh:
-    endpoints_list = json.load(endpoints_list_fh)
-partitions_list = endpoints_list['partitions']
-partitions_dict = dict(
-    (partition['partition'], partition) for partition in partitions_list
-)
+# The `regions` module digs them out of botocore, and caches them for us.
+partitions_dict = regions.load_index()
 
 # Make sure our partition is valid
 if aws_partition not in partitions_dict:
@@ -265,18 +281,13 @@ while aws_region is None:
 # Write out any changes
 aws_config['default']['workshop_partition'] = aws_partition
 aws_config['default']['region'] = aws_region
-aws_config_fh.seek(0, 0)
-aws_config_fh.truncate(0)
-aws_config.write(aws_config_fh)
-aws_config_fh.close()
+write_config_file('AWS_CONFIG_FILE', aws_config, aws_config_snapshot)
 
 # Done with the config file!
 del aws_partition
 del aws_region
 del aws_config
-del aws_config_fh
-del endpoints_list_file
-del endpoints_list
+del aws_config_snapshot
 del partitions_list
 del partitions_dict
 del regions_list
@@ -290,35 +301,7 @@ aws_access = None
 aws_secret = None
 
 # Load the config.  If the file doesn't exist, this will fail silently.
-aws_creds = configparser.ConfigParser()
-try:
-    aws_creds_fh = open(environ['AWS_SHARED_CREDENTIALS_FILE'],
-        mode='a+t',
-        encoding='utf-8',
-    )
-except Exception as e:
-    print(
-        'We were unable to open (or create) the file at path %s.' % environ['AWS_SHARED_CREDENTIALS_FILE'],
-        'Please check permissions and try again.',
-        'Details: %s' % e,
-        sep="\n"
-    )
-    exit()
-try:
-    fcntl.lockf(aws_creds_fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-except OSError:
-    print(
-        'We were unable to get an exclusive lock on %s.' % environ['AWS_SHARED_CREDENTIALS_FILE'],
-        'Another script may be using this file.',
-        'Please try again later!',
-        sep="\n"
-    )
-    exit()
-aws_creds_fh.seek(0, 0)
-aws_creds.read_file(
-    f=aws_creds_fh,
-    source=environ['AWS_SHARED_CREDENTIALS_FILE']
-)
+aws_creds, aws_creds_snapshot = read_config_file('AWS_SHARED_CREDENTIALS_FILE')
 if 'default' not in aws_creds:
     aws_creds['default'] = {}
 
@@ -340,18 +323,17 @@ if aws_access is not None:
     ))
     print('Checking credentials…')
     sys.stdout.flush()
-    aws_access_session = boto3.session.Session(
+    aws_access_session = startup.new_session(
         aws_access_key_id = aws_access,
         aws_secret_access_key = aws_secret,
     )
     aws_access_client = aws_access_session.client('ec2')
 
-    # Try to get a list of instances
-    try:
-        aws_access_client.describe_instances()
-    except Exception as e:
+    # Make sure the credentials work, and can do what we need.
+    result = preflight.check_client(aws_access_client, aws_access)
+    if result is not True:
         print('Your credentials are not valid in your current region.')
-        print('Error details: ', e)
+        print('Error details: ', result)
         aws_access = None
         aws_secret = None
 
@@ -403,18 +385,18 @@ while aws_access is None:
     # We have candidate credentials; try to use them!
     print('Checking credentials…')
     sys.stdout.flush()
-    aws_access_session = boto3.session.Session(
+    aws_access_session = startup.new_session(
         aws_access_key_id = aws_access,
         aws_secret_access_key = aws_secret,
     )
     aws_access_client = aws_access_session.client('ec2')
 
-    # Try to get a list of instances.  If it fails, loop around.
-    try:
-        aws_access_client.describe_instances()
-    except Exception as e:
+    # Make sure the credentials work, and can do what we need.
+    # If they don't, loop around.
+    result = preflight.check_client(aws_access_client, aws_access)
+    if result is not True:
         print('Your credentials are not valid in your current region.')
-        print('Error details: ', e)
+        print('Error details: ', result)
         print('Please try again!')
         aws_access = None
         aws_secret = None
@@ -446,18 +428,121 @@ while aws_access is None:
 # Write out any changes
 aws_creds['default']['aws_access_key_id'] = aws_access
 aws_creds['default']['aws_secret_access_key'] = aws_secret
-aws_creds_fh.seek(0, 0)
-aws_creds_fh.truncate(0)
-aws_creds.write(aws_creds_fh)
-aws_creds_fh.close()
+aws_creds_snapshot = write_config_file('AWS_SHARED_CREDENTIALS_FILE', aws_creds, aws_creds_snapshot)
+
+# Workshops can also launch into other AWS accounts (see the `accounts`
+# module).  Each account has a named profile in the credentials file.  Their
+# clients use the default region, from the config we just wrote.
+print('')
+print('Checking other AWS accounts…')
+aws_default_region = startup.new_session().region_name
+
+# Make a small subroutine to check a profile's credentials.
+# Returns True if they work, or a reason (a string) if not.
+def check_profile(access, secret):
+    try:
+        profile_client = startup.new_session(
+            aws_access_key_id = access,
+            aws_secret_access_key = secret,
+            region_name = aws_default_region,
+        ).client('ec2')
+        return preflight.check_client(profile_client, access)
+    except Exception as e:
+        return str(e)
+# Done defining check_profile
+
+# Check the profiles we already have, all at once.
+aws_profiles = list(
+    profile for profile in aws_creds.sections()
+    if profile != 'default'
+)
+with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    profile_results = dict(
+        (profile, executor.submit(
+            check_profile,
+            aws_creds[profile].get('aws_access_key_id'),
+            aws_creds[profile].get('aws_secret_access_key'),
+        ))
+        for profile in aws_profiles
+    )
+    for profile in aws_profiles:
+        result = profile_results[profile].result()
+        if result is True:
+            print('Account profile %s: OK' % (profile,))
+        else:
+            print('Account profile %s: NOT WORKING (%s)' % (profile, result))
+if len(aws_profiles) == 0:
+    print('No other accounts are configured.')
+
+# Let the user add or remove profiles.
+while True:
+    try:
+        response = input('Would you like to add an account (a), remove one (r), or continue (c)? ')
+    except (EOFError, KeyboardInterrupt):
+        response = 'c'
+    if response == 'c':
+        break
+    elif response not in ('a', 'r'):
+        print('Please enter a, r, or c')
+        continue
+
+    # Get the profile name.  Shards refer to it as `PROFILE:REGION`.
+    try:
+        profile = input('Profile name: ').strip()
+    except (EOFError, KeyboardInterrupt):
+        continue
+    if profile == '':
+        continue
+    if (
+        (profile == 'default') or
+        (':' in profile) or
+        (len(profile.split()) != 1)
+    ):
+        print('Please use a name without spaces or colons, other than "default".')
+        continue
+
+    if response == 'r':
+        if profile not in aws_profiles:
+            print('There is no account profile named %s.' % (profile,))
+            continue
+        del aws_creds[profile]
+        aws_creds_snapshot = write_config_file('AWS_SHARED_CREDENTIALS_FILE', aws_creds, aws_creds_snapshot)
+        aws_profiles.remove(profile)
+        print('Removed account profile %s.' % (profile,))
+        continue
+
+    # Get, and check, the new profile's credentials.
+    try:
+        access = input(' Enter an AWS Access Key ID: ')
+        secret = getpass.getpass('Enter the Secret Access Key: ')
+    except (EOFError, KeyboardInterrupt):
+        continue
+    if access == '' or secret == '':
+        continue
+    print('Checking credentials…')
+    sys.stdout.flush()
+    result = check_profile(access, secret)
+    if result is not True:
+        print('Those credentials are not valid in your default region.')
+        print('Error details: ', result)
+        continue
+    aws_creds[profile] = {
+        'aws_access_key_id': access,
+        'aws_secret_access_key': secret,
+    }
+    aws_creds_snapshot = write_config_file('AWS_SHARED_CREDENTIALS_FILE', aws_creds, aws_creds_snapshot)
+    if profile not in aws_profiles:
+        aws_profiles.append(profile)
+    print('Saved account profile %s.' % (profile,))
 
 # Done with the credentials file!
-del aws_creds_fh
+del aws_creds_snapshot
 del aws_creds
 del aws_access
 del aws_secret
 del aws_access_session
 del aws_access_client
+del aws_profiles
 del response
 
 # Check the script config file
@@ -465,36 +550,102 @@ del response
 print('')
 print('Checking script configurations…')
 
-# Load the config.  If the file doesn't exist, this will fail silently.
-config = configparser.ConfigParser()
-try:
-    config_fh = open(environ['CREATE_INSTANCES_CONFIG'],
-        mode='a+t',
-        encoding='utf-8',
-    )
-except Exception as e:
-    print(
-        'We were unable to open (or create) the file at path %s.' % environ['CREATE_INSTANCES_CONFIG'],
-        'Please check permissions and try again.',
-        'Details: %s' % e,
-        sep="\n"
-    )
-    exit()
-try:
-    fcntl.lockf(config_fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-except OSError:
-    print(
-        'We were unable to get an exclusive lock on %s.' % environ['CREATE_INSTANCES_CONFIG'],
-        'Another script may be using this file.',
-        'Please try again later!',
-        sep="\n"
+
+# EC2 clients are shared, one per location (a region, or `profile:region` for
+# another account; see the `accounts` module), by all of the template checks.
+# They come from new sessions, which see the config we just wrote.
+ec2_clients = dict()
+template_session = startup.new_session()
+template_profile_sessions = dict()
+
+# Make a small subroutine to make the EC2 client for a location
+def location_client(location):
+    if location not in ec2_clients:
+        profile, region = accounts.split_location(location)
+        if profile == accounts.DEFAULT_PROFILE:
+            session = template_session
+        else:
+            if profile not in template_profile_sessions:
+                template_profile_sessions[profile] = startup.new_session(
+                    profile_name=profile,
+                )
+            session = template_profile_sessions[profile]
+        ec2_clients[location] = session.client(
+            'ec2',
+            region_name = region
+        )
+    return ec2_clients[location]
+# Done defining location_client
+
+# Make a small subroutine to check a location/template
+def check_template(location, template):
+    try:
+        response = location_client(location).describe_launch_templates(
+            LaunchTemplateIds=[template],
+        )
+        templates.note_defaults(response['LaunchTemplates'])
+        return True
+    except Exception as e:
+        return (False, e)
+# Done defining check_template
+
+# Checking templates is the slow part, so start by reading the config (if the
+# file doesn't exist, it reads as empty), and check every region/template pair
+# at the same time.
+config, config_snapshot = read_config_file('CREATE_INSTANCES_CONFIG')
+
+# Make a small subroutine to list a workshop's location/template pairs: one
+# for each of its shards (see `workshops.workshop_shards`).
+# Returns None if the workshop's settings are missing or broken.
+def workshop_pairs(workshop):
+    try:
+        return list(
+            (location, template)
+            for location, template, weight in workshops.workshop_shards(config, workshop)
+        )
+    except (KeyError, ValueError):
+        return None
+# Done defining workshop_pairs
+
+template_pairs = set()
+for workshop in config.sections():
+    template_pairs.update(workshop_pairs(workshop) or ())
+spinner = Spinner('Checking %d launch template(s) ' % (len(template_pairs),))
+
+# Clients are made here, before the threads start, because making clients
+# from a session is not thread-safe.
+for location in set(pair[0] for pair in template_pairs):
+    try:
+        location_client(location)
+    except Exception:
+        # check_template will try again, and report the problem.
+        pass
+
+template_checks = dict()
+with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    futures = dict(
+        (executor.submit(check_template, region, template), (region, template))
+        for region, template in template_pairs
     )
-    exit()
-config_fh.seek(0, 0)
-config.read_file(
-    f=config_fh,
-    source=environ['CREATE_INSTANCES_CONFIG']
-)
+    for future in concurrent.futures.as_completed(futures):
+        template_checks[futures[future]] = future.result()
+        spinner.next()
+print(' Complete')
+
+
+# Make a small subroutine to look up a location/template check
+# (If the pair wasn't checked above, it is checked now.)
+def template_ok(location, template):
+    if (location, template) not in template_checks:
+        template_checks[(location, template)] = check_template(location, template)
+    return template_checks[(location, template)]
+# Done defining template_ok
+
+# Re-read the config, in case it changed while we were checking.  From here
+# on, we only stop for workshops with problems.  If the config changes again
+# before we write it out, we'll notice (and not overwrite the change).
+if configstore.changed(config_snapshot):
+    config, config_snapshot = read_config_file('CREATE_INSTANCES_CONFIG')
 
 # Go through each workshop in the config file
 # We copy the list before iterating, in case we delete sections.
@@ -523,6 +674,8 @@ for workshop in list(config.sections()):
                 continue
             elif response in ('s', 'd'):
                 break
+            elif not regions.is_valid_region(response):
+                print('"%s" is not an AWS region we know about.' % (response,))
             else:
                 print('Will use region %s' % (response,))
                 config[workshop]['region'] = response
@@ -538,28 +691,11 @@ for workshop in list(config.sections()):
 
     # Check the template
     spinner.next()
-
-    # Make a small subroutine to check a region/template
-    def check_template(region, template):
-        boto3_client = boto3.client(
-            'ec2',
-            region_name = region
-        )
-        try:
-            boto3_client.describe_launch_templates(
-                LaunchTemplateIds=[template],
-            )
-            return True
-        except Exception as e:
-            return (False, e)
-    # Done defining check_template
-
-    # Check the template
     aws_region = config[workshop]['region']
     aws_template = config[workshop]['template'] if 'template' in config[workshop] else None
     if (
         ('template' not in config[workshop]) or
-        (check_template(aws_region, config[workshop]['template']) is not True)
+        (template_ok(aws_region, config[workshop]['template']) is not True)
     ):
         # If we have a problem, first, print a reason
         if 'template' not in config[workshop]:
@@ -606,7 +742,10 @@ for workshop in list(config.sections()):
                     except (EOFError, KeyboardInterrupt):
                         print('Goodbye')
                         exit()
-                    if response != '':
+                    if response != '' and not regions.is_valid_region(response):
+                        print('"%s" is not an AWS region we know about.' % (response,))
+                        response = ''
+                    elif response != '':
                         aws_region = response
 
             # If the response is 't', or no template is set, ask for it.
@@ -729,14 +868,38 @@ for workshop in list(config.sections()):
 print('')
 
 # Write out any changes.  This includes creating a blank config, if needed.
-config_fh.seek(0, 0)
-config_fh.truncate(0)
-config.write(config_fh)
-config_fh.close()
+write_config_file('CREATE_INSTANCES_CONFIG', config, config_snapshot)
+
+# Remember the workshops whose launch templates we just checked, so the other
+# scripts don't need to check them again right away.  A workshop only counts
+# if every one of its shards' templates checked out.
+validated_workshops = list()
+for workshop in config.sections():
+    pairs = workshop_pairs(workshop)
+    if pairs is None:
+        continue
+    bad_pairs = list(
+        (location, template) for location, template in pairs
+        if template_ok(location, template) is not True
+    )
+    if len(bad_pairs) == 0:
+        validated_workshops.append(workshop)
+    elif 'shards' in config[workshop]:
+        for location, template in bad_pairs:
+            print('WARNING: Workshop %s: the launch template %s could not be validated in %s.' % (
+                workshop,
+                template,
+                location,
+            ))
+validation.record(
+    config,
+    validated_workshops,
+    validation.credential_identity(template_session),
+)
 
 # Done with the script config
 del config
-del config_fh
+del config_snapshot
 
 # We're done!
 
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module turns `describe_instances` pages into a stream of small,
+# normalized instance records.  Everything here is a generator: Nothing is
+# fetched until the consumer asks for the next record, and each page of
+# results is thrown away once its records have been handed out.
+
+# First, import modules from the standard library
+import datetime
+import ipaddress
+import queue
+import threading
+
+# Then, import our own stuff
+import accounts
+
+
+# This is the JMESPath projection applied to each page.  It flattens the
+# reservations, and keeps only the fields that our scripts actually use.
+# (botocore compiles the expression once, and applies it to each page.)
+INSTANCE_PROJECTION = (
+    'Reservations[].Instances[].{'
+    'InstanceId: InstanceId, '
+    'State: State.Name, '
+    'PublicIpAddress: PublicIpAddress, '
+    'LaunchTime: LaunchTime, '
+    'InstanceType: InstanceType, '
+    'AvailabilityZone: Placement.AvailabilityZone, '
+    'Tags: Tags'
+    '}'
+)
+
+# The instance states, in the order we like to display them.
+INSTANCE_STATES = (
+    'pending', 'running',
+    'stopping', 'stopped',
+    'shutting-down', 'terminated',
+)
+
+# The states of instances which have not been told to terminate.
+LIVE_STATES = (
+    'pending', 'running',
+    'stopping', 'stopped',
+)
+
+
+# `create_instances` tags each instance with its launch date and time (in UTC),
+# using these formats.
+LAUNCH_DATE_FORMAT = '%Y-%m-%d'
+LAUNCH_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# When streaming from several regions at once, at most this many records are
+# buffered between the regional workers and the consumer.
+region_queue_size = 1000
+
+
+# Build the server-side filter list for a workshop.
+# `workshop` may be a single workshop name, or a list of names.
+# `states` is an iterable of instance state names; use None for all states.
+def workshop_filters(workshop, states=None):
+    if isinstance(workshop, str):
+        workshop = [workshop]
+    filters = [
+        {
+            'Name': 'tag:Workshop',
+            'Values': list(workshop),
+        },
+    ]
+    if states is not None:
+        filters.append({
+            'Name': 'instance-state-name',
+            'Values': list(states),
+        })
+    return filters
+
+
+# Yield raw projected instances, page by page.
+# Each yielded item is a dict with the keys from INSTANCE_PROJECTION.
+def iter_projected(ec2_client, filters=None, instance_ids=None, page_size=None):
+    paginate_args = dict()
+    if filters is not None:
+        paginate_args['Filters'] = filters
+    if instance_ids is not None:
+        paginate_args['InstanceIds'] = list(instance_ids)
+    if page_size is not None:
+        paginate_args['PaginationConfig'] = {'PageSize': page_size}
+
+    page_iterator = ec2_client.get_paginator('describe_instances').paginate(
+        **paginate_args
+    )
+
+    # `search` applies the projection to one page at a time, and yields the
+    # resulting items as it goes.
+    for instance in page_iterator.search(INSTANCE_PROJECTION):
+        if instance is not None:
+            yield instance
+
+
+# dateutil is installed by `finish_install`, alongside boto3.  It is imported
+# by `local_tz` (the first time it is called), to keep start-up quick.
+_local_tz = None
+_local_tz_lock = threading.Lock()
+
+
+# Get the local time zone.
+def local_tz():
+    global _local_tz
+    with _local_tz_lock:
+        if _local_tz is None:
+            import dateutil.tz
+            _local_tz = dateutil.tz.gettz()
+        return _local_tz
+
+
+# Turn one projected instance into a normalized record.
+# The public IP becomes an ipaddress object (or None), the launch time is
+# converted to the local time zone, and the tags become a dict.  The record
+# also says which region (and account) it came from, and which workshop it
+# belongs to.
+def normalize(instance, region=None, tz=None, account=accounts.DEFAULT_PROFILE):
+    if tz is None:
+        tz = local_tz()
+
+    public_ip = instance.get('PublicIpAddress')
+    if public_ip is not None:
+        public_ip = ipaddress.IPv4Address(public_ip)
+
+    tags = dict(
+        (tag['Key'], tag['Value']) for tag in (instance.get('Tags') or ())
+    )
+
+    return {
+        'InstanceId': instance['InstanceId'],
+        'State': instance['State'],
+        'PublicIpAddress': public_ip,
+        'LaunchTime': instance['LaunchTime'].astimezone(tz),
+        'InstanceType': instance.get('InstanceType'),
+        'AvailabilityZone': instance.get('AvailabilityZone'),
+        'Tags': tags,
+        'Workshop': tags.get('Workshop'),
+        'Region': region,
+        'Account': account,
+    }
+
+
+# Work out when an instance was launched by `create_instances`.
+# The LaunchDateTime tag is used if it is present (and parseable), because EC2's
+# own launch time changes whenever an instance is stopped and started.
+# Returns a timezone-aware datetime.
+def launched_at(instance):
+    tag_value = instance['Tags'].get('LaunchDateTime')
+    if tag_value is not None:
+        try:
+            return datetime.datetime.strptime(
+                tag_value,
+                LAUNCH_DATETIME_FORMAT,
+            ).replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            pass
+    return instance['LaunchTime']
+
+
+# Yield normalized instance records.  This is the main entry point.
+# `account` is the credential profile that `ec2_client` uses.
+def iter_instances(ec2_client, filters=None, instance_ids=None, page_size=None, account=accounts.DEFAULT_PROFILE):
+    tz = local_tz()
+    region = ec2_client.meta.region_name
+    for instance in iter_projected(
+        ec2_client,
+        filters=filters,
+        instance_ids=instance_ids,
+        page_size=page_size,
+    ):
+        yield normalize(instance, region=region, tz=tz, account=account)
+
+
+# A convenience wrapper, to stream all of a workshop's instances.
+def iter_workshop_instances(ec2_client, workshop, states=None, page_size=None, account=accounts.DEFAULT_PROFILE):
+    return iter_instances(
+        ec2_client,
+        filters=workshop_filters(workshop, states),
+        page_size=page_size,
+        account=account,
+    )
+
+
+# Stream the instances of several workshops, spread over several regions.
+# `ec2_clients` maps region names to EC2 clients, and `workshops_by_region`
+# maps region names to lists of workshop names.  Each region is queried in its
+# own thread, and records are yielded as soon as any region's page arrives.
+# The region names may be locations (see the `accounts` module), so this also
+# merges several accounts into one stream.
+# If a region fails, the exception is raised once the other regions finish.
+def iter_regions_instances(ec2_clients, workshops_by_region, states=None, page_size=None):
+    # With only one region, there is no need for threads.
+    if len(workshops_by_region) == 1:
+        region, region_workshops = list(workshops_by_region.items())[0]
+        for instance in iter_workshop_instances(
+            ec2_clients[region],
+            region_workshops,
+            states=states,
+            page_size=page_size,
+            account=accounts.split_location(region)[0],
+        ):
+            yield instance
+        return
+
+    # The queue is bounded, so a slow consumer holds back the workers.
+    # The stop event lets the workers give up if the consumer goes away.
+    results = queue.Queue(maxsize=region_queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker(region):
+        try:
+            for instance in iter_workshop_instances(
+                ec2_clients[region],
+                workshops_by_region[region],
+                states=states,
+                page_size=page_size,
+                account=accounts.split_location(region)[0],
+            ):
+                if not put(instance):
+                    return
+        except Exception as e:
+            put((region, e))
+        finally:
+            put(done)
+
+    threads = list(
+        threading.Thread(target=worker, args=(region,), daemon=True)
+        for region in workshops_by_region.keys()
+    )
+    for thread in threads:
+        thread.start()
+
+    # Hand out records until every worker has finished.
+    errors = list()
+    try:
+        remaining = len(threads)
+        while remaining > 0:
+            item = results.get()
+            if item is done:
+                remaining = remaining - 1
+            elif isinstance(item, tuple):
+                errors.append(item)
+            else:
+                yield item
+    finally:
+        stop.set()
+
+    if len(errors) > 0:
+        raise errors[0][1]
+
+
+# Yield just the instance IDs matching a set of filters.
+# This skips the normalization work, for callers that only need the IDs.
+def iter_instance_ids(ec2_client, filters):
+    page_iterator = ec2_client.get_paginator('describe_instances').paginate(
+        Filters=filters,
+    )
+    for instance_id in page_iterator.search('Reservations[].Instances[].InstanceId'):
+        yield instance_id
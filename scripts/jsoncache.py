@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module reads and writes our JSON caches: The region index, the
+# validation cache, the launch template cache, and the boot-time history.
+#
+# The caches live in the venv (sys.prefix), so a new venv starts out with empty
+# caches.  Like our config files (see `configstore`), each cache has a lock
+# file next to it.  Reads take a brief shared lock.  Updates hold an exclusive
+# lock from reading the cache until the new copy is renamed into place, so two
+# scripts (or two threads) changing the same cache don't lose each other's
+# changes.
+#
+# A cache is only a cache: A missing or broken cache reads as empty, and if a
+# cache can't be written (for example, the venv is read-only), that's OK.
+
+# First, import modules from the standard library
+import contextlib
+import fcntl
+import json
+import os
+import sys
+
+# Then, import our own stuff
+import configstore
+
+
+# Work out where a cache lives.
+def path(filename):
+    return os.path.join(sys.prefix, filename)
+
+
+# Read a cache, without locking it.  See `read` for details.
+def _read(cache_path, valid=None):
+    try:
+        with open(cache_path, 'r') as cache_fh:
+            data = json.load(cache_fh)
+    except (OSError, ValueError):
+        return None
+    if valid is not None and not valid(data):
+        return None
+    return data
+
+
+# Write a cache, without locking it.  We write to a temporary file and rename
+# it, so another script never sees a half-written cache.
+def _write(cache_path, data):
+    try:
+        temp_path = '%s.%d' % (cache_path, os.getpid())
+        with open(temp_path, 'w') as cache_fh:
+            json.dump(data, cache_fh, default=str)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+
+
+# Read a cache.  `valid` (if given) is called with the data, and returns False
+# if the data isn't what we expect.
+# Returns the data, or None if the cache is missing, broken, or not valid.
+def read(cache_path, valid=None):
+    try:
+        with configstore.locked(cache_path, fcntl.LOCK_SH):
+            return _read(cache_path, valid)
+    except OSError:
+        # We can't make the lock file, so nobody can be writing the cache.
+        return _read(cache_path, valid)
+
+
+# Replace a cache's contents.
+def write(cache_path, data):
+    try:
+        with configstore.locked(cache_path, fcntl.LOCK_EX):
+            _write(cache_path, data)
+    except OSError:
+        pass
+
+
+# Change a cache, for a `with` block.  The cache's data is yielded (`empty` is
+# called to make new data, if the cache is missing, broken, or not valid), and
+# whatever it holds at the end of the block is written out.  If the block
+# raises an exception, nothing is written.
+@contextlib.contextmanager
+def update(cache_path, empty, valid=None):
+    with contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(configstore.locked(cache_path, fcntl.LOCK_EX))
+            writable = True
+        except OSError:
+            writable = False
+        data = _read(cache_path, valid)
+        if data is None:
+            data = empty()
+        yield data
+        if writable:
+            _write(cache_path, data)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module launches instances, and waits for them to be ready to use.
+#
+# A launch may be split into shards (for example, one per region), each with
+# its own EC2 client.  Shards are launched at the same time, and each shard is
+# polled in its own thread.  Instances are tracked by ID; `instance_shards`
+# maps each instance ID to its shard's key, and `ec2_clients` maps each shard
+# key to the client to use.
+#
+# Waiting happens in two stages, just like it always has: First, we wait for
+# instances to leave the `pending` state; then, we wait for EC2's instance and
+# system status checks to pass.
+
+# First, import modules from the standard library
+import concurrent.futures
+import random
+import threading
+import time
+
+# Then, import our own stuff
+import inventory
+
+
+# How long (in seconds) each stage may take, by default.
+default_timeout = 600
+
+# These errors happen when we ask about an instance too soon after launching
+# it.  They clear up on their own, so we just ask again later.
+not_yet_errors = (
+    'InvalidInstanceID.NotFound',
+)
+
+
+# Split a count into parts, in proportion to some weights.
+# Leftovers go to the parts that were closest to getting one more.
+# Returns a list of counts, in the same order as the weights.
+def split_count(count, weights):
+    total = sum(weights)
+    if total <= 0:
+        return list(0 for weight in weights)
+    shares = list(count * weight / total for weight in weights)
+    counts = list(int(share) for share in shares)
+    leftover = count - sum(counts)
+    by_remainder = sorted(
+        range(0, len(weights)),
+        key=lambda i: shares[i] - counts[i],
+        reverse=True,
+    )
+    for i in by_remainder[:leftover]:
+        counts[i] = counts[i] + 1
+    return counts
+
+
+# The tags `create_instances` puts on each instance, with its launch date and
+# time (in UTC).  These survive stops and starts, unlike EC2's own launch
+# time, so the reaper uses them to work out an instance's age.
+def launch_tags(launch_datetime):
+    return [
+        {
+            'Key': 'LaunchDate',
+            'Value': launch_datetime.strftime(inventory.LAUNCH_DATE_FORMAT),
+        },
+        {
+            'Key': 'LaunchDateTime',
+            'Value': launch_datetime.strftime(inventory.LAUNCH_DATETIME_FORMAT),
+        },
+    ]
+
+
+# Launch one shard's instances, in a single call.
+# Returns the list of instances (from the `run_instances` response).
+def run_shard(ec2_client, template, count, tags):
+    response = ec2_client.run_instances(
+        LaunchTemplate={
+            'LaunchTemplateId': template,
+        },
+        MinCount=count,
+        MaxCount=count,
+        TagSpecifications=({
+            'ResourceType': 'instance',
+            'Tags': list(tags),
+        },),
+    )
+    return response['Instances']
+
+
+# Launch several shards at the same time.
+# `plan` is a list of (shard key, template, count) tuples.  Shards with a
+# count of zero are skipped.  `tags` are put on every instance.
+# Returns a tuple of three dicts: Instance IDs to instances, instance IDs to
+# shard keys, and (shard key, template) tuples to exceptions (for shards which
+# failed to launch).
+def launch_shards(ec2_clients, plan, tags):
+    instances = dict()
+    instance_shards = dict()
+    errors = dict()
+
+    plan = list(shard for shard in plan if shard[2] > 0)
+    if len(plan) == 0:
+        return (instances, instance_shards, errors)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(plan)) as executor:
+        futures = dict(
+            (executor.submit(
+                run_shard,
+                ec2_clients[shard_key],
+                template,
+                count,
+                tags,
+            ), (shard_key, template))
+            for shard_key, template, count in plan
+        )
+        for future in concurrent.futures.as_completed(futures):
+            shard_key, template = futures[future]
+            try:
+                for instance in future.result():
+                    instances[instance['InstanceId']] = instance
+                    instance_shards[instance['InstanceId']] = shard_key
+            except Exception as e:
+                errors[(shard_key, template)] = e
+
+    return (instances, instance_shards, errors)
+
+
+# Group instance IDs by shard key.
+def group_by_shard(instance_ids, instance_shards):
+    ids_by_shard = dict()
+    for instance_id in instance_ids:
+        ids_by_shard.setdefault(instance_shards[instance_id], list()).append(instance_id)
+    return ids_by_shard
+
+
+# Run a polling function for each shard, each in its own thread.
+# `poll_shard` is called with a shard's client and instance IDs, and returns a
+# tuple of lists.  The lists from every shard are merged, and returned.
+def poll_shards(ec2_clients, instance_ids, instance_shards, poll_shard):
+    ids_by_shard = group_by_shard(instance_ids, instance_shards)
+    if len(ids_by_shard) == 0:
+        return None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ids_by_shard)) as executor:
+        futures = list(
+            executor.submit(poll_shard, ec2_clients[shard_key], shard_ids)
+            for shard_key, shard_ids in ids_by_shard.items()
+        )
+        merged = None
+        for future in futures:
+            result = future.result()
+            if merged is None:
+                merged = tuple(list() for part in result)
+            for merged_part, part in zip(merged, result):
+                merged_part.extend(part)
+    return merged
+
+
+# Wrap a callback so that it is only ever called by one thread at a time.
+# (Progress bars don't like being updated from several threads at once.)
+def serialized(callback):
+    if callback is None:
+        return lambda *args: None
+    lock = threading.Lock()
+    def call(*args):
+        with lock:
+            callback(*args)
+    return call
+
+
+# Wait for instances to leave the `pending` state.
+# `instances` (a dict of instance IDs to instances) is updated as we go.
+# `on_done` (if provided) is called with each instance ID, as it leaves
+# `pending`, and `initial_delay` is how long to wait before the first check.
+# Returns a list of the instance IDs which were still pending at the timeout.
+def wait_for_running(ec2_clients, instances, instance_shards, timeout=default_timeout, on_done=None, initial_delay=3):
+    # botocore comes along with boto3.  It is imported here (and not at the
+    # top) so that importing this module doesn't slow down start-up.
+    from botocore.exceptions import ClientError
+
+    on_done = serialized(on_done)
+
+    def poll_shard(ec2_client, instance_ids):
+        instances_to_check = list(instance_ids)
+
+        # We just kicked off the launch, so wait a little before checking.
+        time.sleep(initial_delay)
+
+        # We'll be governed by the timeout for giving up on updates.
+        wait_starttime = time.monotonic()
+        while (
+            (len(instances_to_check) > 0) and
+            (time.monotonic() - wait_starttime <= timeout)
+        ):
+            try:
+                page_iterator = ec2_client.get_paginator('describe_instances').paginate(
+                    InstanceIds=instances_to_check,
+                )
+                for page in page_iterator:
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            # Update our copy of the instance's details
+                            instances[instance['InstanceId']] = instance
+
+                            # Is the instance state no longer 'pending'?
+                            if instance['State']['Code'] != 0:
+                                instances_to_check.remove(instance['InstanceId'])
+                                on_done(instance['InstanceId'])
+            except ClientError as e:
+                if e.response['Error']['Code'] not in not_yet_errors:
+                    raise
+
+            # If we have any items left to check, wait zero to 15 seconds
+            # before trying again.
+            if len(instances_to_check) > 0:
+                time.sleep(random.randrange(0, 1500, 1) / 100)
+
+        return (instances_to_check,)
+
+    result = poll_shards(ec2_clients, list(instances.keys()), instance_shards, poll_shard)
+    if result is None:
+        return list()
+    return result[0]
+
+
+# Wait for instances to pass EC2's instance and system status checks.
+# `on_done` (if provided) is called with each instance ID, as it passes (or
+# fails).
+# Returns a tuple of two lists: The instance IDs which failed (stopped running,
+# or failed a check), and the instance IDs which were still not ready at the
+# timeout.
+def wait_for_status(ec2_clients, instance_ids, instance_shards, timeout=default_timeout, on_done=None):
+    on_done = serialized(on_done)
+
+    def poll_shard(ec2_client, shard_instance_ids):
+        instances_to_check = list(shard_instance_ids)
+        failed_instances = list()
+
+        # We'll be governed by the timeout for giving up on updates.
+        wait_starttime = time.monotonic()
+        while (
+            (len(instances_to_check) > 0) and
+            (time.monotonic() - wait_starttime <= timeout)
+        ):
+            page_iterator = ec2_client.get_paginator('describe_instance_status').paginate(
+                InstanceIds=instances_to_check,
+                IncludeAllInstances=True,
+            )
+            for page in page_iterator:
+                for instance in page['InstanceStatuses']:
+                    # Is the instance state no longer running?
+                    # Is the instance impaired or failed?
+                    # Then we're done with it for now.
+                    if (
+                        (instance['InstanceState']['Name'] != 'running') or
+                        (instance['InstanceStatus']['Status'] == 'impaired') or
+                        (instance['SystemStatus']['Status'] == 'failed')
+                    ):
+                        failed_instances.append(instance['InstanceId'])
+                        instances_to_check.remove(instance['InstanceId'])
+                        on_done(instance['InstanceId'])
+
+                    # If the instance and system status are good, then awesome!
+                    elif (
+                        (instance['InstanceStatus']['Status'] == 'ok') and
+                        (instance['SystemStatus']['Status'] == 'ok')
+                    ):
+                        instances_to_check.remove(instance['InstanceId'])
+                        on_done(instance['InstanceId'])
+
+                    # For all other statuses, we'll need to check again.
+
+            # If we have any items left to check, wait zero to 5 seconds
+            # before trying again.
+            if len(instances_to_check) > 0:
+                time.sleep(random.randrange(0, 500, 1) / 100)
+
+        return (failed_instances, instances_to_check)
+
+    result = poll_shards(ec2_clients, instance_ids, instance_shards, poll_shard)
+    if result is None:
+        return (list(), list())
+    return result
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module checks that our credentials work, and that they are allowed to
+# do what a script is about to do, as cheaply as possible.
+#
+# Each check is an EC2 call made with `DryRun=True`.  EC2 checks the
+# credentials and permissions, and then stops: Nothing is listed, launched, or
+# terminated.  A permitted call fails with `DryRunOperation`; a forbidden one
+# fails with `UnauthorizedOperation`.  Any other error still proves that the
+# credentials are good (for example, a made-up instance ID is "not found").
+#
+# Checks run concurrently, and results are kept for the rest of the session,
+# keyed by credentials, region, and call.
+
+# First, import modules from the standard library
+import concurrent.futures
+import json
+import threading
+
+
+# The calls that every script needs, with the parameters to use for a dry run.
+# (The instance ID is well-formed, but will never exist.)
+basic_checks = (
+    ('describe_instances', dict()),
+    ('describe_launch_templates', dict()),
+    ('terminate_instances', {'InstanceIds': ['i-00000000000000000']}),
+)
+
+# The calls needed by scripts that only look.
+read_checks = (
+    ('describe_instances', dict()),
+)
+
+# These error codes mean the credentials (or their permissions) are bad.
+auth_errors = (
+    'AuthFailure',
+    'Blocked',
+    'ExpiredToken',
+    'InvalidClientTokenId',
+    'OptInRequired',
+    'RequestExpired',
+    'SignatureDoesNotMatch',
+    'UnauthorizedOperation',
+    'UnrecognizedClientException',
+)
+
+# How many checks may be in flight at once.
+max_workers = 8
+
+# Results so far, keyed by (identity, region, operation, parameters).
+_results = dict()
+_results_lock = threading.Lock()
+
+
+# Do one dry-run call, without looking at the cache.
+# Returns True if the call is allowed, or a reason (a string) if not.
+def dry_run(ec2_client, operation, params):
+    # botocore comes along with boto3.  It is imported here (and not at the
+    # top) so that importing this module doesn't slow down start-up.
+    from botocore.exceptions import ClientError
+
+    try:
+        getattr(ec2_client, operation)(DryRun=True, **params)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code in auth_errors:
+            return '%s: %s' % (code, e.response['Error'].get('Message', ''))
+        return True
+    except Exception as e:
+        return str(e)
+
+    # Some calls ignore DryRun, and simply work.  That's fine, too.
+    return True
+
+
+# Run some checks, concurrently, using (and filling) the session cache.
+# `checks` is a list of (ec2_client, operation, params) tuples, and `identity`
+# says whose credentials the clients use (see `validation.credential_identity`).
+# Returns a list of results (True, or a reason), in the same order as `checks`.
+def run_checks(checks, identity):
+    keys = list(
+        (
+            identity,
+            ec2_client.meta.region_name,
+            operation,
+            json.dumps(params, sort_keys=True),
+        )
+        for ec2_client, operation, params in checks
+    )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for key, (ec2_client, operation, params) in zip(keys, checks):
+            with _results_lock:
+                if key in _results or key in futures:
+                    continue
+            futures[key] = executor.submit(dry_run, ec2_client, operation, params)
+        for key, future in futures.items():
+            result = future.result()
+            with _results_lock:
+                _results[key] = result
+
+    with _results_lock:
+        return list(_results[key] for key in keys)
+
+
+# Check one client against the basic checks, plus any extra checks.
+# `extra_checks` is a list of (operation, params) tuples.
+# Returns True if everything passed, or the first reason (a string) if not.
+def check_client(ec2_client, identity, extra_checks=()):
+    checks = list(
+        (ec2_client, operation, params)
+        for operation, params in tuple(basic_checks) + tuple(extra_checks)
+    )
+    for (ec2_client, operation, params), result in zip(
+        checks,
+        run_checks(checks, identity),
+    ):
+        if result is not True:
+            return '%s was refused (%s)' % (operation, result)
+    return True
@@ -0,0 +1,249 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This script turns on EBS Fast Snapshot Restore for a workshop's AMI, in the
+# Availability Zones the workshop launches into, and waits for it to be ready.
+# Run it before class, so instances boot (and pass status checks) quickly.
+# With `--disable`, it turns Fast Snapshot Restore off again; so does
+# `teardown_instances --disable-fast-restore`.  See the `fastrestore` module.
+
+# First, import modules from the standard library
+import argparse
+import concurrent.futures
+import sys
+from sys import exit
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    from progress.bar import Bar
+    import accounts
+    import fastrestore
+    import launch
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Turn on Fast Snapshot Restore for a workshop\'s AMI, before class.',
+)
+parser.add_argument('workshop',
+    nargs='?',
+    help='The workshop to pre-warm.  If not given, you will be asked.',
+)
+parser.add_argument('--disable',
+    action='store_true',
+    help='Turn Fast Snapshot Restore off, instead of on.',
+)
+parser.add_argument('--no-wait',
+    action='store_true',
+    help='Do not wait for Fast Snapshot Restore to finish enabling.',
+)
+parser.add_argument('--timeout',
+    type=int,
+    default=fastrestore.default_timeout // 60,
+    help='How long to wait, in minutes.  Default: %(default)s',
+)
+parser.add_argument('--yes',
+    action='store_true',
+    help='Do not ask for confirmation.',
+)
+args = parser.parse_args()
+
+print('Welcome to Workshop Pre-Warmer')
+
+# Start talking to AWS in the background, while we read the config and the
+# user reads the menu.
+startup.start_session()
+
+# Load our config files
+with startup.phase('Reading configuration'):
+    config, config_snapshot = workshops.load_config()
+
+# Build our list of usable workshops
+with startup.phase('Checking workshops'):
+    usable_workshops = workshops.check_workshops(config)
+
+# Use the workshop from the command line, or ask for one.
+if args.workshop is not None:
+    if args.workshop not in usable_workshops:
+        print('The workshop "%s" is not configured (or is not usable).' % (
+            args.workshop,
+        ))
+        print('Re-run `finish_install` to fix.')
+        exit()
+    chosen_config = args.workshop
+else:
+    with startup.phase('Waiting for a choice'):
+        chosen_config = workshops.choose_workshop(
+            usable_workshops,
+            'The following workshops can be pre-warmed:',
+        )
+    if chosen_config is None:
+        print('Goodbye')
+        exit()
+del usable_workshops
+
+# A workshop with shards has a launch template in each of its regions.
+shards = workshops.workshop_shards(config, chosen_config)
+
+# Now that we know the workshop, check connectivity (and our permissions in
+# the workshop's region(s)).
+with startup.phase('Talking to AWS'):
+    workshops.check_connectivity(dict(
+        (region, ()) for region, template, weight in shards
+    ))
+
+
+# Follow each launch template to its snapshots and zones, all at once.
+print('Looking up the AMI(s) of workshop %s… ' % (chosen_config,), end='')
+sys.stdout.flush()
+resolved = dict()
+errors = dict()
+with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    futures = dict(
+        (executor.submit(
+            fastrestore.resolve,
+            accounts.client(region),
+            template,
+        ), (region, template))
+        for region, template, weight in shards
+    )
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            resolved[futures[future]] = future.result()
+        except Exception as e:
+            errors[futures[future]] = e
+if len(errors) > 0:
+    print('ERROR')
+    for (region, template), e in sorted(errors.items()):
+        print('  %s in %s: %s' % (template, region, e))
+    exit(1)
+print('Complete')
+
+# Say what we found, and confirm.
+print('')
+print('Fast Snapshot Restore will be turned %s for:' % (
+    'off' if args.disable else 'on',
+))
+pair_count = 0
+for (region, template), found in sorted(resolved.items()):
+    print('  %s (template %s, AMI %s)' % (region, template, found['image']))
+    print('    Snapshots: %s' % (', '.join(found['snapshots']) or '(none)',))
+    print('    Zones:     %s' % (', '.join(found['zones']),))
+    pair_count = pair_count + len(found['snapshots']) * len(found['zones'])
+if pair_count == 0:
+    print('There is nothing to do.')
+    print('Goodbye')
+    exit()
+if not args.disable:
+    print('')
+    print('Fast Snapshot Restore is billed by the hour, for each of these %d snapshot/zone pair(s).' % (
+        pair_count,
+    ))
+    print('Remember to turn it off after class (with `--disable`, or `teardown_instances --disable-fast-restore`).')
+if not args.yes:
+    response = ''
+    while response not in ('y', 'n'):
+        try:
+            response = input('Are you sure (y/n)? ')
+        except (EOFError, KeyboardInterrupt):
+            response = 'n'
+    if response == 'n':
+        print('Goodbye')
+        exit()
+
+# Make the requests, one per template, all at once.
+print('Requesting Fast Snapshot Restore changes… ', end='')
+sys.stdout.flush()
+refused = dict()
+with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    futures = dict(
+        (executor.submit(
+            fastrestore.set_fast_restore,
+            accounts.client(region),
+            found['snapshots'],
+            found['zones'],
+            enable=not args.disable,
+        ), region)
+        for (region, template), found in resolved.items()
+    )
+    for future in concurrent.futures.as_completed(futures):
+        region = futures[future]
+        try:
+            for (snapshot_id, zone), reason in future.result().items():
+                refused[(region, snapshot_id, zone)] = reason
+        except Exception as e:
+            refused[(region, '(all)', '(all)')] = str(e)
+if len(refused) > 0:
+    print('WARNING')
+    for (region, snapshot_id, zone), reason in sorted(refused.items()):
+        print('  %s in %s (%s): %s' % (snapshot_id, zone, region, reason))
+else:
+    print('Complete')
+
+if args.disable or args.no_wait:
+    print('Goodbye')
+    exit()
+
+# Wait for everything to be enabled.  Each template is watched in its own
+# thread, so progress bar updates are serialized.
+progress_bar = Bar(
+    'Waiting for Fast Snapshot Restore…',
+    max=pair_count,
+)
+print('')
+print('(This can take a while: about an hour for each TiB of snapshot.)')
+progress_bar.start()
+sys.stdout.flush()
+on_enabled = launch.serialized(lambda pair: progress_bar.next())
+not_ready = dict()
+with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    futures = dict(
+        (executor.submit(
+            fastrestore.wait_for_fast_restore,
+            accounts.client(region),
+            found['snapshots'],
+            found['zones'],
+            timeout=args.timeout * 60,
+            on_enabled=on_enabled,
+        ), region)
+        for (region, template), found in resolved.items()
+    )
+    for future in concurrent.futures.as_completed(futures):
+        region = futures[future]
+        try:
+            for (snapshot_id, zone), state in future.result().items():
+                not_ready[(region, snapshot_id, zone)] = state
+        except Exception as e:
+            not_ready[(region, '(all)', '(all)')] = str(e)
+progress_bar.finish()
+
+# Report what didn't finish
+for (region, snapshot_id, zone), state in sorted(not_ready.items()):
+    print('WARNING: %s in %s (%s) is not ready (last state: %s)' % (
+        snapshot_id,
+        zone,
+        region,
+        state,
+    ))
+if len(not_ready) == 0:
+    print('Fast Snapshot Restore is ready for workshop %s.' % (chosen_config,))
+print('Goodbye')
+exit()
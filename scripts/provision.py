@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module holds the pieces shared by `create_workshop` and
+# `destroy_workshop`: Running a dependency graph of steps, and tagging (and
+# finding) a workshop's resources.
+#
+# A graph is a dict mapping each node's name to a tuple of two things: A tuple
+# of the names of the nodes it depends on, and a function.  The function is
+# called (with a dict of the results of every node that has finished so far)
+# once all of its dependencies have finished, and its return value is the
+# node's result.  Nodes whose dependencies are done run concurrently.
+#
+# Every resource we make is tagged with the workshop's name (the `Workshop`
+# tag, which is also what the instance scripts look for), and with the node
+# that made it (the `WorkshopResource` tag).  Running `create_workshop` again
+# finds the resources by their tags, instead of making new ones.
+
+# First, import modules from the standard library
+import concurrent.futures
+import random
+import re
+import time
+
+
+# How many nodes may run at once.
+# (boto3 clients are thread-safe, so all nodes share one client.)
+max_workers = 8
+
+# How long (in seconds) to keep retrying a step that EC2 refuses because
+# something still depends on the resource, and the longest wait between tries.
+dependency_timeout = 600
+dependency_max_delay = 30
+
+# The tags we use to find a workshop's resources.
+WORKSHOP_TAG = 'Workshop'
+RESOURCE_TAG = 'WorkshopResource'
+
+
+# A node was not run, because one of its dependencies failed.
+class DependencyFailed(Exception):
+    pass
+
+
+# Run a graph (see above).  `on_node_done` (if provided) is called with each
+# node's name and result (or exception), as each node finishes.
+# Returns a tuple of two dicts: The first maps node names to results, and the
+# second maps the names of failed (or skipped) nodes to exceptions.
+def run_graph(graph, on_node_done=None):
+    results = dict()
+    failures = dict()
+    pending = dict(graph)
+
+    # Make sure every dependency is in the graph, so nothing waits forever.
+    for name, (dependencies, function) in graph.items():
+        for dependency in dependencies:
+            if dependency not in graph:
+                raise ValueError('Node %s depends on unknown node %s' % (
+                    name,
+                    dependency,
+                ))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = dict()
+        while len(pending) > 0 or len(running) > 0:
+            # Skip nodes that depend on a failure, and start nodes that are
+            # ready.  Skipping a node may make others skippable, so repeat.
+            progress = True
+            while progress:
+                progress = False
+                for name in list(pending.keys()):
+                    dependencies, function = pending[name]
+                    failed = list(
+                        dependency for dependency in dependencies
+                        if dependency in failures
+                    )
+                    if len(failed) > 0:
+                        del pending[name]
+                        failures[name] = DependencyFailed(
+                            'Not attempted, because %s failed' % (', '.join(failed),)
+                        )
+                        if on_node_done is not None:
+                            on_node_done(name, failures[name])
+                        progress = True
+                    elif all(dependency in results for dependency in dependencies):
+                        del pending[name]
+                        running[executor.submit(function, dict(results))] = name
+
+            # If nothing is running now, whatever is left can never run.
+            if len(running) == 0:
+                for name in pending:
+                    failures[name] = DependencyFailed('Dependency cycle')
+                break
+
+            done, not_done = concurrent.futures.wait(
+                running,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    outcome = results[name]
+                except Exception as e:
+                    failures[name] = e
+                    outcome = e
+                if on_node_done is not None:
+                    on_node_done(name, outcome)
+
+    return (results, failures)
+
+
+# Check if an exception is an EC2 error with one of the given codes.
+def is_error(e, *codes):
+    return (
+        hasattr(e, 'response') and
+        e.response.get('Error', dict()).get('Code') in codes
+    )
+
+
+# Call a function, retrying (with backoff and jitter) for as long as EC2 says
+# that something still depends on the resource.  That happens a lot during a
+# teardown: For example, a subnet can't be deleted until EC2 has finished
+# cleaning up the network interfaces of the instances that were in it.
+def retry_dependency(function, *args, **kwargs):
+    delay = 1
+    start_time = time.monotonic()
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            if (
+                (not is_error(e, 'DependencyViolation', 'ResourceInUse')) or
+                (time.monotonic() - start_time > dependency_timeout)
+            ):
+                raise
+        time.sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, dependency_max_delay)
+
+
+# The tags for one of a workshop's resources.
+def resource_tags(workshop, resource):
+    return [
+        {'Key': WORKSHOP_TAG, 'Value': workshop},
+        {'Key': RESOURCE_TAG, 'Value': resource},
+        {'Key': 'Name', 'Value': '%s-%s' % (workshop, resource)},
+    ]
+
+
+# A TagSpecifications list, for tagging a resource as it is made.
+def tag_specifications(resource_type, workshop, resource):
+    return [{
+        'ResourceType': resource_type,
+        'Tags': resource_tags(workshop, resource),
+    }]
+
+
+# Filters for finding a workshop's resources.  If `resource` is None, every
+# resource in the workshop is found.
+def resource_filters(workshop, resource=None):
+    filters = [{
+        'Name': 'tag:%s' % (WORKSHOP_TAG,),
+        'Values': [workshop],
+    }]
+    if resource is not None:
+        filters.append({
+            'Name': 'tag:%s' % (RESOURCE_TAG,),
+            'Values': [resource],
+        })
+    return filters
+
+
+# Get the value of a tag, from a resource description.
+def get_tag(resource, key):
+    for tag in resource.get('Tags', ()):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+# The name we give a workshop's launch template (and security group).
+# Launch template names are limited to a few characters, so anything else
+# becomes a dash.
+def launch_template_name(workshop):
+    return 'workshop-%s' % (re.sub(r'[^a-zA-Z0-9().\-/_]', '-', workshop),)
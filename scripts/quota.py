@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module works out how many instances we can launch right now, before
+# `run_instances` finds out the hard way.
+#
+# EC2 limits On-Demand instances by the number of vCPUs running in each
+# "family group" (for example, the standard A, C, D, H, I, M, R, T, and Z
+# families share one limit).  So, for each region (and account) we launch
+# into, we read the vCPU limit from Service Quotas, and add up the vCPUs of
+# the instances already running in the same family group.  Older accounts
+# are limited by instance count instead; we read that from the
+# `max-instances` account attribute, but only use it if we couldn't read a
+# vCPU limit, because EC2 no longer enforces it in accounts that have them.
+#
+# The "headroom" of a location is a dict with the free vCPUs (`vcpus`) and
+# free instances (`instances`).  Either may be None, meaning "no known limit".
+#
+# Elastic IPs have a limit of their own (see `suspend_workshop --keep-ips`).
+
+# First, import modules from the standard library
+import concurrent.futures
+import re
+
+# Then, import our own stuff
+import accounts
+import templates
+
+
+# The On-Demand vCPU quotas, by instance family prefix.
+# Families not listed here have no limit we know about.
+vcpu_quota_codes = {
+    'standard': 'L-1216C47A',
+    'f': 'L-74FC7D96',
+    'g': 'L-DB2E81BA',
+    'vt': 'L-DB2E81BA',
+    'inf': 'L-1945791B',
+    'p': 'L-417A185B',
+    'x': 'L-7295265B',
+}
+standard_families = ('a', 'c', 'd', 'h', 'i', 'm', 'r', 't', 'z')
+
+# The instance states which count against the limits.
+counted_states = ('pending', 'running')
+
+# The quota on Elastic IPs, in each region.
+address_quota_code = 'L-0263D0A3'
+
+# How many locations are checked at once.
+max_workers = 8
+
+
+# Work out which vCPU quota an instance type falls under.
+# Returns a quota code, or None if we don't know of one.
+def quota_code(instance_type):
+    match = re.match(r'([a-z]+)', instance_type)
+    if match is None:
+        return None
+    prefix = match.group(1)
+    if prefix in vcpu_quota_codes:
+        return vcpu_quota_codes[prefix]
+    if prefix[0] in standard_families and len(prefix) == 1:
+        return vcpu_quota_codes['standard']
+    return None
+
+
+# Get the instance type a launch template launches.
+# Returns None if the template doesn't say.
+def template_instance_type(ec2_client, template):
+    return templates.template_data(ec2_client, template).get('InstanceType')
+
+
+# Get the number of vCPUs of some instance types.
+# Returns a dict mapping instance types to vCPU counts.
+def instance_type_vcpus(ec2_client, instance_types):
+    vcpus = dict()
+    page_iterator = ec2_client.get_paginator('describe_instance_types').paginate(
+        InstanceTypes=sorted(set(instance_types)),
+    )
+    for instance_type, default_vcpus in page_iterator.search(
+        'InstanceTypes[].[InstanceType, VCpuInfo.DefaultVCpus]'
+    ):
+        vcpus[instance_type] = default_vcpus
+    return vcpus
+
+
+# Read a location's limits and usage, for some instance types.
+# Returns a tuple of two things: The location's headroom (see above) for each
+# instance type (a dict), and the number of vCPUs each instance type uses
+# (also a dict).
+def location_headroom(location, instance_types):
+    ec2_client = accounts.client(location)
+
+    # How big is each of our instance types?
+    type_vcpus = instance_type_vcpus(ec2_client, instance_types)
+
+    # What is running now?  Count the instances, and the vCPUs in each quota.
+    running_count = 0
+    running_vcpus = dict()
+    running_types = list()
+    page_iterator = ec2_client.get_paginator('describe_instances').paginate(
+        Filters=[{
+            'Name': 'instance-state-name',
+            'Values': list(counted_states),
+        }],
+    )
+    for instance_type, core_count, threads in page_iterator.search(
+        'Reservations[].Instances[].[InstanceType, CpuOptions.CoreCount, CpuOptions.ThreadsPerCore]'
+    ):
+        running_count = running_count + 1
+        running_types.append((instance_type, core_count, threads))
+    unknown_types = set(
+        instance_type for instance_type, core_count, threads in running_types
+        if core_count is None and instance_type not in type_vcpus
+    )
+    if len(unknown_types) > 0:
+        type_vcpus.update(instance_type_vcpus(ec2_client, unknown_types))
+    for instance_type, core_count, threads in running_types:
+        code = quota_code(instance_type)
+        if code is None:
+            continue
+        if core_count is not None:
+            vcpus = core_count * (threads or 1)
+        else:
+            vcpus = type_vcpus.get(instance_type, 0)
+        running_vcpus[code] = running_vcpus.get(code, 0) + vcpus
+
+    # What are the vCPU limits?  Reading them needs Service Quotas access,
+    # which our credentials may not have.
+    vcpu_limits = dict()
+    for instance_type in instance_types:
+        code = quota_code(instance_type)
+        if code is None or code in vcpu_limits:
+            continue
+        try:
+            quotas_client = accounts.client(location, 'service-quotas')
+            vcpu_limits[code] = quotas_client.get_service_quota(
+                ServiceCode='ec2',
+                QuotaCode=code,
+            )['Quota']['Value']
+        except Exception:
+            vcpu_limits[code] = None
+
+    # The old instance-count limit, from the account attributes.
+    instance_limit = None
+    response = ec2_client.describe_account_attributes(
+        AttributeNames=['max-instances'],
+    )
+    for attribute in response['AccountAttributes']:
+        for value in attribute['AttributeValues']:
+            try:
+                instance_limit = int(value['AttributeValue'])
+            except ValueError:
+                pass
+
+    # Instance types under the same limit share one headroom dict.
+    headroom = dict()
+    shared_headroom = dict()
+    for instance_type in instance_types:
+        code = quota_code(instance_type)
+        if vcpu_limits.get(code) is not None:
+            if code not in shared_headroom:
+                shared_headroom[code] = {
+                    'vcpus': max(0, int(vcpu_limits[code]) - running_vcpus.get(code, 0)),
+                    'instances': None,
+                }
+            headroom[instance_type] = shared_headroom[code]
+        elif instance_limit is not None:
+            if 'max-instances' not in shared_headroom:
+                shared_headroom['max-instances'] = {
+                    'vcpus': None,
+                    'instances': max(0, instance_limit - running_count),
+                }
+            headroom[instance_type] = shared_headroom['max-instances']
+        else:
+            headroom[instance_type] = None
+    return (headroom, type_vcpus)
+
+
+# Read the limits for each shard (see `workshops.workshop_shards`), with each
+# location checked at the same time.
+# Returns a tuple of two things: A list with one entry per shard, each a tuple
+# of (headroom, vCPUs per instance), and a dict mapping locations (that we
+# couldn't check) to exceptions.  A shard we couldn't check gets (None, None).
+def shard_limits(shards):
+    instance_types = dict()
+    errors = dict()
+
+    # First, find each shard's instance type.
+    def find_type(location, template):
+        return template_instance_type(accounts.client(location), template)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict(
+            (executor.submit(find_type, location, template), (location, template))
+            for location, template, weight in shards
+        )
+        for future in concurrent.futures.as_completed(futures):
+            location, template = futures[future]
+            try:
+                instance_types[(location, template)] = future.result()
+            except Exception as e:
+                errors[location] = e
+
+    # Then, read the limits for each location.
+    types_by_location = dict()
+    for (location, template), instance_type in instance_types.items():
+        if instance_type is not None:
+            types_by_location.setdefault(location, set()).add(instance_type)
+    location_results = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict(
+            (executor.submit(location_headroom, location, sorted(location_types)), location)
+            for location, location_types in types_by_location.items()
+        )
+        for future in concurrent.futures.as_completed(futures):
+            location = futures[future]
+            try:
+                location_results[location] = future.result()
+            except Exception as e:
+                errors[location] = e
+
+    # Put it all together.  Shards in the same location share that location's
+    # headroom (the same dict), so filling one shard leaves less for another.
+    limits = list()
+    for location, template, weight in shards:
+        instance_type = instance_types.get((location, template))
+        if location not in location_results or instance_type is None:
+            limits.append((None, None))
+            continue
+        headroom, type_vcpus = location_results[location]
+        limits.append((headroom[instance_type], type_vcpus.get(instance_type)))
+    return (limits, errors)
+
+
+# How many more instances fit in some headroom.
+# Returns None if there is no limit.
+def fits(headroom, vcpus):
+    if headroom is None:
+        return None
+    room = list()
+    if headroom['vcpus'] is not None and vcpus:
+        room.append(headroom['vcpus'] // vcpus)
+    if headroom['instances'] is not None:
+        room.append(headroom['instances'])
+    if len(room) == 0:
+        return None
+    return max(0, min(room))
+
+
+# Take some instances out of some headroom.
+def use(headroom, vcpus, count):
+    if headroom is None:
+        return
+    if headroom['vcpus'] is not None and vcpus:
+        headroom['vcpus'] = headroom['vcpus'] - (vcpus * count)
+    if headroom['instances'] is not None:
+        headroom['instances'] = headroom['instances'] - count
+
+
+# Fit a launch plan into the limits.
+# `counts` is the number of instances wanted from each shard, and `limits` is
+# from `shard_limits`.  Each shard is capped at what fits; anything left over
+# goes to the shards with room to spare, heaviest (by weight) first.
+# The headroom in `limits` is used up as we go.
+# Returns a list of new counts, one per shard.
+def fit_counts(shards, counts, limits):
+    planned = list()
+    for count, (headroom, vcpus) in zip(counts, limits):
+        room = fits(headroom, vcpus)
+        if room is not None:
+            count = min(count, room)
+        use(headroom, vcpus, count)
+        planned.append(count)
+
+    leftover = sum(counts) - sum(planned)
+    for i in sorted(range(0, len(shards)), key=lambda i: shards[i][2], reverse=True):
+        if leftover <= 0:
+            break
+        headroom, vcpus = limits[i]
+        room = fits(headroom, vcpus)
+        extra = leftover if room is None else min(leftover, room)
+        use(headroom, vcpus, extra)
+        planned[i] = planned[i] + extra
+        leftover = leftover - extra
+    return planned
+
+
+# Work out how many more Elastic IPs a location can have.
+# Returns None if the limit can't be read.
+def address_headroom(location):
+    try:
+        limit = accounts.client(location, 'service-quotas').get_service_quota(
+            ServiceCode='ec2',
+            QuotaCode=address_quota_code,
+        )['Quota']['Value']
+    except Exception:
+        return None
+    in_use = len(accounts.client(location).describe_addresses()['Addresses'])
+    return max(0, int(limit) - in_use)
@@ -0,0 +1,215 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# First, import modules from the standard library
+import argparse
+import datetime
+import logging
+import os
+from os import environ
+import signal
+from sys import exit
+import time
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    import accounts
+    import configstore
+    import filters
+    import inventory
+    import terminate
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Terminate workshop instances which have outlived their TTL.',
+)
+parser.add_argument('--interval',
+    default='15m',
+    help='How long to wait between scans (for example, 15m or 1h).  Default: 15m',
+)
+parser.add_argument('--once',
+    action='store_true',
+    help='Do one scan, and then exit (useful from cron).',
+)
+parser.add_argument('--dry-run',
+    action='store_true',
+    help='Log what would be terminated, but do not terminate anything.',
+)
+parser.add_argument('--log',
+    default=None,
+    help='Append the log to this file, instead of printing it.',
+)
+args = parser.parse_args()
+
+# Start talking to AWS in the background.
+startup.start_session()
+
+try:
+    interval = filters.parse_age(args.interval)
+except ValueError as e:
+    print(e)
+    exit(1)
+
+# Every action is logged, with a timestamp.
+logging.basicConfig(
+    filename=args.log,
+    format='%(asctime)s %(levelname)s %(message)s',
+    level=logging.INFO,
+)
+logger = logging.getLogger('reap_instances')
+
+# We need the workshop config file to exist.
+if 'CREATE_INSTANCES_CONFIG' not in environ:
+    print('Environment variable CREATE_INSTANCES_CONFIG is missing.  Re-run `finish_install`.')
+    exit(1)
+if not os.path.isfile(environ['CREATE_INSTANCES_CONFIG']):
+    print('The CREATE_INSTANCES_CONFIG file appears to be missing.  Re-run `finish_install`.')
+    exit(1)
+
+# EC2 clients, by region.  Clients are created as regions are needed.
+ec2_clients = dict()
+
+# Stop cleanly (between scans, or after the current scan) on SIGTERM.
+stop_requested = False
+def request_stop(signal, frame):
+    global stop_requested
+    stop_requested = True
+    logger.info('Stop requested; exiting after the current scan')
+signal.signal(signal.SIGTERM, request_stop)
+
+
+# Define a subroutine that reads each workshop's TTL from the config.
+# The config is read as a snapshot (see the `configstore` module), so we never
+# get in the way of `finish_install`, even though we run for a long time.
+# Returns a dict mapping workshop names to (regions, TTL in seconds) tuples.
+# A workshop with shards has more than one region.
+def read_ttls():
+    config, snapshot = configstore.read_config(environ['CREATE_INSTANCES_CONFIG'])
+
+    ttls = dict()
+    for workshop in config.sections():
+        # Workshops without a TTL are never reaped.
+        if 'ttl' not in config[workshop]:
+            continue
+        if 'region' not in config[workshop]:
+            logger.warning('Workshop %s has a TTL, but no region; skipping', workshop)
+            continue
+        try:
+            ttl = filters.parse_age(config[workshop]['ttl'])
+        except ValueError as e:
+            logger.warning('Workshop %s has a bad TTL: %s; skipping', workshop, e)
+            continue
+        ttls[workshop] = (workshops.workshop_regions(config, workshop), ttl)
+    return ttls
+
+
+# Define a subroutine that does one scan, terminating expired instances.
+# This is safe to repeat: Only instances which have not yet been told to
+# terminate are found, and terminating an instance twice does no harm.
+def reap():
+    ttls = read_ttls()
+    if len(ttls) == 0:
+        logger.info('No workshops have a TTL set; nothing to do')
+        return
+
+    # Group the workshops by region, and make sure we have clients.
+    workshops_by_region = dict()
+    for workshop, (workshop_regions, ttl) in ttls.items():
+        for region in workshop_regions:
+            workshops_by_region.setdefault(region, list()).append(workshop)
+            if region not in ec2_clients:
+                ec2_clients[region] = accounts.client(region)
+
+    # Find the expired instances.  The workshop and state filtering happens on
+    # the EC2 side; only the age check happens here.
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expired = dict()
+    expired_workshops = dict()
+    for instance in inventory.iter_regions_instances(
+        ec2_clients,
+        workshops_by_region,
+        states=inventory.LIVE_STATES,
+    ):
+        workshop = instance['Workshop']
+        age = (now - inventory.launched_at(instance)).total_seconds()
+        if age <= ttls[workshop][1]:
+            continue
+        logger.info('Instance %s (workshop %s, region %s, %s) is %.1f hours old; TTL is %.1f hours',
+            instance['InstanceId'],
+            workshop,
+            accounts.instance_location(instance),
+            instance['State'],
+            age / 3600,
+            ttls[workshop][1] / 3600,
+        )
+        expired.setdefault(accounts.instance_location(instance), list()).append(instance['InstanceId'])
+        expired_workshops[instance['InstanceId']] = workshop
+
+    if len(expired_workshops) == 0:
+        logger.info('Scanned %d workshop(s); no instances have expired', len(ttls))
+        return
+    if args.dry_run:
+        logger.info('Dry run: Not terminating %d instance(s)', len(expired_workshops))
+        return
+
+    # Terminate, in batches.
+    states, failures = terminate.terminate_instances_by_region(
+        ec2_clients,
+        expired,
+    )
+    for instance_id in sorted(states.keys()):
+        logger.info('Terminated instance %s (workshop %s); now %s',
+            instance_id,
+            expired_workshops[instance_id],
+            states[instance_id],
+        )
+    for instance_id in sorted(failures.keys()):
+        logger.error('Could not terminate instance %s (workshop %s): %s',
+            instance_id,
+            expired_workshops[instance_id],
+            failures[instance_id],
+        )
+
+
+# Our main loop: Scan, then sleep, until we are told to stop.
+logger.info('Reaper starting (interval %d seconds%s)',
+    interval,
+    ', dry run' if args.dry_run else '',
+)
+try:
+    while not stop_requested:
+        # A failed scan is logged, and we try again next time.
+        try:
+            reap()
+        except Exception as e:
+            logger.exception('Scan failed: %s', e)
+        if args.once:
+            break
+
+        # Sleep in small steps, so a stop request is noticed quickly.
+        wake_time = time.monotonic() + interval
+        while not stop_requested and time.monotonic() < wake_time:
+            time.sleep(min(5, max(0, wake_time - time.monotonic())))
+except KeyboardInterrupt:
+    pass
+logger.info('Reaper exiting')
+exit()
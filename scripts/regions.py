@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module gives us the list of AWS partitions and regions (with their
+# human-readable descriptions), without any API calls.
+#
+# boto3 doesn't give us human-readable descriptions via API, but they are in
+# botocore's `endpoints.json` file.  See https://github.com/boto/boto3/issues/1411
+# That file is large, so we boil it down to a small index the first time it is
+# needed, and save the index in the venv (see the `jsoncache` module).  The
+# index is rebuilt whenever the installed botocore version changes.
+#
+# Importing botocore is slow, so this module finds botocore's files without
+# importing it.
+
+# First, import modules from the standard library
+import importlib.util
+import json
+import os
+
+# importlib.metadata is only in Python 3.8 and later.
+try:
+    import importlib.metadata as importlib_metadata
+except ImportError:
+    importlib_metadata = None
+
+# Then, import our own stuff
+import jsoncache
+
+
+index_path = jsoncache.path('workshop_regions.json')
+
+# Once loaded, the index is kept here.
+_index = None
+
+
+# Find botocore's endpoints.json file, without importing botocore.
+def endpoints_path():
+    spec = importlib.util.find_spec('botocore')
+    if spec is None:
+        raise ModuleNotFoundError('No module named \'botocore\'', name='botocore')
+    return os.path.join(
+        spec.submodule_search_locations[0],
+        'data',
+        'endpoints.json',
+    )
+
+
+# Get the installed botocore version, without importing botocore.
+# If the package metadata isn't available, the endpoints.json file's size and
+# modification time stand in for the version.
+def botocore_version():
+    if importlib_metadata is not None:
+        try:
+            return importlib_metadata.version('botocore')
+        except importlib_metadata.PackageNotFoundError:
+            pass
+    endpoints_stat = os.stat(endpoints_path())
+    return '%d-%d' % (endpoints_stat.st_size, endpoints_stat.st_mtime)
+
+
+# Read botocore's endpoints.json, and boil it down to the parts we use.
+# The result has the same shape as the original `partitions` list (turned into
+# a dict keyed by partition), minus everything we don't need.
+def build_index():
+    with open(endpoints_path(), 'r') as endpoints_list_fh:
+        endpoints_list = json.load(endpoints_list_fh)
+
+    partitions = dict()
+    for partition in endpoints_list['partitions']:
+        partitions[partition['partition']] = {
+            'partitionName': partition['partitionName'],
+            'regions': dict(
+                (region, {'description': region_info.get('description', region)})
+                for region, region_info in partition['regions'].items()
+            ),
+        }
+    return {
+        'botocore_version': botocore_version(),
+        'partitions': partitions,
+    }
+
+
+# Load the index, building (and saving) it if needed.
+# Returns a dict of partitions; see `build_index` for the format.
+def load_index():
+    global _index
+    if _index is not None:
+        return _index['partitions']
+
+    # Try the saved index first.
+    try:
+        index = jsoncache.read(
+            index_path,
+            lambda index: isinstance(index, dict) and 'partitions' in index,
+        )
+        if index is not None and index.get('botocore_version') == botocore_version():
+            _index = index
+            return _index['partitions']
+    except OSError:
+        pass
+
+    # Build a new index, and try to save it.
+    _index = build_index()
+    jsoncache.write(index_path, _index)
+    return _index['partitions']
+
+
+# Find the partition that contains a region.
+# Returns the partition name, or None if the region is unknown.
+def find_partition(region):
+    for partition, partition_info in load_index().items():
+        if region in partition_info['regions']:
+            return partition
+    return None
+
+
+# Check if a region name is one that botocore knows about.
+def is_valid_region(region):
+    return find_partition(region) is not None
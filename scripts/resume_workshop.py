@@ -0,0 +1,262 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This script starts every stopped instance in a workshop (for example, ones
+# stopped by `suspend_workshop`), and waits for them to be ready, just like
+# `create_instances` waits for new instances.  See the `suspend` module.
+
+# First, import modules from the standard library
+import argparse
+import sys
+from sys import exit
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    from progress.bar import Bar
+    import accounts
+    import inventory
+    import launch
+    import suspend
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Start every stopped instance in a workshop.',
+)
+parser.add_argument('workshop',
+    nargs='?',
+    help='The workshop to resume.  If not given, you will be asked.',
+)
+args = parser.parse_args()
+
+print('Welcome to Workshop Resumer')
+
+# Start talking to AWS in the background, while we read the config and the
+# user reads the menu.
+startup.start_session()
+
+# Worker timeout is in seconds
+worker_timeout = 600
+
+# Load our config files
+with startup.phase('Reading configuration'):
+    config, config_snapshot = workshops.load_config()
+
+# We only need to know which region(s) the workshop lives in.
+region_workshops = list(
+    workshop for workshop in config.sections()
+    if 'region' in config[workshop]
+)
+
+# Use the workshop from the command line, or ask for one.
+if args.workshop is not None:
+    if args.workshop not in region_workshops:
+        print('The workshop "%s" is not configured (or has no region).' % (
+            args.workshop,
+        ))
+        print('Re-run `finish_install` to fix.')
+        exit()
+    chosen_config = args.workshop
+else:
+    chosen_config = workshops.choose_workshop(
+        region_workshops,
+        'The following workshops can be resumed:',
+    )
+    if chosen_config is None:
+        print('Goodbye')
+        exit()
+del region_workshops
+
+# A workshop with shards may have instances in several regions.
+chosen_regions = workshops.workshop_regions(config, chosen_config)
+instance_instructions = config[chosen_config].get('instructions')
+
+# Now that we know the workshop, check connectivity (and our permissions in
+# the workshop's region(s)).
+with startup.phase('Talking to AWS'):
+    workshops.check_connectivity(dict(
+        (region, ()) for region in chosen_regions
+    ))
+
+ec2_clients = dict(
+    (region, accounts.client(region))
+    for region in chosen_regions
+)
+
+# Find every stopped (or stopping) instance in the workshop.
+print('Looking for stopped instances in workshop %s… ' % (chosen_config,), end='')
+sys.stdout.flush()
+instance_ids_by_region = dict()
+instance_regions = dict()
+stopping_ids = list()
+try:
+    for instance in inventory.iter_regions_instances(
+        ec2_clients,
+        dict((region, [chosen_config]) for region in chosen_regions),
+        states=('stopping', 'stopped'),
+    ):
+        if instance['State'] == 'stopping':
+            stopping_ids.append(instance['InstanceId'])
+            continue
+        region = accounts.instance_location(instance)
+        instance_ids_by_region.setdefault(region, list()).append(instance['InstanceId'])
+        instance_regions[instance['InstanceId']] = region
+except Exception as e:
+    print('ERROR')
+    print('We were unable to get a list of instances.')
+    print('The exact error we got:', e)
+    exit()
+print('Complete')
+
+if len(stopping_ids) > 0:
+    print('WARNING: %d instance(s) are still stopping, and will not be started.' % (
+        len(stopping_ids),
+    ))
+    print('Run `resume_workshop` again once they have stopped.')
+if len(instance_regions) == 0:
+    print('There are no stopped instances in workshop %s.' % (chosen_config,))
+    print('Goodbye')
+    exit()
+
+# Send the start requests, in chunks.
+progress_bar = Bar(
+    'Requesting instance starts…',
+    max=len(instance_regions),
+)
+progress_bar.start()
+sys.stdout.flush()
+states, failures = suspend.start_instances_by_region(
+    ec2_clients,
+    instance_ids_by_region,
+    on_chunk_done=progress_bar.next,
+)
+progress_bar.finish()
+
+# Report anything that could not be started
+for instance_id in sorted(failures.keys()):
+    print('WARNING: Instance %s could not be started: %s' % (
+        instance_id,
+        failures[instance_id],
+    ))
+if len(states) == 0:
+    print('ERROR!  No instances were started.  Exiting.')
+    print('Goodbye')
+    exit()
+print('Start requested for %d instance(s).' % (len(states),))
+
+# From here on, this is just like waiting for new instances (see the `launch`
+# module).  Each region is checked in its own thread.
+started_instances = dict(
+    (instance_id, {'InstanceId': instance_id})
+    for instance_id in states.keys()
+)
+
+progress_bar = Bar(
+    'Waiting for instances to "power on"…',
+    max=len(started_instances),
+)
+print('')
+progress_bar.start()
+sys.stdout.flush()
+
+instances_to_check = launch.wait_for_running(
+    ec2_clients,
+    started_instances,
+    instance_regions,
+    timeout=worker_timeout,
+    on_done=lambda instance_id: progress_bar.next(),
+)
+
+# We have either run out of time, or have checked everything
+progress_bar.finish()
+for bad_instance in instances_to_check:
+    print('WARNING: Instance %s never finished powering on' % (bad_instance,))
+    del started_instances[bad_instance]
+del instances_to_check
+
+# Do we have any instances left?  If not, then exit
+if len(started_instances) == 0:
+    print('ERROR!  No instances survived.  Exiting.')
+    print('Goodbye')
+    exit()
+
+# Wait for instances to pass status checks
+
+progress_bar = Bar(
+    'Waiting for instances to be ready…',
+    max=len(started_instances),
+)
+print('')
+print('(This next step will take a few minutes.)')
+progress_bar.start()
+sys.stdout.flush()
+
+failed_instances, instances_to_check = launch.wait_for_status(
+    ec2_clients,
+    list(started_instances.keys()),
+    instance_regions,
+    timeout=worker_timeout,
+    on_done=lambda instance_id: progress_bar.next(),
+)
+
+# We have either run out of time, or have checked everything
+progress_bar.finish()
+
+# Did any instances either fail to go OK in time, or go bad?
+for bad_instance in instances_to_check:
+    print('WARNING: Instance %s never finished starting up.' % (bad_instance,))
+    del started_instances[bad_instance]
+for bad_instance in failed_instances:
+    print('WARNING: Instance %s failed to boot properly.' % (bad_instance,))
+    del started_instances[bad_instance]
+if (len(instances_to_check) + len(failed_instances)) > 0:
+    print('Please check on (or replace) these instance(s).')
+del failed_instances
+del instances_to_check
+
+if len(started_instances) == 0:
+    print('ERROR!  No instances survived.  Exiting.')
+    print('Goodbye')
+    exit()
+print('%d instance(s) resumed.' % (len(started_instances),))
+
+# Print the IP addresses of the instances.  If the workshop is split across
+# regions, say which region each instance is in.
+print('')
+print('Here are the IP addresses of the running instances:')
+for instance_id in sorted(
+    started_instances.keys(),
+    key=lambda instance_id: instance_regions[instance_id],
+):
+    public_ip = started_instances[instance_id].get('PublicIpAddress')
+    if public_ip is not None:
+        if len(instance_ids_by_region) == 1:
+            print(public_ip)
+        else:
+            print('%-15s %s' % (public_ip, instance_regions[instance_id]))
+
+# Print the instructions, and we're done!
+if instance_instructions is not None:
+    print('')
+    print('As a reminder, here are the instructions for these instances:')
+    print(instance_instructions)
+print('')
+print('Goodbye!')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module works out when to launch a workshop's instances, so that they
+# are ready by a deadline (see `schedule_instances`).
+#
+# Instances are launched in waves, each bigger than the last, spaced
+# `wave_gap` seconds apart.  The last (biggest) wave should be ready `margin`
+# seconds before the deadline.  A wave is started when the time left before
+# its ready-by time is down to how long we predict instances take to be ready
+# (see the `boottimes` module).
+#
+# The early waves tell us how long instances are taking today.  If a wave is
+# slower than predicted, the prediction goes up, which moves the later waves
+# earlier.  A wave counts as slower as soon as it has been running longer than
+# the prediction without enough of its instances being ready, so we don't
+# have to wait for it to finish.
+#
+# Times here are in seconds; points in time are from `time.time()`.
+
+# First, import modules from the standard library
+import math
+
+# Then, import our own stuff
+import boottimes
+import launch
+
+
+# The defaults for `schedule_instances`.
+default_waves = 3
+default_wave_gap = 10 * 60
+default_margin = 5 * 60
+default_percentile = 90
+
+# The prediction only goes up in steps of at least this much, so the plan
+# isn't changed (and logged) every time we check.
+replan_threshold = 60
+
+
+# Split a count into waves, each twice the size of the one before.
+# Returns a list of counts, without any empty waves.
+def wave_counts(count, waves):
+    counts = launch.split_count(count, list(2 ** i for i in range(0, waves)))
+    return list(wave_count for wave_count in counts if wave_count > 0)
+
+
+# Plan the waves.
+# Returns a list of waves, in launch order.  Each wave is a dict with its
+# number (`number`, starting from 1), instance count (`count`), and the time
+# it should be ready by (`ready_by`).
+def plan_waves(count, deadline, waves=default_waves, wave_gap=default_wave_gap, margin=default_margin):
+    counts = wave_counts(count, waves)
+    return list(
+        {
+            'number': i + 1,
+            'count': wave_count,
+            'ready_by': deadline - margin - (len(counts) - 1 - i) * wave_gap,
+        }
+        for i, wave_count in enumerate(counts)
+    )
+
+
+# Work out when a wave should start, given a prediction.
+def wave_start(wave, predicted):
+    return wave['ready_by'] - predicted
+
+
+# Split a wave's instances across the shards, in proportion to what each
+# shard has left to launch.  (The shard counts have already been fitted into
+# the limits; see `quota.fit_counts`.)  `remaining` is updated.
+# Returns a list of counts, one per shard.
+def shard_counts(count, remaining):
+    counts = launch.split_count(min(count, sum(remaining)), remaining)
+    for i, shard_count in enumerate(counts):
+        remaining[i] = remaining[i] - shard_count
+    return counts
+
+
+# Work out what a wave tells us about how long instances take to be ready.
+# `elapsed` is how long ago the wave was launched, `ready_times` is a list of
+# the times its ready instances took, and `finished` says if we're done
+# waiting for it.  `fraction` is the percentile we predict with.
+# Returns a time, which the prediction should be at least, or None if the
+# wave doesn't tell us anything (yet).
+def observed_time(wave, elapsed, ready_times, finished, fraction):
+    needed = max(1, int(math.ceil(fraction * wave['count'])))
+    ready_times = sorted(ready_times)
+    if len(ready_times) >= needed:
+        return ready_times[needed - 1]
+
+    # Instances that failed (or timed out) never become ready, so once we're
+    # done waiting, go by the ones that did.
+    if finished:
+        return boottimes.percentile(ready_times, fraction)
+
+    # Otherwise, the percentile is at least as long as the wave has been
+    # running.
+    return elapsed
@@ -0,0 +1,462 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This script launches a workshop's instances so that they are ready by a
+# given time.  It uses how long the workshop's instances took to be ready in
+# the past (see the `boottimes` module) to work out when to start, and then
+# launches in waves, re-planning if a wave is slower than predicted (see the
+# `schedule` module).  With `--background`, it runs on its own, writing what
+# it does to a log file.
+
+# First, import modules from the standard library
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+from sys import exit
+import threading
+import time
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    import dateutil.parser
+    import accounts
+    import boottimes
+    import inventory
+    import launch
+    import quota
+    import schedule
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Launch a workshop\'s instances, so that they are ready by a given time.',
+)
+parser.add_argument('workshop',
+    help='The workshop to launch.',
+)
+parser.add_argument('count',
+    type=int,
+    help='How many instances to launch.',
+)
+parser.add_argument('ready_by',
+    help='When the instances should be ready (for example, "8:30", or "2018-06-01 08:30").',
+)
+parser.add_argument('--waves',
+    type=int,
+    default=schedule.default_waves,
+    help='How many waves to launch in.  Default: %(default)s',
+)
+parser.add_argument('--wave-gap',
+    type=int,
+    default=schedule.default_wave_gap // 60,
+    help='How far apart the waves are, in minutes.  Default: %(default)s',
+)
+parser.add_argument('--margin',
+    type=int,
+    default=schedule.default_margin // 60,
+    help='How early the last wave should be ready, in minutes.  Default: %(default)s',
+)
+parser.add_argument('--percentile',
+    type=int,
+    default=schedule.default_percentile,
+    help='Plan for this percentile of past ready times.  Default: %(default)s',
+)
+parser.add_argument('--background',
+    action='store_true',
+    help='After confirming, run in the background, writing to a log file.',
+)
+parser.add_argument('--log',
+    default=None,
+    help='The log file for --background.  Default: schedule-WORKSHOP.log',
+)
+parser.add_argument('--yes',
+    action='store_true',
+    help='Do not ask for confirmation.',
+)
+args = parser.parse_args()
+if args.waves < 1 or args.count < 1 or not (0 < args.percentile <= 100):
+    print('The count and number of waves must be at least 1, and the percentile must be from 1 to 100.')
+    exit(1)
+fraction = args.percentile / 100
+
+print('Welcome to Instance Scheduler!')
+
+# Start talking to AWS in the background, while we read the config.
+startup.start_session()
+
+# Worker timeout is in seconds
+worker_timeout = 600
+
+# Work out the deadline.  Anything not given (like the date) is today's.
+local_tz = inventory.local_tz()
+now = datetime.datetime.now(local_tz)
+try:
+    deadline = dateutil.parser.parse(
+        args.ready_by,
+        default=now.replace(hour=0, minute=0, second=0, microsecond=0),
+    )
+except (ValueError, OverflowError):
+    print('"%s" is not a time we understand.' % (args.ready_by,))
+    exit(1)
+if deadline.tzinfo is None:
+    deadline = deadline.replace(tzinfo=local_tz)
+if deadline <= now:
+    print('%s has already passed.' % (deadline.strftime('%Y-%m-%d %H:%M %Z'),))
+    exit(1)
+
+# Load our config files
+with startup.phase('Reading configuration'):
+    config, config_snapshot = workshops.load_config()
+
+# Check the workshop
+with startup.phase('Checking workshops'):
+    usable_workshops = workshops.check_workshops(config)
+if args.workshop not in usable_workshops:
+    print('The workshop "%s" is not configured (or is not usable).' % (
+        args.workshop,
+    ))
+    print('Re-run `finish_install` to fix.')
+    exit(1)
+del usable_workshops
+chosen_config = args.workshop
+if args.count > config[chosen_config].getint('maximum'):
+    print('Please ask for %d instances or fewer (the type-specific max).' % (
+        config[chosen_config].getint('maximum'),
+    ))
+    exit(1)
+instance_instructions = config[chosen_config]['instructions']
+
+# A workshop may be split into shards (see `workshops.workshop_shards`).
+shards = workshops.workshop_shards(config, chosen_config)
+shard_regions = sorted(set(region for region, template, weight in shards))
+
+# Check connectivity and the launch template(s), and that we're allowed to
+# launch (and tag) instances in each region.
+with startup.phase('Talking to AWS'):
+    workshops.check_connectivity(workshops.launch_checks(shards))
+    if len(workshops.check_templates(config, [chosen_config])) == 0:
+        print('Goodbye')
+        exit(1)
+
+ec2_clients = dict(
+    (region, accounts.client(region))
+    for region in shard_regions
+)
+
+# Make sure the instances fit within the limits right now.  (Other launches
+# may use up some room before we launch; if so, the shards will tell us.)
+instance_count = args.count
+print('Checking instance limits… ', end='')
+sys.stdout.flush()
+limits, limit_errors = quota.shard_limits(shards)
+remaining_counts = quota.fit_counts(
+    shards,
+    launch.split_count(instance_count, list(shard[2] for shard in shards)),
+    limits,
+)
+if len(limit_errors) > 0:
+    print('WARNING')
+    for region, e in sorted(limit_errors.items()):
+        print('Unable to check the limits in %s: %s' % (region, e))
+else:
+    print('Complete')
+if sum(remaining_counts) == 0:
+    print('None of the instances fit within your current limits.')
+    exit(1)
+if sum(remaining_counts) < instance_count:
+    print('WARNING: Only %d of the %d instances fit within your current limits.' % (
+        sum(remaining_counts),
+        instance_count,
+    ))
+    instance_count = sum(remaining_counts)
+del limits
+del limit_errors
+
+# Plan the waves.
+predicted, sample_count = boottimes.predict(chosen_config, fraction)
+waves = schedule.plan_waves(
+    instance_count,
+    deadline.timestamp(),
+    waves=args.waves,
+    wave_gap=args.wave_gap * 60,
+    margin=args.margin * 60,
+)
+
+# Define a subroutine to show a point in time
+def show_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, local_tz).strftime('%H:%M:%S')
+
+# Define a subroutine to show a length of time
+def show_duration(seconds):
+    return '%dm%02ds' % (seconds // 60, seconds % 60)
+
+print('')
+if sample_count == 0:
+    print('There isn\'t enough history yet, so we guess instances take %s to be ready.' % (
+        show_duration(predicted),
+    ))
+else:
+    print('From %d past instances, %d%% of them were ready within %s.' % (
+        sample_count,
+        args.percentile,
+        show_duration(predicted),
+    ))
+print('To have %d instances of `%s` ready by %s:' % (
+    instance_count,
+    chosen_config,
+    deadline.strftime('%Y-%m-%d %H:%M %Z'),
+))
+for wave in waves:
+    print('  Wave %d: %4d instance(s), launched at %s, ready by %s' % (
+        wave['number'],
+        wave['count'],
+        show_time(schedule.wave_start(wave, predicted)),
+        show_time(wave['ready_by']),
+    ))
+if schedule.wave_start(waves[0], predicted) < time.time():
+    print('WARNING: That is not enough time; the first wave will launch right away.')
+
+# Confirm, unless we were told not to.
+if not args.yes:
+    response = None
+    while response not in ('y', 'n'):
+        try:
+            response = input('Go ahead (y/n)? ')
+        except (EOFError, KeyboardInterrupt):
+            response = 'n'
+    if response == 'n':
+        print('Goodbye')
+        exit()
+
+# If asked, run the rest in the background.  We start a copy of ourselves,
+# with the same plan, in its own session (so it survives logging out), and
+# point its output at the log file.
+if args.background:
+    log_path = args.log
+    if log_path is None:
+        log_path = 'schedule-%s.log' % (chosen_config,)
+    try:
+        log_fh = open(log_path, 'a')
+    except OSError as e:
+        print('Unable to open the log file %s: %s' % (log_path, e))
+        exit(1)
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(sys.argv[0]),
+            chosen_config,
+            str(instance_count),
+            deadline.isoformat(),
+            '--waves', str(args.waves),
+            '--wave-gap', str(args.wave_gap),
+            '--margin', str(args.margin),
+            '--percentile', str(args.percentile),
+            '--yes',
+        ] + startup.options,
+        stdin=subprocess.DEVNULL,
+        stdout=log_fh,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    log_fh.close()
+    print('Running in the background (process %d).' % (process.pid,))
+    print('Follow along with: tail -f %s' % (log_path,))
+    print('Goodbye')
+    exit()
+
+# From here on, nobody is watching, so everything is logged with the time.
+log_lock = threading.Lock()
+def log(message):
+    with log_lock:
+        print('%s %s' % (show_time(time.time()), message))
+        sys.stdout.flush()
+
+# Define a subroutine that launches a wave, and waits for it to be ready.
+# It runs in its own thread.  Each wave keeps its launched instances
+# (`instances`), their regions (`regions`), and how long each ready instance
+# took (`ready_times`).  `finished` is set once we're done waiting.
+def run_wave(wave, plan):
+    launch_datetime = datetime.datetime.now(datetime.timezone.utc)
+    wave['launched_at'] = time.monotonic()
+    try:
+        instances, instance_regions, launch_errors = launch.launch_shards(
+            ec2_clients,
+            plan,
+            launch.launch_tags(launch_datetime),
+        )
+        for (region, template), e in sorted(launch_errors.items()):
+            log('WARNING: Wave %d could not launch in %s (%s): %s' % (
+                wave['number'],
+                region,
+                template,
+                e,
+            ))
+        wave['instances'] = instances
+        wave['regions'] = instance_regions
+        wave['count'] = len(instances)
+        log('Wave %d: %d instance(s) launched' % (wave['number'], len(instances)))
+        if len(instances) == 0:
+            return
+
+        pending = launch.wait_for_running(
+            ec2_clients,
+            instances,
+            instance_regions,
+            timeout=worker_timeout,
+        )
+        for instance_id in pending:
+            log('WARNING: Instance %s never finished powering on' % (instance_id,))
+            del instances[instance_id]
+
+        def instance_done(instance_id):
+            wave['ready_times'][instance_id] = time.monotonic() - wave['launched_at']
+        failed, not_ready = launch.wait_for_status(
+            ec2_clients,
+            list(instances.keys()),
+            instance_regions,
+            timeout=worker_timeout,
+            on_done=instance_done,
+        )
+        for instance_id in not_ready:
+            log('WARNING: Instance %s never finished starting up' % (instance_id,))
+            del instances[instance_id]
+        for instance_id in failed:
+            log('WARNING: Instance %s failed to boot properly' % (instance_id,))
+            del instances[instance_id]
+            del wave['ready_times'][instance_id]
+        boottimes.record(chosen_config, wave['ready_times'].values())
+        log('Wave %d: %d instance(s) ready' % (wave['number'], len(instances)))
+    except Exception as e:
+        log('ERROR: Wave %d: %s' % (wave['number'], e))
+    finally:
+        wave['finished'] = True
+
+# Our event loop: Launch each wave when its time comes, and keep the
+# prediction up to date with what the waves so far have shown us.
+log('Scheduled %d instance(s) of `%s`, to be ready by %s' % (
+    instance_count,
+    chosen_config,
+    deadline.strftime('%Y-%m-%d %H:%M %Z'),
+))
+log('Predicting %s for instances to be ready; wave 1 launches at %s' % (
+    show_duration(predicted),
+    show_time(schedule.wave_start(waves[0], predicted)),
+))
+threads = list()
+next_wave = 0
+while (
+    (next_wave < len(waves)) or
+    any(thread.is_alive() for thread in threads)
+):
+    # Did any of the waves so far take longer than predicted?
+    slowest = predicted
+    for wave in waves[:next_wave]:
+        if 'launched_at' not in wave or wave['count'] == 0:
+            continue
+        observed = schedule.observed_time(
+            wave,
+            time.monotonic() - wave['launched_at'],
+            list(wave['ready_times'].values()),
+            wave['finished'],
+            fraction,
+        )
+        if observed is not None:
+            slowest = max(slowest, observed)
+    if slowest - predicted >= schedule.replan_threshold:
+        predicted = slowest
+        if next_wave < len(waves):
+            log('Instances are slower than predicted; now predicting %s, so wave %d launches at %s' % (
+                show_duration(predicted),
+                waves[next_wave]['number'],
+                show_time(schedule.wave_start(waves[next_wave], predicted)),
+            ))
+
+    # Launch every wave whose time has come.
+    while (
+        (next_wave < len(waves)) and
+        (schedule.wave_start(waves[next_wave], predicted) <= time.time())
+    ):
+        wave = waves[next_wave]
+        wave['ready_times'] = dict()
+        wave['finished'] = False
+        plan = list(
+            (region, template, count)
+            for (region, template, weight), count in zip(
+                shards,
+                schedule.shard_counts(wave['count'], remaining_counts),
+            )
+        )
+        log('Wave %d: launching %d instance(s)' % (wave['number'], wave['count']))
+        thread = threading.Thread(target=run_wave, args=(wave, plan))
+        thread.start()
+        threads.append(thread)
+        next_wave = next_wave + 1
+
+    # Wait until the next wave is due (but check on things every so often).
+    if next_wave < len(waves):
+        time.sleep(max(1, min(
+            30,
+            schedule.wave_start(waves[next_wave], predicted) - time.time(),
+        )))
+    else:
+        time.sleep(5)
+
+# All of the waves are done!  Report how we did.
+ready_instances = dict()
+instance_regions = dict()
+for wave in waves:
+    ready_instances.update(wave.get('instances', dict()))
+    instance_regions.update(wave.get('regions', dict()))
+if time.time() <= deadline.timestamp():
+    log('%d of %d instance(s) are ready, ahead of the deadline.' % (
+        len(ready_instances),
+        instance_count,
+    ))
+else:
+    log('%d of %d instance(s) are ready, but we missed the deadline by %s.' % (
+        len(ready_instances),
+        instance_count,
+        show_duration(time.time() - deadline.timestamp()),
+    ))
+
+# Print the IP addresses of the instances.  If the workshop is split across
+# regions, say which region each instance is in.
+print('')
+print('Here are the IP addresses of the running instances:')
+for instance_id in sorted(
+    ready_instances.keys(),
+    key=lambda instance_id: instance_regions[instance_id],
+):
+    public_ip = ready_instances[instance_id].get('PublicIpAddress')
+    if public_ip is not None:
+        if len(shard_regions) == 1:
+            print(public_ip)
+        else:
+            print('%-15s %s' % (public_ip, instance_regions[instance_id]))
+
+# Print the instructions, and we're done!
+print('')
+print('As a reminder, here are the instructions for these instances:')
+print(instance_instructions)
+print('')
+print('Goodbye!')
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module keeps our scripts quick to start.
+#
+# Importing boto3 (really, botocore) and creating a session are the slowest
+# parts of starting up.  So, `start_session` does both in a background thread,
+# while the script reads its config and the operator reads the menu.  Anything
+# that needs AWS asks for a client with `client`, which waits for the
+# background work (if it isn't done yet).  Clients are cached and shared.
+# Clients for other named credential profiles (see the `accounts` module) come
+# from their own sessions, which are made the first time they are needed.
+#
+# Every script should import this module first.  If `--profile-startup` is on
+# the command line, it is removed (so the script never sees it), and a
+# breakdown of import times and start-up phases is printed when the script
+# exits.
+#
+# Likewise, `--api-stats` measures every AWS API call (see the `apistats`
+# module), and prints a summary when the script exits.  `--api-stats-json
+# PATH` writes the numbers to PATH (as JSON) when the script exits, and also
+# whenever the script gets a SIGUSR1 (`kill -USR1 PID`) while it runs.
+
+# First, import modules from the standard library
+import atexit
+import builtins
+import contextlib
+import importlib.util
+import signal
+import sys
+import threading
+import time
+
+# Then, import our own stuff
+import apistats
+
+
+# When we started, so phases can be reported relative to it.
+start_time = time.perf_counter()
+
+# Are we profiling?
+profiling = '--profile-startup' in sys.argv
+if profiling:
+    sys.argv.remove('--profile-startup')
+
+# Are we measuring API calls?  If so, where (if anywhere) does the JSON go?
+api_stats = '--api-stats' in sys.argv
+if api_stats:
+    sys.argv.remove('--api-stats')
+api_stats_json = None
+for i, arg in enumerate(sys.argv):
+    if arg == '--api-stats-json' and i + 1 < len(sys.argv):
+        api_stats_json = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+        break
+    if arg.startswith('--api-stats-json='):
+        api_stats_json = arg.split('=', 1)[1]
+        del sys.argv[i]
+        break
+
+# The options we took from the command line, so a script that re-runs itself
+# can pass them along.
+options = list()
+if profiling:
+    options.append('--profile-startup')
+if api_stats:
+    options.append('--api-stats')
+if api_stats_json is not None:
+    options.append('--api-stats-json=%s' % (api_stats_json,))
+
+# What we've measured: Lists of (name, start offset, seconds) tuples.
+phases = list()
+import_times = list()
+
+# The background session.  `_session_state` holds the session (or the error
+# we hit creating it), and `_clients` caches clients by (service, region,
+# profile).  `_profile_sessions` holds the sessions for other profiles.
+_session_thread = None
+_session_state = dict()
+_clients = dict()
+_clients_lock = threading.Lock()
+_profile_sessions = dict()
+
+
+# Make sure some modules are installed, without importing them.
+# Raises ModuleNotFoundError (just like `import` would) if one is missing.
+def require(*names):
+    for name in names:
+        if importlib.util.find_spec(name) is None:
+            raise ModuleNotFoundError('No module named %r' % (name,), name=name)
+
+
+# Import a module lazily: It is actually loaded the first time one of its
+# attributes is used.  Raises ModuleNotFoundError if the module is missing.
+# The first use should happen in one thread (the main thread, say), because
+# older Pythons don't protect the actual load with a lock.
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError('No module named %r' % (name,), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    # Like `import`, make a submodule an attribute of its package.
+    if '.' in name:
+        parent, child = name.rsplit('.', 1)
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+# Time a phase of start-up.  Use as `with startup.phase('Reading config'):`
+@contextlib.contextmanager
+def phase(name):
+    phase_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((
+            name,
+            phase_start - start_time,
+            time.perf_counter() - phase_start,
+        ))
+
+
+# The background thread: Import boto3, make a session, and make any clients
+# we were asked to preload.
+def _make_session(preload):
+    phase_start = time.perf_counter()
+    try:
+        import boto3
+        _session_state['boto3'] = boto3
+        _session_state['session'] = new_session()
+        for service, region in preload:
+            client(service, region_name=region, wait=False)
+    except Exception as e:
+        _session_state['error'] = e
+    phases.append((
+        'Background: import boto3, make session',
+        phase_start - start_time,
+        time.perf_counter() - phase_start,
+    ))
+
+
+# Start making our AWS session in the background.
+# `preload` is a list of (service, region) tuples for clients to make ahead of
+# time; use None for the default region.
+def start_session(preload=(('ec2', None),)):
+    global _session_thread
+    if _session_thread is not None:
+        return
+    _session_thread = threading.Thread(
+        target=_make_session,
+        args=(tuple(preload),),
+        daemon=True,
+    )
+    _session_thread.start()
+
+
+# Get the boto3 module, once the background thread has imported it.
+def get_boto3():
+    start_session()
+    _session_thread.join()
+    if 'error' in _session_state:
+        raise _session_state['error']
+    return _session_state['boto3']
+
+
+# Make a new boto3 session (the arguments are passed to boto3), with its API
+# calls measured if we were asked to.  Sessions should only be made here.
+def new_session(**kwargs):
+    boto3 = _session_state.get('boto3') or get_boto3()
+    session = boto3.session.Session(**kwargs)
+    if api_stats or api_stats_json is not None:
+        apistats.install(session)
+    return session
+
+
+# Get our session, waiting for the background thread if needed.
+# If `profile` is given, get the session for that named credential profile
+# instead.  Its default region is the same as our session's.
+def get_session(profile=None):
+    get_boto3()
+    if profile is None:
+        return _session_state['session']
+    with _clients_lock:
+        return _get_profile_session(profile)
+
+
+# Make (or reuse) the session for a profile.  Call with `_clients_lock` held.
+def _get_profile_session(profile):
+    if profile not in _profile_sessions:
+        _profile_sessions[profile] = new_session(
+            profile_name=profile,
+            region_name=_session_state['session'].region_name,
+        )
+    return _profile_sessions[profile]
+
+
+# Get a (shared) client for a service and region, and (optionally) a named
+# credential profile.
+# Sessions are not thread-safe, so clients are made one at a time; the
+# clients themselves are thread-safe, and may be shared.
+def client(service, region_name=None, wait=True, profile=None):
+    if wait:
+        get_session()
+    with _clients_lock:
+        if profile is None:
+            session = _session_state['session']
+        else:
+            session = _get_profile_session(profile)
+        key = (service, region_name, profile)
+        if key not in _clients:
+            _clients[key] = session.client(service, region_name=region_name)
+        return _clients[key]
+
+
+# Start making clients for some regions, in the background.
+# This is handy once we know which regions a script will need.
+def preload_clients(service, regions):
+    def preload():
+        try:
+            for region in regions:
+                client(service, region_name=region)
+        except Exception:
+            # Whoever uses the client will hit (and report) the problem.
+            pass
+    threading.Thread(target=preload, daemon=True).start()
+
+
+# Our replacement for `__import__`, used when profiling.
+# Only the outermost import is timed, so nested imports aren't counted twice.
+_import_depth = threading.local()
+_original_import = builtins.__import__
+def _timed_import(name, *args, **kwargs):
+    depth = getattr(_import_depth, 'depth', 0)
+    if depth > 0 or name in sys.modules:
+        _import_depth.depth = depth + 1
+        try:
+            return _original_import(name, *args, **kwargs)
+        finally:
+            _import_depth.depth = depth
+    import_start = time.perf_counter()
+    _import_depth.depth = 1
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        _import_depth.depth = 0
+        import_times.append((
+            name,
+            import_start - start_time,
+            time.perf_counter() - import_start,
+        ))
+
+
+# Print our start-up profile (to standard error).
+def report():
+    out = sys.__stderr__
+    print('', file=out)
+    print('Start-up profile (times in milliseconds)', file=out)
+    print('  Slowest imports:', file=out)
+    for name, offset, seconds in sorted(
+        import_times,
+        key=lambda x: x[2],
+        reverse=True,
+    )[:15]:
+        print('    %8.1f  (at %8.1f)  %s' % (seconds * 1000, offset * 1000, name), file=out)
+    print('  Phases:', file=out)
+    for name, offset, seconds in sorted(phases, key=lambda x: x[1]):
+        print('    %8.1f  (at %8.1f)  %s' % (seconds * 1000, offset * 1000, name), file=out)
+    print('  Total run time: %.1f' % (
+        (time.perf_counter() - start_time) * 1000,
+    ), file=out)
+
+
+if profiling:
+    builtins.__import__ = _timed_import
+    atexit.register(report)
+
+
+# Write out our API call numbers, as JSON.  A problem writing them shouldn't
+# stop the script.
+def _dump_api_stats(*args):
+    try:
+        apistats.dump(api_stats_json)
+    except Exception as e:
+        print('Unable to write API stats to %s: %s' % (api_stats_json, e), file=sys.__stderr__)
+
+
+# On SIGUSR1, write them out from another thread.  The signal handler runs on
+# the main thread, which may be holding the stats lock when the signal comes.
+def _dump_api_stats_signal(*args):
+    threading.Thread(target=_dump_api_stats, daemon=True).start()
+
+
+if api_stats:
+    atexit.register(apistats.report)
+if api_stats_json is not None:
+    atexit.register(_dump_api_stats)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, _dump_api_stats_signal)
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module stops (or hibernates) a workshop's instances at the end of a
+# class day, and starts them again the next morning.
+#
+# Stops and starts are sent in bounded chunks, concurrently, just like
+# terminations are (see the `terminate` module).  An instance is hibernated
+# (instead of stopped) if its launch template allows it.  EC2 can still
+# refuse to hibernate an instance (for example, one that was launched only a
+# few minutes ago), and then it is stopped instead.
+#
+# An instance's public IP goes away when it stops, unless it has an Elastic
+# IP.  So, this module can also give each instance an Elastic IP (tagged with
+# the workshop's name, so it can be found and released later).
+
+# First, import modules from the standard library
+import concurrent.futures
+import random
+import time
+
+# Then, import our own stuff
+import launch
+import provision
+import templates
+import terminate
+
+
+# These errors mean that EC2 won't hibernate an instance, but will stop it.
+hibernate_errors = (
+    'UnsupportedHibernationConfiguration',
+    'UnsupportedOperation',
+)
+
+# These errors mean the Elastic IP is already gone.
+address_gone_errors = (
+    'InvalidAllocationID.NotFound',
+    'InvalidAssociationID.NotFound',
+)
+
+# The tag EC2 puts on an instance launched from a launch template.
+TEMPLATE_TAG = 'aws:ec2launchtemplate:id'
+
+# The `WorkshopResource` tag value for a workshop's Elastic IPs.
+ADDRESS_RESOURCE = 'address'
+
+
+# Check if a launch template allows its instances to hibernate.
+def template_hibernates(ec2_client, template):
+    data = templates.template_data(ec2_client, template)
+    return data.get('HibernationOptions', dict()).get('Configured', False)
+
+
+# Work out which instances should be hibernated.
+# `instances` is a list of normalized instance records (see the `inventory`
+# module), all in the region (and account) that `ec2_client` talks to.
+# Returns a set of instance IDs.  An instance whose template can't be read is
+# just stopped.
+def hibernating_instances(ec2_client, instances):
+    hibernates = dict()
+    instance_ids = set()
+    for instance in instances:
+        template = instance['Tags'].get(TEMPLATE_TAG)
+        if template is None:
+            continue
+        if template not in hibernates:
+            try:
+                hibernates[template] = template_hibernates(ec2_client, template)
+            except Exception:
+                hibernates[template] = False
+        if hibernates[template]:
+            instance_ids.add(instance['InstanceId'])
+    return instance_ids
+
+
+# These errors (besides `terminate.permanent_errors`) mean that EC2 won't
+# stop or start some instance in a chunk, so the chunk is split to find it.
+split_errors = hibernate_errors + ('IncorrectInstanceState',)
+
+
+# Stop (or hibernate) one chunk of instances.
+# If EC2 won't hibernate an instance, it is stopped instead.
+# See `terminate.change_chunk` for what is returned.
+def stop_chunk(ec2_client, instance_ids, hibernate=False):
+    states, failures = terminate.change_chunk(
+        ec2_client.stop_instances,
+        'StoppingInstances',
+        instance_ids,
+        split_errors=split_errors,
+        Hibernate=hibernate,
+    )
+    retry_ids = list(
+        instance_id for instance_id, e in failures.items()
+        if hibernate and provision.is_error(e, *hibernate_errors)
+    )
+    if len(retry_ids) > 0:
+        for instance_id in retry_ids:
+            del failures[instance_id]
+        retry_states, retry_failures = terminate.change_chunk(
+            ec2_client.stop_instances,
+            'StoppingInstances',
+            retry_ids,
+            split_errors=split_errors,
+        )
+        states.update(retry_states)
+        failures.update(retry_failures)
+    return (states, failures)
+
+
+# Start one chunk of instances.
+# See `terminate.change_chunk` for what is returned.
+def start_chunk(ec2_client, instance_ids):
+    return terminate.change_chunk(
+        ec2_client.start_instances,
+        'StartingInstances',
+        instance_ids,
+        split_errors=split_errors,
+    )
+
+
+# Run chunk jobs from several regions, sharing one pool of workers.
+# `jobs` is a list of (function, arguments) tuples; each function returns a
+# tuple of two dicts (see `terminate.change_chunk`).  The second argument of
+# each job is its chunk of instance IDs.
+# `on_chunk_done` (if provided) is called with the number of instances in each
+# chunk, as each chunk finishes.
+def run_chunks(jobs, on_chunk_done=None):
+    states = dict()
+    failures = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=terminate.max_workers) as executor:
+        futures = dict(
+            (executor.submit(function, *arguments), arguments[1])
+            for function, arguments in jobs
+        )
+        for future in concurrent.futures.as_completed(futures):
+            chunk_states, chunk_failures = future.result()
+            states.update(chunk_states)
+            failures.update(chunk_failures)
+            if on_chunk_done is not None:
+                on_chunk_done(len(futures[future]))
+    return (states, failures)
+
+
+# Stop instances spread across several regions, in concurrent chunks.
+# `ec2_clients` maps region names to EC2 clients, `instance_ids_by_region`
+# maps region names to lists of instance IDs, and `hibernate_ids` is a set of
+# the instance IDs to hibernate.
+# Returns a tuple of two dicts; see `terminate.change_chunk` for details.
+def stop_instances_by_region(ec2_clients, instance_ids_by_region, hibernate_ids=(), on_chunk_done=None):
+    jobs = list()
+    for region, instance_ids in instance_ids_by_region.items():
+        for hibernate in (True, False):
+            chosen_ids = list(
+                instance_id for instance_id in instance_ids
+                if (instance_id in hibernate_ids) == hibernate
+            )
+            for chunk in terminate.chunks(chosen_ids, terminate.chunk_size):
+                jobs.append((stop_chunk, (ec2_clients[region], chunk, hibernate)))
+    return run_chunks(jobs, on_chunk_done)
+
+
+# Start instances spread across several regions, in concurrent chunks.
+# See `stop_instances_by_region` for details.
+def start_instances_by_region(ec2_clients, instance_ids_by_region, on_chunk_done=None):
+    jobs = list()
+    for region, instance_ids in instance_ids_by_region.items():
+        for chunk in terminate.chunks(instance_ids, terminate.chunk_size):
+            jobs.append((start_chunk, (ec2_clients[region], chunk)))
+    return run_chunks(jobs, on_chunk_done)
+
+
+# Wait for instances to reach the `stopped` state.  The arguments are like
+# those of `launch.wait_for_running`.
+# Returns a tuple of two lists: The instance IDs which went somewhere other
+# than `stopped` (for example, `terminated`), and the instance IDs which had
+# not stopped at the timeout.
+def wait_for_stopped(ec2_clients, instance_ids, instance_shards, timeout=launch.default_timeout, on_done=None):
+    on_done = launch.serialized(on_done)
+
+    def poll_shard(ec2_client, shard_instance_ids):
+        instances_to_check = list(shard_instance_ids)
+        failed_instances = list()
+
+        # We'll be governed by the timeout for giving up on updates.
+        wait_starttime = time.monotonic()
+        while (
+            (len(instances_to_check) > 0) and
+            (time.monotonic() - wait_starttime <= timeout)
+        ):
+            states = dict()
+            for chunk in terminate.chunks(instances_to_check, terminate.describe_chunk_size):
+                response_iterator = ec2_client.get_paginator('describe_instances').paginate(
+                    Filters=[{
+                        'Name': 'instance-id',
+                        'Values': chunk,
+                    }],
+                ).search('Reservations[].Instances[].[InstanceId, State.Name]')
+                for instance_id, instance_state in response_iterator:
+                    states[instance_id] = instance_state
+
+            # Instances which EC2 no longer knows about have failed.
+            for instance_id in list(instances_to_check):
+                instance_state = states.get(instance_id, 'terminated')
+                if instance_state == 'stopped':
+                    instances_to_check.remove(instance_id)
+                    on_done(instance_id)
+                elif instance_state not in ('running', 'stopping'):
+                    failed_instances.append(instance_id)
+                    instances_to_check.remove(instance_id)
+                    on_done(instance_id)
+
+            # If we have any items left to check, wait zero to 5 seconds
+            # before trying again.
+            if len(instances_to_check) > 0:
+                time.sleep(random.randrange(0, 500, 1) / 100)
+
+        return (failed_instances, instances_to_check)
+
+    result = launch.poll_shards(ec2_clients, instance_ids, instance_shards, poll_shard)
+    if result is None:
+        return (list(), list())
+    return result
+
+
+# Get a workshop's Elastic IPs, in one region.
+# Returns a list of addresses (from the `describe_addresses` response).
+def workshop_addresses(ec2_client, workshop):
+    return ec2_client.describe_addresses(
+        Filters=provision.resource_filters(workshop, ADDRESS_RESOURCE),
+    )['Addresses']
+
+
+# Give one instance a new Elastic IP.  If the address can't be associated, it
+# is released again; if that fails too, both errors are reported (the address
+# keeps the workshop's tags, so `destroy_workshop` will release it later).
+# Returns the new address (raising an exception if there isn't one).
+def keep_address(ec2_client, workshop, instance_id):
+    address = ec2_client.allocate_address(
+        Domain='vpc',
+        TagSpecifications=provision.tag_specifications(
+            'elastic-ip',
+            workshop,
+            ADDRESS_RESOURCE,
+        ),
+    )
+    try:
+        ec2_client.associate_address(
+            AllocationId=address['AllocationId'],
+            InstanceId=instance_id,
+        )
+    except Exception as e:
+        try:
+            ec2_client.release_address(AllocationId=address['AllocationId'])
+        except Exception as release_error:
+            raise Exception('%s (releasing the new address %s also failed: %s)' % (
+                e,
+                address['PublicIp'],
+                release_error,
+            ))
+        raise
+    return address['PublicIp']
+
+
+# Give each instance (in one region) an Elastic IP, unless it already has one
+# of the workshop's.  The instance's public IP changes to the new address
+# right away, and then stays the same across stops and starts.  Like the stop
+# and start requests, instances are done concurrently.
+# Returns a tuple of two dicts: The first maps instance IDs to their Elastic
+# IP, and the second maps instance IDs (that couldn't get one) to exceptions.
+def keep_addresses(ec2_client, workshop, instance_ids):
+    kept = dict()
+    failures = dict()
+    for address in workshop_addresses(ec2_client, workshop):
+        if address.get('InstanceId') in instance_ids:
+            kept[address['InstanceId']] = address['PublicIp']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=terminate.max_workers) as executor:
+        futures = dict(
+            (executor.submit(keep_address, ec2_client, workshop, instance_id), instance_id)
+            for instance_id in instance_ids
+            if instance_id not in kept
+        )
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                kept[futures[future]] = future.result()
+            except Exception as e:
+                failures[futures[future]] = e
+    return (kept, failures)
+
+
+# Release a workshop's Elastic IPs (in one region), disassociating them first.
+# Returns a tuple of the number released, and a dict mapping the addresses
+# (that couldn't be released) to exceptions.
+def release_addresses(ec2_client, workshop):
+    released = 0
+    failures = dict()
+    for address in workshop_addresses(ec2_client, workshop):
+        try:
+            if 'AssociationId' in address:
+                try:
+                    ec2_client.disassociate_address(
+                        AssociationId=address['AssociationId'],
+                    )
+                except Exception as e:
+                    if not provision.is_error(e, *address_gone_errors):
+                        raise
+            ec2_client.release_address(AllocationId=address['AllocationId'])
+            released = released + 1
+        except Exception as e:
+            if not provision.is_error(e, *address_gone_errors):
+                failures[address['PublicIp']] = e
+    return (released, failures)
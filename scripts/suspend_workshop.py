@@ -0,0 +1,329 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This script stops every running instance in a workshop, at the end of a
+# class day.  Instances whose launch template allows it are hibernated, so
+# they come back with their memory intact.  Run `resume_workshop` to start
+# them again.  With `--keep-ips`, each instance is given an Elastic IP first,
+# so its address survives the stop.  See the `suspend` module.
+
+# First, import modules from the standard library
+import argparse
+import concurrent.futures
+import sys
+from sys import exit
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    from progress.bar import Bar
+    import accounts
+    import inventory
+    import quota
+    import suspend
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Stop (or hibernate) every running instance in a workshop.',
+)
+parser.add_argument('workshop',
+    nargs='?',
+    help='The workshop to suspend.  If not given, you will be asked.',
+)
+parser.add_argument('--keep-ips',
+    action='store_true',
+    help='Give each instance an Elastic IP, so it keeps its address.',
+)
+parser.add_argument('--no-hibernate',
+    action='store_true',
+    help='Stop instances, even if they could be hibernated.',
+)
+parser.add_argument('--no-wait',
+    action='store_true',
+    help='Do not wait for the instances to finish stopping.',
+)
+parser.add_argument('--yes',
+    action='store_true',
+    help='Do not ask for confirmation.',
+)
+args = parser.parse_args()
+
+print('Welcome to Workshop Suspender')
+
+# Start talking to AWS in the background, while we read the config and the
+# user reads the menu.
+startup.start_session()
+
+# Worker timeout is in seconds
+worker_timeout = 600
+
+# Load our config files
+with startup.phase('Reading configuration'):
+    config, config_snapshot = workshops.load_config()
+
+# We only need to know which region(s) the workshop lives in.
+region_workshops = list(
+    workshop for workshop in config.sections()
+    if 'region' in config[workshop]
+)
+
+# Use the workshop from the command line, or ask for one.
+if args.workshop is not None:
+    if args.workshop not in region_workshops:
+        print('The workshop "%s" is not configured (or has no region).' % (
+            args.workshop,
+        ))
+        print('Re-run `finish_install` to fix.')
+        exit()
+    chosen_config = args.workshop
+else:
+    chosen_config = workshops.choose_workshop(
+        region_workshops,
+        'The following workshops can be suspended:',
+    )
+    if chosen_config is None:
+        print('Goodbye')
+        exit()
+del region_workshops
+
+# A workshop with shards may have instances in several regions.
+chosen_regions = workshops.workshop_regions(config, chosen_config)
+
+# Now that we know the workshop, check connectivity (and our permissions in
+# the workshop's region(s)).
+with startup.phase('Talking to AWS'):
+    workshops.check_connectivity(dict(
+        (region, ()) for region in chosen_regions
+    ))
+
+ec2_clients = dict(
+    (region, accounts.client(region))
+    for region in chosen_regions
+)
+
+# Find every running instance in the workshop.
+print('Looking for running instances in workshop %s… ' % (chosen_config,), end='')
+sys.stdout.flush()
+instances_by_region = dict()
+try:
+    for instance in inventory.iter_regions_instances(
+        ec2_clients,
+        dict((region, [chosen_config]) for region in chosen_regions),
+        states=('pending', 'running'),
+    ):
+        instances_by_region.setdefault(
+            accounts.instance_location(instance),
+            list(),
+        ).append(instance)
+except Exception as e:
+    print('ERROR')
+    print('We were unable to get a list of instances.')
+    print('The exact error we got:', e)
+    exit()
+instance_ids_by_region = dict(
+    (region, list(instance['InstanceId'] for instance in region_instances))
+    for region, region_instances in instances_by_region.items()
+)
+instance_regions = dict(
+    (instance_id, region)
+    for region, region_instance_ids in instance_ids_by_region.items()
+    for instance_id in region_instance_ids
+)
+print('Complete')
+
+if len(instance_regions) == 0:
+    print('There are no running instances in workshop %s.' % (chosen_config,))
+    print('Goodbye')
+    exit()
+
+# Work out which instances can be hibernated (see the `templates` module).
+hibernate_ids = set()
+if not args.no_hibernate:
+    for region, region_instances in instances_by_region.items():
+        hibernate_ids.update(suspend.hibernating_instances(
+            ec2_clients[region],
+            region_instances,
+        ))
+
+# Elastic IPs have a limit of their own, so check it before asking.
+if args.keep_ips:
+    short = dict()
+    for region, region_instance_ids in instance_ids_by_region.items():
+        headroom = quota.address_headroom(region)
+        if headroom is None:
+            continue
+        has_address = set(
+            address.get('InstanceId')
+            for address in suspend.workshop_addresses(ec2_clients[region], chosen_config)
+        )
+        needed = len(list(
+            instance_id for instance_id in region_instance_ids
+            if instance_id not in has_address
+        ))
+        if needed > headroom:
+            short[region] = (needed, headroom)
+    for region, (needed, headroom) in sorted(short.items()):
+        print('WARNING: %d instance(s) in %s need an Elastic IP, but only %d more fit within your limits.' % (
+            needed,
+            region,
+            headroom,
+        ))
+        print('The rest will get a new address when they are resumed.')
+
+# Give the user one chance to abort.
+print('')
+print('You are about to stop %d instance(s) in workshop %s (region %s).' % (
+    len(instance_regions),
+    chosen_config,
+    ', '.join(sorted(instance_ids_by_region.keys())),
+))
+if len(hibernate_ids) > 0:
+    print('%d of them will be hibernated (their memory is saved to disk).' % (
+        len(hibernate_ids),
+    ))
+if args.keep_ips:
+    print('Each instance will get an Elastic IP first.  Instances that don\'t have one')
+    print('yet will get a new address now, which they will keep from then on.')
+    print('Elastic IPs are billed while they are held; `teardown_instances` releases them.')
+else:
+    print('When they are resumed, the instances will have new IP addresses.')
+if not args.yes:
+    response = None
+    while response is None:
+        try:
+            response = input('Are you sure you wish to proceed (y/n)? ')
+        except (EOFError, KeyboardInterrupt):
+            response = 'n'
+        if response not in ('y', 'n'):
+            response = None
+    if response == 'n':
+        print('Taking no action.')
+        print('Goodbye')
+        exit()
+
+# If asked, give each instance an Elastic IP.  Each region is done at the same
+# time.
+if args.keep_ips:
+    print('Giving each instance an Elastic IP… ', end='')
+    sys.stdout.flush()
+    kept = dict()
+    failures = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = dict(
+            (executor.submit(
+                suspend.keep_addresses,
+                ec2_clients[region],
+                chosen_config,
+                region_instance_ids,
+            ), region)
+            for region, region_instance_ids in instance_ids_by_region.items()
+        )
+        for future in concurrent.futures.as_completed(futures):
+            region = futures[future]
+            try:
+                region_kept, region_failures = future.result()
+                kept.update(region_kept)
+                failures.update(region_failures)
+            except Exception as e:
+                for instance_id in instance_ids_by_region[region]:
+                    failures[instance_id] = e
+    if len(failures) > 0:
+        print('WARNING')
+        for instance_id in sorted(failures.keys()):
+            print('WARNING: Instance %s did not get an Elastic IP: %s' % (
+                instance_id,
+                failures[instance_id],
+            ))
+    else:
+        print('Complete')
+
+    # Print the addresses, which won't change from now on.
+    print('')
+    print('Here are the IP addresses of the instances (they will not change):')
+    for instance_id in sorted(
+        kept.keys(),
+        key=lambda instance_id: instance_regions[instance_id],
+    ):
+        if len(instance_ids_by_region) == 1:
+            print(kept[instance_id])
+        else:
+            print('%-15s %s' % (kept[instance_id], instance_regions[instance_id]))
+    print('')
+
+# Send the stop requests, in chunks.
+progress_bar = Bar(
+    'Requesting instance stops…',
+    max=len(instance_regions),
+)
+progress_bar.start()
+sys.stdout.flush()
+states, failures = suspend.stop_instances_by_region(
+    ec2_clients,
+    instance_ids_by_region,
+    hibernate_ids=hibernate_ids,
+    on_chunk_done=progress_bar.next,
+)
+progress_bar.finish()
+
+# Report anything that could not be stopped
+for instance_id in sorted(failures.keys()):
+    print('WARNING: Instance %s could not be stopped: %s' % (
+        instance_id,
+        failures[instance_id],
+    ))
+print('Stop requested for %d instance(s).' % (len(states),))
+
+if args.no_wait or len(states) == 0:
+    print('Goodbye')
+    exit()
+
+# Follow the instances until they are stopped.  Each region is checked in its
+# own thread.
+progress_bar = Bar(
+    'Waiting for instances to stop…',
+    max=len(states),
+)
+print('')
+print('(Hibernating instances take a little longer, while their memory is saved.)')
+progress_bar.start()
+sys.stdout.flush()
+failed_instances, instances_to_check = suspend.wait_for_stopped(
+    ec2_clients,
+    list(states.keys()),
+    instance_regions,
+    timeout=worker_timeout,
+    on_done=lambda instance_id: progress_bar.next(),
+)
+progress_bar.finish()
+
+# Report what didn't finish
+for bad_instance in instances_to_check:
+    print('WARNING: Instance %s has not stopped yet.' % (bad_instance,))
+for bad_instance in failed_instances:
+    print('WARNING: Instance %s did not stop (it may have been terminated).' % (bad_instance,))
+if (len(instances_to_check) + len(failed_instances)) == 0:
+    print('All %d instance(s) stopped.  Run `resume_workshop` to start them again.' % (
+        len(states),
+    ))
+
+# All done!
+print('Goodbye')
+exit()
@@ -0,0 +1,295 @@
+#!python3
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# First, import modules from the standard library
+import argparse
+import sys
+from sys import exit
+
+# Our start-up helper comes first, so it can see the command line.
+import startup
+
+# Try importing other stuff
+# (boto3 is only checked for here; it is imported in the background.)
+try:
+    startup.require('boto3', 'dateutil')
+    from progress.bar import Bar
+    import accounts
+    import fastrestore
+    import inventory
+    import suspend
+    import terminate
+    import workshops
+except ModuleNotFoundError as e:
+    print('Failed to import module %s' % (e.name,))
+    print('Run `finish_install`')
+    exit()
+
+# Parse our command-line arguments
+parser = argparse.ArgumentParser(
+    description='Terminate every instance in a workshop.',
+)
+parser.add_argument('workshop',
+    nargs='?',
+    help='The workshop to tear down.  If not given, you will be asked.',
+)
+parser.add_argument('--wait',
+    action='store_true',
+    help='Wait for all of the instances to finish terminating.',
+)
+parser.add_argument('--disable-fast-restore',
+    action='store_true',
+    help='Also turn off Fast Snapshot Restore for the workshop\'s AMI (see `prewarm_workshop`).',
+)
+args = parser.parse_args()
+
+print('Welcome to Workshop Teardown')
+
+# Start talking to AWS in the background, while we read the config and the
+# user reads the menu.
+startup.start_session()
+
+# Worker timeout is in seconds
+worker_timeout = 600
+
+# Load our config files
+with startup.phase('Reading configuration'):
+    config, config_snapshot = workshops.load_config()
+
+# We don't need a working launch template to tear down a workshop, but we do
+# need to know which region it lives in.
+region_workshops = list(
+    workshop for workshop in config.sections()
+    if 'region' in config[workshop]
+)
+
+# Use the workshop from the command line, or ask for one.
+if args.workshop is not None:
+    if args.workshop not in region_workshops:
+        print('The workshop "%s" is not configured (or has no region).' % (
+            args.workshop,
+        ))
+        print('Re-run `finish_install` to fix.')
+        exit()
+    chosen_config = args.workshop
+else:
+    chosen_config = workshops.choose_workshop(
+        region_workshops,
+        'The following workshops can be torn down:',
+    )
+    if chosen_config is None:
+        print('Goodbye')
+        exit()
+del region_workshops
+
+# A workshop with shards may have instances in several regions.
+chosen_regions = workshops.workshop_regions(config, chosen_config)
+
+# Now that we know the workshop, check connectivity (and our permissions in
+# the workshop's region(s)).
+with startup.phase('Talking to AWS'):
+    workshops.check_connectivity(dict(
+        (region, ()) for region in chosen_regions
+    ))
+
+# Do our final ec2_client re-creation
+ec2_clients = dict(
+    (region, accounts.client(region))
+    for region in chosen_regions
+)
+
+# Find every instance in the workshop which hasn't been terminated.
+# The filtering happens on the EC2 side, and we only keep the IDs.
+print('Looking for instances in workshop %s… ' % (chosen_config,), end='')
+sys.stdout.flush()
+instance_ids_by_region = dict()
+try:
+    for region in chosen_regions:
+        region_instance_ids = list(inventory.iter_instance_ids(
+            ec2_clients[region],
+            inventory.workshop_filters(chosen_config, inventory.LIVE_STATES),
+        ))
+        if len(region_instance_ids) > 0:
+            instance_ids_by_region[region] = region_instance_ids
+    instance_ids = list(
+        instance_id
+        for region_instance_ids in instance_ids_by_region.values()
+        for instance_id in region_instance_ids
+    )
+except Exception as e:
+    print('ERROR')
+    print('We were unable to get a list of instances.')
+    print('The exact error we got:', e)
+    exit()
+print('Complete')
+
+# Define a subroutine that turns off Fast Snapshot Restore for the workshop's
+# AMI(s), in every zone it launches into (see the `fastrestore` module).
+def disable_fast_restore():
+    print('Turning off Fast Snapshot Restore for workshop %s… ' % (chosen_config,), end='')
+    sys.stdout.flush()
+    problems = list()
+    try:
+        shards = workshops.workshop_shards(config, chosen_config)
+    except (KeyError, ValueError) as e:
+        print('ERROR')
+        print('The workshop\'s launch template(s) could not be found in the configuration.')
+        return
+    for region, template, weight in shards:
+        try:
+            ec2_client = accounts.client(region)
+            found = fastrestore.resolve(ec2_client, template)
+            refused = fastrestore.set_fast_restore(
+                ec2_client,
+                found['snapshots'],
+                found['zones'],
+                enable=False,
+            )
+            for (snapshot_id, zone), reason in sorted(refused.items()):
+                problems.append('%s in %s (%s): %s' % (snapshot_id, zone, region, reason))
+        except Exception as e:
+            problems.append('%s in %s: %s' % (template, region, e))
+    if len(problems) > 0:
+        print('WARNING')
+        for problem in problems:
+            print('  %s' % (problem,))
+    else:
+        print('Complete')
+
+# Define a subroutine that releases the workshop's Elastic IPs (from
+# `suspend_workshop --keep-ips`), which are billed for as long as we hold them.
+def release_addresses():
+    released = 0
+    problems = list()
+    for region in chosen_regions:
+        try:
+            region_released, region_failures = suspend.release_addresses(
+                ec2_clients[region],
+                chosen_config,
+            )
+            released = released + region_released
+            for public_ip, e in sorted(region_failures.items()):
+                problems.append('%s in %s: %s' % (public_ip, region, e))
+        except Exception as e:
+            problems.append('%s: %s' % (region, e))
+    for problem in problems:
+        print('WARNING: Elastic IP %s could not be released' % (problem,))
+    if released > 0:
+        print('Released %d Elastic IP(s).' % (released,))
+
+if len(instance_ids) == 0:
+    print('There are no instances to terminate in workshop %s.' % (chosen_config,))
+    release_addresses()
+    if args.disable_fast_restore:
+        disable_fast_restore()
+    print('Goodbye')
+    exit()
+
+# Give the user one chance to abort.
+print('')
+print('WARNING!!!  You are about to terminate %d instance(s) in workshop %s (region %s).' % (
+    len(instance_ids),
+    chosen_config,
+    ', '.join(sorted(instance_ids_by_region.keys())),
+))
+print('Once instance termination begins, it may not be stopped!')
+response = None
+while response is None:
+    try:
+        response = input('Are you sure you wish to proceed (y/n)? ')
+    except (EOFError, KeyboardInterrupt):
+        response = 'n'
+    if response not in ('y', 'n'):
+        response = None
+if response == 'n':
+    print('Taking no action.')
+    print('Goodbye')
+    exit()
+
+# Send the termination requests, in chunks.
+progress_bar = Bar(
+    'Requesting instance termination…',
+    max=len(instance_ids),
+)
+progress_bar.start()
+sys.stdout.flush()
+states, failures = terminate.terminate_instances_by_region(
+    ec2_clients,
+    instance_ids_by_region,
+    on_chunk_done=progress_bar.next,
+)
+progress_bar.finish()
+
+# Report anything that could not be terminated
+for instance_id in sorted(failures.keys()):
+    print('WARNING: Instance %s could not be terminated: %s' % (
+        instance_id,
+        failures[instance_id],
+    ))
+print('Termination requested for %d instance(s).' % (len(states),))
+release_addresses()
+
+# If asked, follow the instances until they are actually terminated.
+if args.wait and len(states) > 0:
+    progress_bar = Bar(
+        'Waiting for instances to terminate…',
+        max=len(states),
+    )
+    print('(Press <Control-C> to stop waiting; termination will continue.)')
+    progress_bar.start()
+    sys.stdout.flush()
+    wait_error = None
+    try:
+        remaining = terminate.wait_for_termination_by_region(
+            ec2_clients,
+            dict(
+                (region, list(
+                    instance_id for instance_id in region_instance_ids
+                    if instance_id in states
+                ))
+                for region, region_instance_ids in instance_ids_by_region.items()
+            ),
+            timeout=worker_timeout,
+            on_terminated=lambda instance_id: progress_bar.next(),
+        )
+    except KeyboardInterrupt:
+        remaining = None
+    except Exception as e:
+        # The terminations were already requested, so a problem here only
+        # means we can't follow them.
+        wait_error = e
+        remaining = None
+    progress_bar.finish()
+
+    # Report what didn't finish
+    if wait_error is not None:
+        print('WARNING: We were unable to check on the terminations.')
+        print('The exact error we got:', wait_error)
+    if remaining is None:
+        print('Stopped waiting.')
+    elif len(remaining) > 0:
+        for instance_id in sorted(remaining.keys()):
+            print('WARNING: Instance %s has not terminated yet (last state: %s)' % (
+                instance_id,
+                remaining[instance_id],
+            ))
+    else:
+        print('All %d instance(s) terminated.' % (len(states),))
+
+# If asked, turn off Fast Snapshot Restore (see `prewarm_workshop`), which is
+# billed for as long as it is on.
+if args.disable_fast_restore:
+    disable_fast_restore()
+
+# All done!
+print('Goodbye')
+exit()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module remembers what is inside each workshop's launch template (its
+# AMI, instance type, subnets, security groups, and so on), so that planning
+# a launch doesn't need an API call for every template, every time.
+#
+# A launch template version never changes once it is made, so the contents of
+# each version are kept (keyed by template ID and version number) until they
+# haven't been used for a while.  What can change is which version is the
+# template's default.  So, we also remember each template's default version
+# number, and when we last confirmed it.  The default is confirmed whenever a
+# script calls `describe_launch_templates` anyway (see `note_defaults`), and
+# otherwise, once it is older than `default_ttl`.  A new default version means
+# a new key, so the old contents are never used for it.
+#
+# The cache is kept (and locked) by the `jsoncache` module.
+
+# First, import modules from the standard library
+import contextlib
+import time
+
+# Then, import our own stuff
+import jsoncache
+
+
+cache_path = jsoncache.path('launch_templates.json')
+
+# How long (in seconds) we trust a remembered default version number.
+default_ttl = 60 * 60
+
+# Versions not used for this long are dropped when the cache is written.
+max_age = 7 * 24 * 60 * 60
+
+
+# Make the key for a template version.
+def version_key(template, version):
+    return '%s:%d' % (template, version)
+
+
+# Make an empty cache.
+def empty():
+    return {
+        'defaults': dict(),
+        'versions': dict(),
+    }
+
+
+# Check that the cache (as read from disk) looks right.
+def is_valid(cache):
+    return (
+        isinstance(cache, dict) and
+        isinstance(cache.get('defaults'), dict) and
+        isinstance(cache.get('versions'), dict)
+    )
+
+
+# Read the cache.  A missing or broken cache is the same as an empty one.
+# Returns a dict with two dicts: `defaults` maps template IDs to their default
+# version number (and when it was confirmed), and `versions` maps version keys
+# to their contents (and when they were last used).
+def load():
+    return jsoncache.read(cache_path, is_valid) or empty()
+
+
+# Change the cache, for a `with` block (see `jsoncache.update`).  Old entries
+# are dropped before it is written.
+@contextlib.contextmanager
+def update():
+    with jsoncache.update(cache_path, empty, is_valid) as cache:
+        yield cache
+        now = time.time()
+        cache['defaults'] = dict(
+            (template, entry) for template, entry in cache['defaults'].items()
+            if now - entry['checked_at'] < max_age
+        )
+        cache['versions'] = dict(
+            (key, entry) for key, entry in cache['versions'].items()
+            if now - entry['used_at'] < max_age
+        )
+
+
+# Record the default version numbers from a `describe_launch_templates`
+# response (a list of launch templates).  A template whose default has moved
+# will have its new default version fetched the next time it is resolved.
+def note_defaults(launch_templates):
+    if len(launch_templates) == 0:
+        return
+    with update() as cache:
+        now = time.time()
+        for launch_template in launch_templates:
+            cache['defaults'][launch_template['LaunchTemplateId']] = {
+                'version': launch_template['DefaultVersionNumber'],
+                'checked_at': now,
+            }
+
+
+# Get the contents (the `LaunchTemplateData`) of a template's default version.
+# The cache is used if it can be; otherwise, one `describe_launch_template_versions`
+# call gets the default version's number and contents together.
+def template_data(ec2_client, template):
+    cache = load()
+    now = time.time()
+
+    default = cache['defaults'].get(template)
+    if default is not None and now - default['checked_at'] < default_ttl:
+        entry = cache['versions'].get(version_key(template, default['version']))
+        if entry is not None:
+            # Only note the use now and then, so reads don't always write.
+            if now - entry['used_at'] > default_ttl:
+                with update() as cache:
+                    if version_key(template, default['version']) in cache['versions']:
+                        cache['versions'][version_key(template, default['version'])]['used_at'] = now
+            return entry['data']
+
+    response = ec2_client.describe_launch_template_versions(
+        LaunchTemplateId=template,
+        Versions=['$Default'],
+    )
+    version = response['LaunchTemplateVersions'][0]
+    with update() as cache:
+        cache['defaults'][template] = {
+            'version': version['VersionNumber'],
+            'checked_at': now,
+        }
+        cache['versions'][version_key(template, version['VersionNumber'])] = {
+            'data': version['LaunchTemplateData'],
+            'used_at': now,
+        }
+    return version['LaunchTemplateData']
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module terminates instances in bounded chunks, sent concurrently, and
+# then follows the instances until EC2 reports them as `terminated`.
+
+# First, import modules from the standard library
+import concurrent.futures
+import random
+import time
+
+
+# How many instance IDs go into each `terminate_instances` call.
+chunk_size = 100
+
+# How many calls may be in flight at once.
+# (boto3 clients are thread-safe, so all workers share one client.)
+max_workers = 4
+
+# How many times a chunk is tried before we give up on it.
+chunk_attempts = 3
+
+# These errors mean that some instance in the request is bad, so retrying the
+# same request will never work.  Instead, we split the chunk to find the
+# bad instance IDs.
+permanent_errors = (
+    'InvalidInstanceID.Malformed',
+    'InvalidInstanceID.NotFound',
+    'OperationNotPermitted',
+)
+
+# These errors mean that the whole request is bad (for example, we aren't
+# allowed to make it), so the whole chunk fails right away.
+chunk_errors = (
+    'UnauthorizedOperation',
+)
+
+# How many instance IDs go into each `describe_instances` filter.
+# (EC2 allows up to 200 values per filter.)
+describe_chunk_size = 200
+
+
+# Split a list into lists of (at most) `size` items.
+def chunks(items, size):
+    items = list(items)
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+# Make one call (like `terminate_instances`) for a chunk of instances.
+# `call` is the client method, and `response_key` is the list in its response
+# with the new instance states; any other keyword arguments go to the call.
+# Throttling (and other passing problems) is retried a few times, and then the
+# whole chunk fails; the chunk is only split when EC2 says one of its
+# instances is bad.  `split_errors` are more error codes that mean that.
+# Returns a tuple of two dicts:
+# The first maps instance IDs to the state EC2 reported after the call.
+# The second maps instance IDs (that the call failed for) to exceptions.
+def change_chunk(call, response_key, instance_ids, split_errors=(), **kwargs):
+    # botocore comes along with boto3.  It is imported here (and not at the
+    # top) so that importing this module doesn't slow down start-up.
+    from botocore.exceptions import ClientError
+
+    states = dict()
+    failures = dict()
+
+    error = None
+    split = False
+    for attempt in range(0, chunk_attempts):
+        try:
+            response = call(
+                InstanceIds=list(instance_ids),
+                **kwargs
+            )
+            for instance in response[response_key]:
+                states[instance['InstanceId']] = instance['CurrentState']['Name']
+            return (states, failures)
+        except ClientError as e:
+            error = e
+            if e.response['Error']['Code'] in (permanent_errors + tuple(split_errors)):
+                split = True
+                break
+            if e.response['Error']['Code'] in chunk_errors:
+                break
+        except Exception as e:
+            error = e
+
+        # Wait a little (with jitter) before the next attempt.
+        if attempt + 1 < chunk_attempts:
+            time.sleep(random.uniform(0, 2 ** attempt))
+
+    # If we ran out of attempts (or the request itself is bad), the whole
+    # chunk has failed.  Splitting it would only mean more calls.
+    # Also, if this was a single instance, it has failed.
+    if not split or len(instance_ids) == 1:
+        for instance_id in instance_ids:
+            failures[instance_id] = error
+        return (states, failures)
+
+    # Otherwise, split the chunk in half, and try each half on its own.
+    # That way, one bad instance does not sink the whole chunk.
+    middle = len(instance_ids) // 2
+    for half in (instance_ids[:middle], instance_ids[middle:]):
+        half_states, half_failures = change_chunk(
+            call,
+            response_key,
+            half,
+            split_errors=split_errors,
+            **kwargs
+        )
+        states.update(half_states)
+        failures.update(half_failures)
+    return (states, failures)
+
+
+# Terminate one chunk of instances.
+# See `change_chunk` for what is returned.
+def terminate_chunk(ec2_client, instance_ids):
+    return change_chunk(
+        ec2_client.terminate_instances,
+        'TerminatingInstances',
+        instance_ids,
+    )
+
+
+# Terminate instances spread across several regions, in concurrent chunks.
+# `ec2_clients` maps region names to EC2 clients, and `instance_ids_by_region`
+# maps region names to lists of instance IDs.  Chunks from every region share
+# one pool of workers.
+# `on_chunk_done` (if provided) is called with the number of instances in each
+# chunk, as each chunk finishes.
+# Returns a tuple of two dicts; see `change_chunk` for details.
+def terminate_instances_by_region(ec2_clients, instance_ids_by_region, on_chunk_done=None):
+    states = dict()
+    failures = dict()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for region, instance_ids in instance_ids_by_region.items():
+            for chunk in chunks(instance_ids, chunk_size):
+                futures[executor.submit(
+                    terminate_chunk,
+                    ec2_clients[region],
+                    chunk,
+                )] = chunk
+        for future in concurrent.futures.as_completed(futures):
+            chunk_states, chunk_failures = future.result()
+            states.update(chunk_states)
+            failures.update(chunk_failures)
+            if on_chunk_done is not None:
+                on_chunk_done(len(futures[future]))
+
+    return (states, failures)
+
+
+# Terminate a list of instances (all in one region), in concurrent chunks.
+# See `terminate_instances_by_region` for details.
+def terminate_instances(ec2_client, instance_ids, on_chunk_done=None):
+    return terminate_instances_by_region(
+        {ec2_client.meta.region_name: ec2_client},
+        {ec2_client.meta.region_name: list(instance_ids)},
+        on_chunk_done=on_chunk_done,
+    )
+
+
+# Wait for instances, spread across several regions, to reach the `terminated`
+# state.  The arguments are like those of `terminate_instances_by_region`.
+# `on_terminated` (if provided) is called with each instance ID, as it becomes
+# terminated.  Instances which EC2 no longer knows about count as terminated.
+# Returns a dict of instance IDs (which did not finish in time) to their last
+# known state.
+def wait_for_termination_by_region(ec2_clients, instance_ids_by_region, timeout=600, on_terminated=None):
+    remaining = dict()
+    instance_regions = dict()
+    for region, instance_ids in instance_ids_by_region.items():
+        for instance_id in instance_ids:
+            remaining[instance_id] = None
+            instance_regions[instance_id] = region
+    wait_starttime = time.monotonic()
+
+    while (
+        (len(remaining) > 0) and
+        (time.monotonic() - wait_starttime <= timeout)
+    ):
+        seen = set()
+        for region in set(instance_regions[instance_id] for instance_id in remaining):
+            region_remaining = list(
+                instance_id for instance_id in remaining
+                if instance_regions[instance_id] == region
+            )
+            for chunk in chunks(region_remaining, describe_chunk_size):
+                response_iterator = ec2_clients[region].get_paginator('describe_instances').paginate(
+                    Filters=[{
+                        'Name': 'instance-id',
+                        'Values': chunk,
+                    }],
+                ).search('Reservations[].Instances[].[InstanceId, State.Name]')
+                for instance_id, instance_state in response_iterator:
+                    seen.add(instance_id)
+                    remaining[instance_id] = instance_state
+
+        # Anything terminated (or gone) is done.
+        for instance_id in list(remaining.keys()):
+            if (
+                (instance_id not in seen) or
+                (remaining[instance_id] == 'terminated')
+            ):
+                del remaining[instance_id]
+                if on_terminated is not None:
+                    on_terminated(instance_id)
+
+        # If we have any items left to check, wait zero to 5 seconds before trying again
+        if len(remaining) > 0:
+            time.sleep(random.randrange(0, 500, 1) / 100)
+
+    return remaining
+
+
+# Wait for instances (all in one region) to reach the `terminated` state.
+# See `wait_for_termination_by_region` for details.
+def wait_for_termination(ec2_client, instance_ids, timeout=600, on_terminated=None):
+    return wait_for_termination_by_region(
+        {ec2_client.meta.region_name: ec2_client},
+        {ec2_client.meta.region_name: list(instance_ids)},
+        timeout=timeout,
+        on_terminated=on_terminated,
+    )
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module remembers which workshops recently passed their AWS checks, so
+# the scripts don't have to re-check a workshop's launch template every time.
+#
+# Each entry is keyed by a hash of the workshop's config section, plus the
+# identity of the credentials that did the check.  So, changing anything in a
+# workshop's config (or switching credentials) means a fresh check.  Entries
+# expire after the workshop's `validation_ttl` (default: one hour).  Set
+# `validation_ttl = 0m` to always check.
+#
+# The cache is kept (and locked) by the `jsoncache` module.
+
+# First, import modules from the standard library
+import contextlib
+import hashlib
+import json
+import time
+
+# Try importing other stuff
+# (Scripts import this module inside their own import check.)
+import filters
+import jsoncache
+import startup
+
+
+cache_path = jsoncache.path('workshop_validation.json')
+
+# How long an entry is good for, if the workshop doesn't say.
+default_ttl = '1h'
+
+# Entries older than this are dropped when the cache is written.
+max_age = 7 * 24 * 60 * 60
+
+
+# Work out who our credentials belong to, without an API call.
+# The access key ID is enough to tell one set of credentials from another.
+# Uses our shared session, unless another is given.
+# Returns None if there are no credentials.
+def credential_identity(session=None):
+    if session is None:
+        session = startup.get_session()
+    credentials = session.get_credentials()
+    if credentials is None:
+        return None
+    return credentials.access_key
+
+
+# Make the cache key for a workshop.
+def entry_key(config, workshop, identity):
+    key_source = json.dumps({
+        'identity': identity,
+        'workshop': workshop,
+        'config': sorted(config[workshop].items()),
+    }, sort_keys=True)
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+# Get a workshop's TTL, in seconds.
+def workshop_ttl(config, workshop):
+    try:
+        return filters.parse_age(config[workshop].get('validation_ttl', default_ttl))
+    except ValueError:
+        return filters.parse_age(default_ttl)
+
+
+# Check that the cache (as read from disk) looks right.
+def is_valid(cache):
+    return isinstance(cache, dict)
+
+
+# Read the cache.  A missing or broken cache is the same as an empty one.
+# Returns a dict of keys to the time (in seconds since the epoch) of the check.
+def load():
+    return jsoncache.read(cache_path, is_valid) or dict()
+
+
+# Change the cache, for a `with` block (see `jsoncache.update`).  Old entries
+# are dropped before it is written.
+@contextlib.contextmanager
+def update():
+    with jsoncache.update(cache_path, dict, is_valid) as cache:
+        yield cache
+        now = time.time()
+        for key, checked_at in list(cache.items()):
+            if now - checked_at >= max_age:
+                del cache[key]
+
+
+# Check if a workshop passed its checks recently.
+def is_fresh(cache, config, workshop, identity):
+    if identity is None:
+        return False
+    checked_at = cache.get(entry_key(config, workshop, identity))
+    if checked_at is None:
+        return False
+    return time.time() - checked_at < workshop_ttl(config, workshop)
+
+
+# Record that some workshops just passed their checks.
+def record(config, workshop_list, identity):
+    if identity is None or len(workshop_list) == 0:
+        return
+    with update() as cache:
+        now = time.time()
+        for workshop in workshop_list:
+            cache[entry_key(config, workshop, identity)] = now
+
+
+# Forget an entry (by its key, from `entry_key`), so the workshop is checked
+# again next time.  Use this when something goes wrong that a check should
+# have caught.
+def forget(key):
+    with update() as cache:
+        cache.pop(key, None)
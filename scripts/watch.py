@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module is the live "watch" view used by `destroy_instances`.
+# It takes over the terminal (using curses), polls EC2 for the instances being
+# shown, and redraws only the rows that changed.  Rows can be selected and
+# terminated without leaving the view.
+
+# First, import modules from the standard library
+import curses
+import time
+
+# Then, import our own modules
+import inventory
+
+
+# Polling starts fast, and slows down (doubling each time) while nothing is
+# changing.  Any change, or any instance in a transitional state, resets the
+# interval back to the minimum.  Times are in seconds.
+min_interval = 2
+max_interval = 30
+
+# These states will change on their own, so we poll quickly while we see them.
+transitional_states = ('pending', 'stopping', 'shutting-down')
+
+# Only instances in these states are polled.  Anything that drops out of the
+# results has been terminated (and maybe cleaned up by EC2).
+polled_states = (
+    'pending', 'running',
+    'stopping', 'stopped',
+    'shutting-down',
+)
+
+
+# Count the instances in each state, in our preferred state order.
+def count_states(instances):
+    counts = dict((state, 0) for state in inventory.INSTANCE_STATES)
+    for instance in instances.values():
+        counts[instance['State']] = counts.get(instance['State'], 0) + 1
+    return counts
+
+
+# Format one row of the table.  `selected` adds a marker in the first column.
+# `show_workshop` adds the workshop and region, when several are being shown.
+def format_row(instance, selected, show_workshop=False):
+    row = '%s %19s | %15s | %17s | %13s' % (
+        '*' if selected else ' ',
+        instance['InstanceId'],
+        '' if instance['PublicIpAddress'] is None else instance['PublicIpAddress'],
+        instance['LaunchTime'].strftime('%a, %b %d %H:%M'),
+        instance['State'],
+    )
+    if show_workshop:
+        row = '%s | %s (%s)' % (row, instance['Workshop'], instance['Region'])
+    return row
+
+
+# Poll EC2 for all non-terminal instances, and merge the results.
+# `fetch` is called with a list of states, and returns an iterable of
+# instance records (from the `inventory` module).
+# Returns True if anything changed.
+def poll(fetch, instances):
+    changed = False
+    seen = set()
+    for instance in fetch(polled_states):
+        seen.add(instance['InstanceId'])
+        old_instance = instances.get(instance['InstanceId'])
+        if (
+            (old_instance is None) or
+            (old_instance['State'] != instance['State']) or
+            (old_instance['PublicIpAddress'] != instance['PublicIpAddress'])
+        ):
+            instances[instance['InstanceId']] = instance
+            changed = True
+
+    # Anything we were polling, which didn't come back, is now terminated.
+    for instance_id, instance in instances.items():
+        if instance['State'] in polled_states and instance_id not in seen:
+            instance['State'] = 'terminated'
+            changed = True
+
+    return changed
+
+
+# The curses main loop.  Use `watch_instances` instead of calling this.
+def _watch(stdscr, title, instances, fetch, terminate):
+    curses.curs_set(0)
+    stdscr.timeout(250)
+
+    # Rows are kept in instance-ID order; new instances are slotted in.
+    order = sorted(instances.keys())
+    selected = set()
+    cursor = 0
+    top = 0
+
+    # `drawn` remembers what is on each screen line, so we only redraw changes.
+    drawn = dict()
+
+    interval = min_interval
+    next_poll = time.monotonic()
+    status = ''
+
+    while True:
+        # Is it time to poll?
+        if time.monotonic() >= next_poll:
+            try:
+                changed = poll(fetch, instances)
+            except Exception as e:
+                changed = False
+                status = 'Polling failed: %s' % (e,)
+            if changed:
+                order = sorted(instances.keys())
+            if changed or any(
+                instance['State'] in transitional_states
+                for instance in instances.values()
+            ):
+                interval = min_interval
+            else:
+                interval = min(interval * 2, max_interval)
+            next_poll = time.monotonic() + interval
+
+        # Work out what each line of the screen should hold.
+        height, width = stdscr.getmaxyx()
+        rows_visible = max(1, height - 4)
+        if len(order) > 0:
+            cursor = max(0, min(cursor, len(order) - 1))
+        if cursor < top:
+            top = cursor
+        elif cursor >= top + rows_visible:
+            top = cursor - rows_visible + 1
+
+        counts = count_states(instances)
+        show_workshop = len(set(
+            (instance['Workshop'], instance['Region'])
+            for instance in instances.values()
+        )) > 1
+        lines = list()
+        lines.append((
+            '%s: %d instance(s)  %s  (next poll in %ds)' % (
+                title,
+                len(instances),
+                '  '.join(
+                    '%s %d' % (state, count)
+                    for state, count in counts.items()
+                    if count > 0
+                ),
+                max(0, next_poll - time.monotonic()),
+            ),
+            curses.A_BOLD,
+        ))
+        lines.append((
+            '       Instance ID     |    Public IP    |      Created      |     State',
+            curses.A_UNDERLINE,
+        ))
+        for i in range(top, top + rows_visible):
+            if i < len(order):
+                instance_id = order[i]
+                lines.append((
+                    format_row(
+                        instances[instance_id],
+                        instance_id in selected,
+                        show_workshop,
+                    ),
+                    curses.A_REVERSE if i == cursor else curses.A_NORMAL,
+                ))
+            else:
+                lines.append(('', curses.A_NORMAL))
+        lines.append((status, curses.A_NORMAL))
+        lines.append((
+            'space select  a all  c clear  t terminate  r refresh  q quit  (%d selected)' % (
+                len(selected),
+            ),
+            curses.A_DIM,
+        ))
+
+        # Redraw only the lines that changed.
+        for y, line in enumerate(lines[:height]):
+            # Curses won't let us write the bottom-right cell, so stay short.
+            line = (line[0][:width - 1], line[1])
+            if drawn.get(y) != line:
+                stdscr.move(y, 0)
+                stdscr.clrtoeol()
+                stdscr.addstr(y, 0, line[0], line[1])
+                drawn[y] = line
+        stdscr.refresh()
+
+        # Wait for a key (this times out, so we keep polling).
+        key = stdscr.getch()
+        if key == -1:
+            continue
+        elif key == curses.KEY_RESIZE:
+            stdscr.clear()
+            drawn.clear()
+        elif key in (ord('q'), 27):
+            return
+        elif key in (curses.KEY_UP, ord('k')):
+            cursor = max(0, cursor - 1)
+        elif key in (curses.KEY_DOWN, ord('j')):
+            cursor = cursor + 1
+        elif key == curses.KEY_PPAGE:
+            cursor = max(0, cursor - rows_visible)
+        elif key == curses.KEY_NPAGE:
+            cursor = cursor + rows_visible
+        elif key == ord(' ') and len(order) > 0:
+            selected.symmetric_difference_update((order[cursor],))
+        elif key == ord('a'):
+            selected = set(
+                instance_id for instance_id in order
+                if instances[instance_id]['State'] != 'terminated'
+            )
+        elif key == ord('c'):
+            selected.clear()
+        elif key == ord('r'):
+            next_poll = time.monotonic()
+        elif key == ord('t'):
+            if len(selected) == 0:
+                status = 'Select some instances first (space to select).'
+                continue
+
+            # Ask for confirmation on the status line, and wait for an answer.
+            status = 'Terminate %d instance(s)?  This cannot be undone!  (y/n)' % (
+                len(selected),
+            )
+            stdscr.move(height - 2, 0)
+            stdscr.clrtoeol()
+            stdscr.addstr(height - 2, 0, status[:width - 1], curses.A_BOLD)
+            drawn.pop(height - 2, None)
+            stdscr.timeout(-1)
+            answer = stdscr.getch()
+            stdscr.timeout(250)
+            if answer != ord('y'):
+                status = 'Taking no action.'
+                continue
+
+            try:
+                failures = terminate(sorted(selected), instances) or dict()
+                status = 'Requested termination of %d instance(s).' % (
+                    len(selected) - len(failures),
+                )
+                if len(failures) > 0:
+                    status = '%s  %d failed (%s: %s)' % (
+                        status,
+                        len(failures),
+                        sorted(failures.keys())[0],
+                        failures[sorted(failures.keys())[0]],
+                    )
+
+                # Failed instances stay selected, so they can be retried.
+                selected = set(failures.keys())
+            except Exception as e:
+                status = 'Termination failed: %s' % (e,)
+
+            # Things are about to change, so start polling quickly.
+            interval = min_interval
+            next_poll = time.monotonic()
+    # Done with the main loop
+
+
+# Run the watch view until the user quits.
+# `title` is shown at the top of the screen.
+# `instances` is a dict of normalized records (from the `inventory` module),
+# used as the starting point; it is not modified.
+# `fetch` is called with a list of states, and returns an iterable of records.
+# `terminate` is called with a list of instance IDs to terminate, and the
+# view's own dict of records (which includes any instances that appeared while
+# the view was open).  It may return a dict of instance IDs (which could not
+# be terminated) to errors.
+def watch_instances(title, instances, fetch, terminate):
+    return curses.wrapper(
+        _watch,
+        title,
+        dict(
+            (instance_id, dict(instance))
+            for instance_id, instance in instances.items()
+        ),
+        fetch,
+        terminate,
+    )
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+# Copyright © 2018 The Board of Trustees of the Leland Stanford Junior University.
+
+# The contents of this file are licensed under the
+# GNU General Public License, Version 3.
+# In addition, documentation in this file is licensed under the
+# Creative Commons Attribution-ShareAlike 3.0 Unported.
+# See the files `LICENSE` and `LICENSE.cc-by-sa-3` for full license text.
+
+# This module holds the start-up steps shared by the scripts that work with
+# workshops: Reading the config files, checking that we can talk to AWS,
+# checking each workshop's configuration, and choosing a workshop.
+# Like the scripts themselves, these subroutines print what went wrong and
+# exit when something is not usable.
+#
+# To keep start-up quick, the checks are in two steps: `check_workshops` only
+# looks at the config (no AWS calls), so the menu can be shown right away.
+# Once a workshop is chosen, `check_templates` makes the AWS calls, for just
+# the chosen workshop(s).
+
+# First, import modules from the standard library
+import concurrent.futures
+import os
+from os import environ
+from sys import exit
+
+# Try importing other stuff
+# (Scripts import this module inside their own import check.)
+import accounts
+import configstore
+from progress.spinner import Spinner
+import preflight
+import regions
+import startup
+import templates
+import validation
+
+
+# These environment variables point to our config files.
+config_vars = (
+    'AWS_CONFIG_FILE',
+    'AWS_SHARED_CREDENTIALS_FILE',
+    'CREATE_INSTANCES_CONFIG',
+)
+
+# `choose_workshop` returns this when the user picks "all workshops".
+ALL_WORKSHOPS = '(All workshops)'
+
+# These items are required in each workshop's config.
+workshop_vars = (
+    'template',
+    'region',
+    'instructions',
+    'maximum',
+)
+
+# The weight a shard gets, if its line in `shards` doesn't give one.
+default_shard_weight = 1
+
+
+# Define a subroutine that finds our config files, and then reads a snapshot
+# of the workshop config (see the `configstore` module).  The config is only
+# locked while it is being read.  The snapshot is returned with the config;
+# use it with `configstore.changed` to see if the config has since changed.
+def load_config():
+    # Look for our config files
+    spinner = Spinner('Checking Configuration ')
+    for var in config_vars:
+        spinner.next()
+        if var not in environ:
+            print('Environment variable %s is missing.  Re-run `finish_install`.' % (
+                var,
+            ))
+            exit()
+        if not os.path.isfile(environ[var]):
+            print('The %s file appears to be missing.  Re-run `finish_install`.' % (
+                var,
+            ))
+            exit()
+
+    # Try loading our config
+    spinner.next()
+    try:
+        config, snapshot = configstore.read_config(environ['CREATE_INSTANCES_CONFIG'])
+        spinner.next()
+    except OSError as e:
+        print('ERROR')
+        print('There was a problem opening and locking the file at %s: %s' % (
+            environ['CREATE_INSTANCES_CONFIG'],
+            e,
+        ))
+        print('There may be a permission problem.')
+        exit()
+    except Exception as e:
+        print('ERROR')
+        print('The instance configuration file could not be read.')
+        print('Here is the error: ', e)
+        print('Re-run `finish_install`')
+        exit()
+    print(' Complete')
+
+    return (config, snapshot)
+
+
+# Define a subroutine that returns a workshop's shards: The region/template
+# pairs its instances are launched into, each with a weight.  Most workshops
+# have one shard, made from their `region` and `template` items.  A workshop
+# may instead have a `shards` item, with one shard per line, like this:
+#
+#     shards =
+#         us-west-2 lt-0123456789abcdef0 2
+#         us-east-2 lt-0fedcba9876543210 1
+#
+# The weight (the last number) is optional.  A launch is split across the
+# shards in proportion to their weights.  To launch in another AWS account,
+# put its credential profile in front of the region, like `second:us-east-2`
+# (see the `accounts` module).  So, the "region" of a shard is really a
+# location, and so are the regions returned by `workshop_regions` and
+# `workshops_by_region`.
+# Returns a list of (region, template, weight) tuples.
+# Raises ValueError if the `shards` item can't be understood.
+def workshop_shards(config, workshop):
+    if 'shards' not in config[workshop]:
+        return [(
+            config[workshop]['region'],
+            config[workshop]['template'],
+            default_shard_weight,
+        )]
+
+    shards = list()
+    for line in config[workshop]['shards'].splitlines():
+        parts = line.split()
+        if len(parts) == 0:
+            continue
+        if len(parts) == 2:
+            parts.append(str(default_shard_weight))
+        if len(parts) != 3:
+            raise ValueError('expected "region template [weight]", got "%s"' % (
+                line.strip(),
+            ))
+        try:
+            weight = int(parts[2])
+        except ValueError:
+            weight = -1
+        if weight <= 0:
+            raise ValueError('invalid weight "%s"' % (parts[2],))
+        shards.append((parts[0], parts[1], weight))
+    if len(shards) == 0:
+        raise ValueError('no shards listed')
+    return shards
+
+
+# Define a subroutine that returns every region a workshop's instances may be
+# in: Its `region`, plus the region of each of its shards.
+# Returns a sorted list of region names.
+def workshop_regions(config, workshop):
+    workshop_region_set = set()
+    if 'region' in config[workshop]:
+        workshop_region_set.add(config[workshop]['region'])
+    try:
+        workshop_region_set.update(
+            region for region, template, weight
+            in workshop_shards(config, workshop)
+        )
+    except (KeyError, ValueError):
+        pass
+    return sorted(workshop_region_set)
+
+
+# Define a subroutine that groups workshops by region.  A workshop with shards
+# in several regions appears under each of them.
+# Returns a dict mapping region names to lists of workshop names.
+def workshops_by_region(config, workshop_list):
+    grouped = dict()
+    for workshop in workshop_list:
+        for region in workshop_regions(config, workshop):
+            grouped.setdefault(region, list()).append(workshop)
+    return grouped
+
+
+# Build the extra checks (for `check_connectivity`) to run before launching a
+# workshop's shards: We make sure we're allowed to launch (and tag) instances
+# with each shard's launch template.
+def launch_checks(shards):
+    region_checks = dict()
+    for region, template, weight in shards:
+        region_checks.setdefault(region, list()).append(('run_instances', {
+            'LaunchTemplate': {
+                'LaunchTemplateId': template,
+            },
+            'MinCount': 1,
+            'MaxCount': 1,
+            'TagSpecifications': [{
+                'ResourceType': 'instance',
+                'Tags': [{'Key': 'LaunchDate', 'Value': 'preflight'}],
+            }],
+        }))
+    return region_checks
+
+
+# Define a subroutine that checks for connectivity and permissions.
+# The checks are cheap dry-run calls (see the `preflight` module), made in the
+# default region, plus each region in `region_checks`.  `region_checks` maps
+# region names (or locations, for other accounts) to lists of extra
+# (operation, params) checks for that region.
+# If `read_only` is set, we only check that we can list instances.
+# Returns an EC2 client in the default region.
+def check_connectivity(region_checks=None, read_only=False):
+    if region_checks is None:
+        region_checks = dict()
+    if read_only:
+        common_checks = preflight.read_checks
+    else:
+        common_checks = preflight.basic_checks
+    spinner = Spinner('Talking to AWS ')
+
+    # Our EC2 client uses the default region for this check.
+    # Each account's checks are run with its own identity.
+    try:
+        ec2_client = startup.client('ec2')
+        checks_by_profile = {
+            accounts.DEFAULT_PROFILE: list(
+                (ec2_client.meta.region_name, ec2_client, operation, params)
+                for operation, params in common_checks
+            ),
+        }
+        for region, extra_checks in region_checks.items():
+            profile = accounts.split_location(region)[0]
+            region_client = accounts.client(region)
+            checks_by_profile.setdefault(profile, list()).extend(
+                (region, region_client, operation, params)
+                for operation, params in tuple(common_checks) + tuple(extra_checks)
+            )
+        checks = list()
+        results = list()
+        for profile, profile_checks in sorted(checks_by_profile.items()):
+            checks.extend(profile_checks)
+            results.extend(preflight.run_checks(
+                list(check[1:] for check in profile_checks),
+                validation.credential_identity(accounts.session(profile)),
+            ))
+            spinner.next()
+    except Exception as e:
+        print('ERROR!')
+        print('We were unable to talk to AWS.')
+        print('The exact error we got:', e)
+        print('Re-run `finish_install`')
+        exit()
+
+    # Report every refused call, not just the first.
+    failures = list(
+        (check[0], check[2], result)
+        for check, result in zip(checks, results)
+        if result is not True
+    )
+    if len(failures) > 0:
+        print('ERROR!')
+        print('Our credentials are not allowed to do everything we need:')
+        for region, operation, result in failures:
+            print('  %s in %s: %s' % (operation, region, result))
+        print('Re-run `finish_install`')
+        exit()
+    print(' Complete')
+
+    return ec2_client
+
+
+# Define a subroutine that checks over a workshop's config.
+# No AWS calls are made; see `check_template` for that.
+# Returns True if the workshop is usable, or a reason (a string) if not.
+def check_workshop(config, workshop):
+    # Make sure the required keys are in each workshop.
+    for var in workshop_vars:
+        if var not in config[workshop]:
+            return 'missing config item \'%s\'' % (var,)
+
+    # For maximum, do number tests
+    try:
+        maximum = config[workshop].getint('maximum')
+    except ValueError:
+        maximum = -1
+    if maximum <= 0:
+        return 'invalid item \'maximum\''
+
+    # Make sure the region is real.  This is checked locally, so a typo doesn't
+    # cost us an API call (or a long timeout).
+    if not regions.is_valid_region(config[workshop]['region']):
+        return 'unknown region \'%s\'' % (config[workshop]['region'],)
+
+    # The same goes for each shard's region, and (if it isn't the default)
+    # its account's credential profile.
+    try:
+        shards = workshop_shards(config, workshop)
+    except ValueError as e:
+        return 'invalid item \'shards\' (%s)' % (e,)
+    for location, template, weight in shards:
+        profile, region = accounts.split_location(location)
+        if not regions.is_valid_region(region):
+            return 'unknown shard region \'%s\'' % (region,)
+        if (
+            (profile != accounts.DEFAULT_PROFILE) and
+            (profile not in accounts.profiles())
+        ):
+            return 'unknown credential profile \'%s\'' % (profile,)
+
+    return True
+
+
+# Define a subroutine that checks we can access a workshop's launch template
+# (or, for a workshop with shards, each shard's launch template).
+# Returns True if the workshop is usable, or a reason (a string) if not.
+def check_template(config, workshop):
+    for region, template, weight in workshop_shards(config, workshop):
+        ec2_client = accounts.client(region)
+        try:
+            response = ec2_client.describe_launch_templates(
+                LaunchTemplateIds=[template],
+            )
+        except Exception as e:
+            return 'unable to pull up the launch template %s in %s' % (
+                template,
+                region,
+            )
+        templates.note_defaults(response['LaunchTemplates'])
+
+    return True
+
+
+# Define a subroutine that checks every workshop in the config.
+# Only the config is checked; see `check_templates` for the AWS side.
+# Returns a list of the usable workshop names.
+def check_workshops(config):
+    workshops = list()
+    spinner = Spinner('Checking %s workshop(s) ' % (
+        len(config.sections()),
+    ))
+
+    # Build our list of usable workshops
+    for workshop in config.sections():
+        result = check_workshop(config, workshop)
+        if result is not True:
+            print(' WARNING')
+            print('Workshop "%s": %s.' % (workshop, result))
+            print('Skipping this entry for now.  Re-run `finish_install` to fix.')
+            continue
+
+        # We have a good workshop!
+        workshops.append(workshop)
+        spinner.next()
+
+    # Done checking configuration
+    print(' Complete')
+
+    # While the menu is up, start making clients for the workshops' regions.
+    accounts.preload_clients(sorted(
+        workshops_by_region(config, workshops).keys()
+    ))
+
+    return workshops
+
+
+# Define a subroutine that checks the launch templates of some workshops.
+# Workshops that passed recently (see the `validation` module) are not checked
+# again; the rest are checked concurrently.
+# Returns a list of the usable workshop names.
+def check_templates(config, workshop_list):
+    spinner = Spinner('Checking launch template(s) ')
+
+    identity = validation.credential_identity()
+    cache = validation.load()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = dict(
+            (workshop, executor.submit(check_template, config, workshop))
+            for workshop in workshop_list
+            if not validation.is_fresh(cache, config, workshop, identity)
+        )
+        workshops = list()
+        for workshop in workshop_list:
+            if workshop not in results:
+                workshops.append(workshop)
+                continue
+            result = results[workshop].result()
+            spinner.next()
+            if result is not True:
+                print(' WARNING')
+                print('Workshop "%s": %s.' % (workshop, result))
+                print('Skipping this entry for now.  Re-run `finish_install` to fix.')
+                continue
+            workshops.append(workshop)
+
+    # Remember the workshops that passed.
+    validation.record(config, list(
+        workshop for workshop in workshops if workshop in results
+    ), identity)
+
+    if len(results) == 0:
+        print(' Complete (recently checked)')
+    else:
+        print(' Complete')
+
+    return workshops
+
+
+# Define a subroutine that asks the user to pick one workshop.
+# If `allow_all` is set, the user may also pick every workshop at once.
+# Returns the workshop name, ALL_WORKSHOPS, or None if the user chose to quit.
+def choose_workshop(workshops, heading='The following workshops are available:', allow_all=False):
+    config_names_as_list = ['(Quit)']
+    config_names_as_list.extend(workshops)
+    if allow_all and len(workshops) > 1:
+        config_names_as_list.append(ALL_WORKSHOPS)
+
+    print('')
+    print(heading)
+    for i in range(0, len(config_names_as_list)):
+        print('%3d: %s' % (i, config_names_as_list[i]))
+    choice_index = -1
+    while choice_index == -1:
+        try:
+            choice_index = input('Please choose a number from 0 to %d: ' % (len(config_names_as_list)-1,))
+        except (EOFError, KeyboardInterrupt):
+            choice_index = 0
+        try:
+            choice_index = int(choice_index)
+        # Make sure we have an integer in the range [0, len(config_names_as_list))
+        except ValueError:
+            print('Please enter a valid base 10 integer')
+            choice_index = -1
+            continue
+        if choice_index < 0:
+            print('Please enter a non-negative integer')
+            choice_index = -1
+        if choice_index >= len(config_names_as_list):
+            print('Please enter an integer less than %d' % (len(config_names_as_list),))
+            choice_index = -1
+
+    # Return the selection
+    if choice_index == 0:
+        return None
+    return config_names_as_list[choice_index]